@@ -0,0 +1,88 @@
+# -*- coding: ISO-8859-1 -*-
+
+# Copyright (C) 2003, 2004 Jrg Lehmann <joerg@luga.de>
+#
+# This file is part of PyTone (http://www.luga.de/pytone/)
+#
+# PyTone is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2
+# as published by the Free Software Foundation.
+#
+# PyTone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyTone; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+""" benchmark of the audio rendering pipeline of the decoder """
+
+import array, os.path, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import __builtin__
+__builtin__._ = lambda s: s
+
+# use the pcm module the decoder uses, i.e., the C or the NumPy implementation
+from decoder import pcm
+
+
+def benchmarkrendering(seconds=60, inrate=48000, outrate=44100, SIZE=4096):
+    """ measure the CPU time needed per second of audio output
+
+    Two songs with a sample rate of inrate are crossfaded, replaygain and
+    volume are applied. The old pipeline using pcm.rate_convert, pcm.scale
+    and pcm.mix is compared with pcm.render writing into a single buffer.
+    """
+    # frames as returned by libmad
+    frame = array.array("h", [(i*37) % 20000 - 10000 for i in range(2*1152)]).tostring()
+    nframes = seconds*inrate//1152
+
+    def oldpipeline():
+        states = [[None, 0, None, None], [None, 0, None, None]]
+        def read(state, size):
+            buff, buffpos, last_l, last_r = state
+            bytesleft = buff is not None and len(buff) - buffpos or 0
+            while bytesleft < size:
+                buff, last_l, last_r = pcm.rate_convert(frame, inrate, buff, buffpos,
+                                                        outrate, last_l, last_r)
+                buffpos = 0
+                bytesleft = len(buff)
+            state[:] = [buff, buffpos + size, last_l, last_r]
+            # pcm.scale needs a writable buffer
+            result = array.array("c", buff[buffpos:buffpos+size])
+            pcm.scale(result, 0.8)
+            return result.tostring()
+        ratio = 0
+        for i in xrange(nframes*1152*4*outrate//inrate//SIZE):
+            buff, ratio = pcm.mix(read(states[0], SIZE), read(states[1], SIZE), ratio, 1e-6)
+            pcm.scale(array.array("c", str(buff)), 0.5)
+
+    def newpipeline():
+        out = array.array("c", "\0"*SIZE)
+        states = [[0, None], [0, None]]
+        def readinto(state, factor, mixingratio, mixingrate):
+            start = 0
+            while start < SIZE:
+                state[0], start, state[1], mixingratio = pcm.render(out, start, SIZE, frame, state[0],
+                                                                    inrate, outrate, state[1],
+                                                                    factor, mixingratio, mixingrate)
+                if state[0] >= len(frame):
+                    state[0] = 0
+            return mixingratio
+        ratio = 0
+        for i in xrange(nframes*1152*4*outrate//inrate//SIZE):
+            readinto(states[0], 0.8*0.5, 1, None)
+            ratio = readinto(states[1], 0.8*0.5, ratio, 1e-6)
+
+    for pipeline in oldpipeline, newpipeline:
+        starttime = time.clock()
+        pipeline()
+        cputime = time.clock() - starttime
+        print "%s: %.2f ms CPU per second of audio" % (pipeline.__name__, 1000*cputime/seconds)
+
+
+if __name__ == "__main__":
+    benchmarkrendering()
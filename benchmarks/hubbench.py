@@ -0,0 +1,75 @@
+# -*- coding: ISO-8859-1 -*-
+
+# Copyright (C) 2003, 2004 Jrg Lehmann <joerg@luga.de>
+#
+# This file is part of PyTone (http://www.luga.de/pytone/)
+#
+# PyTone is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2
+# as published by the Free Software Foundation.
+#
+# PyTone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyTone; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+""" micro benchmarks of the event dispatching and of the request queues of the hub """
+
+import os.path, sys, time, types
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import events, hub, log
+
+
+def benchmarkdispatch(nchannels=12, nevents=20000):
+    """ measure the number of events per second dispatched to one of nchannels channels
+
+    Only the receiving channel is processed, so that the measurement is not
+    dominated by polling the queues of all channels.
+    """
+    ahub = hub.hub()
+    eventclasses = [types.ClassType("event%d" % i, (events.event,), {}) for i in range(nchannels)]
+    received = []
+    channels = []
+    for eventclass in eventclasses:
+        achannel = ahub.newchannel()
+        achannel.subscribe(events.quit, received.append)
+        achannel.subscribe(eventclass, received.append)
+        channels.append(achannel)
+    anevent = eventclasses[0]()
+    receiver = channels[0]
+    starttime = time.time()
+    for i in range(nevents):
+        ahub.notify(anevent)
+        receiver.process()
+    duration = time.time() - starttime
+    assert len(received) == nevents
+    for achannel in channels[1:]:
+        assert achannel.queue.empty()
+    print "%d channels: %d events/s" % (nchannels, nevents/duration)
+
+
+def benchmarkqueue(nbackground=20000, nrequests=1000):
+    """ measure the time needed to put and get a request into a queue filled with background items """
+    queue = hub.PriorityQueue(-1)
+    for i in range(nbackground):
+        queue.put((i, 100))
+    starttime = time.time()
+    for i in range(nrequests):
+        queue.put((i, 0))
+        queue.get()
+    duration = time.time() - starttime
+    print "%d background items: %.1f us per request" % (nbackground, 1e6*duration/nrequests)
+
+
+if __name__ == "__main__":
+    # the logging of each event would dominate the measurement
+    log.debug = lambda s: None
+    for nchannels in (1, 12, 50):
+        benchmarkdispatch(nchannels)
+    for nbackground in (100, 20000):
+        benchmarkqueue(nbackground)
@@ -0,0 +1,108 @@
+# -*- coding: ISO-8859-1 -*-
+
+# Copyright (C) 2003, 2004 Jrg Lehmann <joerg@luga.de>
+#
+# This file is part of PyTone (http://www.luga.de/pytone/)
+#
+# PyTone is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2
+# as published by the Free Software Foundation.
+#
+# PyTone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyTone; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+""" micro benchmark of the song handles """
+
+import os.path, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import __builtin__
+__builtin__._ = lambda s: s
+
+import item
+
+
+class dictsong(object):
+
+    """ song handle with an instance dictionary hashing a formatted string """
+
+    def __init__(self, songdbid, id, album_id, artist_id, album_artist_id, date_played=None):
+        self.songdbid = songdbid
+        self.id = id
+        self.album_id = album_id
+        self.artist_id = artist_id
+        self.album_artist_id = album_artist_id
+        self.date_played = date_played
+        self.song_metadata = None
+
+    def __hash__(self):
+        return hash("%r-%d" % (self.songdbid, self.id))
+
+    def __eq__(self, other):
+        return isinstance(other, dictsong) and self.songdbid == other.songdbid and self.id == other.id
+
+
+def _attributes(obj):
+    """ return the values of the attributes of obj stored in slots or in its instance dictionary """
+    values = []
+    for cls in type(obj).__mro__:
+        for name in getattr(cls, "__slots__", []):
+            if hasattr(obj, name):
+                values.append(getattr(obj, name))
+    if hasattr(obj, "__dict__"):
+        values.extend(obj.__dict__.values())
+    return values
+
+
+def memorypersong(songs):
+    """ return the average number of bytes allocated for each of the songs
+
+    This includes the instance dictionary, if present, and the attribute
+    values, where objects shared by several songs are only counted once.
+    """
+    seen = {}
+    size = 0
+    for song in songs:
+        objects = [song] + _attributes(song)
+        if hasattr(song, "__dict__"):
+            objects.append(song.__dict__)
+        for obj in objects:
+            if id(obj) not in seen:
+                seen[id(obj)] = obj
+                size += sys.getsizeof(obj)
+    return size / len(songs)
+
+
+def benchmarksongs(nsongs=500000, nsample=10000):
+    """ measure memory and time needed for a working set of nsongs song handles
+
+    The song handles are compared with a representation using an instance
+    dictionary and hashing a formatted string.
+    """
+    for songclass in item.song, dictsong:
+        starttime = time.time()
+        songs = [songclass("main", i, i // 10, i // 100, i // 100) for i in xrange(nsongs)]
+        creationtime = time.time() - starttime
+        size = memorypersong(songs[-nsample:])
+        # the set of songs is used by the autoregisterer to find the songs which have been removed
+        starttime = time.time()
+        songset = set(songs)
+        settime = time.time() - starttime
+        starttime = time.time()
+        for i in xrange(nsongs):
+            songset.discard(songclass("main", i, None, None, None))
+        discardtime = time.time() - starttime
+        assert not songset
+        print "%s: %d bytes per song, creation %.2fs, set %.2fs, discard %.2fs" % (
+            songclass.__name__, size, creationtime, settime, discardtime)
+        del songs, songset
+
+
+if __name__ == "__main__":
+    benchmarksongs()
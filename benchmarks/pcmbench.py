@@ -0,0 +1,72 @@
+# -*- coding: ISO-8859-1 -*-
+
+# Copyright (C) 2003, 2004 Jrg Lehmann <joerg@luga.de>
+#
+# This file is part of PyTone (http://www.luga.de/pytone/)
+#
+# PyTone is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2
+# as published by the Free Software Foundation.
+#
+# PyTone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyTone; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+""" comparison of the throughput and the results of the C and the NumPy pcm modules """
+
+import array, os.path, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import numpy
+import pcm, pcmnumpy
+
+
+def benchmarkpcm(chunksizes=(512, 4096, 32768), seconds=10):
+    """ compare throughput and results of the NumPy and the C implementation
+
+    For each function and chunk size, the time needed to process seconds of
+    audio and the maximal difference of the resulting samples is printed.
+    """
+    def render(module, chunk, in_rate, mixingrate):
+        out = array.array("c", "\0"*len(chunk))
+        module.render(out, 0, len(out), chunk, 0, in_rate, 44100, None, 0.5, 0.25, mixingrate)
+        return out
+
+    tests = [("scale", lambda module, chunk: module.scale(array.array("c", chunk), 0.5)),
+             ("mix", lambda module, chunk: module.mix(chunk, chunk[::-1], 0.25, 1e-4)[0]),
+             ("rate_convert", lambda module, chunk: module.rate_convert(chunk, 48000, None, None, 44100, None, None)[0]),
+             ("render", lambda module, chunk: render(module, chunk, 44100, None)),
+             ("render 48kHz", lambda module, chunk: render(module, chunk, 48000, None)),
+             ("render mixing", lambda module, chunk: render(module, chunk, 44100, 1e-4))]
+
+    print "%-14s %6s %12s %12s %8s" % ("function", "chunk", "C [ms/s]", "NumPy [ms/s]", "max diff")
+    for name, test in tests:
+        for chunksize in chunksizes:
+            samples = numpy.arange(chunksize//2) * 7919 % 60000 - 30000
+            chunk = samples.astype(numpy.int16).tostring()
+            repeats = max(seconds*44100*4 // chunksize, 1)
+            times = []
+            results = []
+            for module in pcm, pcmnumpy:
+                if name == "scale":
+                    # scale works in place, so we have to look at the scaled buffer
+                    result = array.array("c", chunk)
+                    module.scale(result, 0.5)
+                else:
+                    result = test(module, chunk)
+                results.append(pcmnumpy._int16(result).astype(numpy.int32))
+                starttime = time.clock()
+                for i in xrange(repeats):
+                    test(module, chunk)
+                times.append(1000*(time.clock() - starttime)/seconds)
+            n = min(len(results[0]), len(results[1]))
+            maxdiff = abs(results[0][:n] - results[1][:n]).max()
+            print "%-14s %6d %12.2f %12.2f %8d" % (name, chunksize, times[0], times[1], maxdiff)
+
+if __name__ == "__main__":
+    benchmarkpcm()
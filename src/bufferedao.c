@@ -22,6 +22,7 @@
 #include <stdlib.h>
 #include <unistd.h>
 #include <pthread.h>
+#include <sys/time.h>
 #include <ao/ao.h>
 #include <errno.h>
 #include <assert.h>
@@ -34,6 +35,23 @@ typedef int Py_ssize_t;
 
 #define NRITEMS() ((self->in >= self->out) ? self->in-self->out : self->in+self->buffersize-self->out)
 
+/* adaptive buffering:
+ *
+ * The writer may only fill depth items of the ring buffer. Every ADAPTINTERVAL seconds of
+ * output, the largest drop of the fill level of the ring buffer below its preceding peak
+ * is compared with depth. If it exceeded half of depth, depth is increased by 50%. If it
+ * stayed below a quarter of depth for SHRINKINTERVALS successive intervals, depth is
+ * decreased by 25%. Every underrun doubles depth. depth always stays between mindepth and
+ * maxdepth. */
+
+#define ADAPTINTERVAL 5
+#define SHRINKINTERVALS 3
+
+/* upper bounds in milliseconds of the bins of the device latency histogram. The last bin
+ * collects all longer writes */
+static double latencybins[] = {1, 2, 5, 10, 20, 50, 100, 200, 500};
+#define NLATENCYBINS (sizeof(latencybins)/sizeof(double) + 1)
+
 /* debug and error log functions */
 PyObject *log_debug; /* currently not used */
 PyObject *log_error;
@@ -70,10 +88,127 @@ typedef struct {
     pthread_mutex_t restartmutex; /* mutex protecting the restart condition variable */
     pthread_cond_t restart;       /* condition variable signalizing that we should restart after being paused */
     pthread_mutex_t devmutex;     /* mutex protecting dev */
+
+    /* adaptive buffering (protected by buffermutex) */
+    int depth;                    /* number of items the writer may currently put in the buffer */
+    int mindepth;                 /* lower and ... */
+    int maxdepth;                 /* ... upper bound for depth */
+    int intervallength;           /* number of items read per adaptation interval */
+    int intervalpos;              /* number of items read in the current adaptation interval */
+    int intervalpeak;             /* highest fill level in the current adaptation interval */
+    int intervaldrop;             /* largest drop of the fill level below intervalpeak */
+    int calmintervals;            /* number of successive intervals with a small drop */
+
+    /* statistics (protected by buffermutex as well) */
+    int streaming;                /* PCM data has been output since the last flush */
+    int starved;                  /* the ring buffer ran empty while streaming */
+    int primed;                   /* the ring buffer has been full since the last flush */
+    long underruns;               /* number of times the ring buffer ran empty while streaming */
+    long writes;                  /* number of calls of ao_play */
+    int lowwatermark;             /* lowest and ... */
+    int highwatermark;            /* ... highest fill level while primed (-1 if not yet primed) */
+    long latencies[NLATENCYBINS]; /* histogram of the durations of the ao_play calls */
+    double maxlatency;            /* longest ao_play call in milliseconds */
+    int flushes;                  /* number of flushes, used to detect a flush during ao_play */
 } bufferedao;
 
 /* helper methods */
 
+/* the following functions for adaptive buffering and statistics have to be called with
+ * buffermutex held */
+
+static void
+setdepth(bufferedao *self, int depth)
+{
+    if ( depth < self->mindepth )
+        depth = self->mindepth;
+    if ( depth > self->maxdepth )
+        depth = self->maxdepth;
+    self->depth = depth;
+    self->calmintervals = 0;
+}
+
+/* start a new adaptation interval with the fill level fill */
+static void
+resetinterval(bufferedao *self, int fill)
+{
+    self->intervalpos = 0;
+    self->intervalpeak = fill;
+    self->intervaldrop = 0;
+}
+
+/* mark the output as interrupted, such that draining the ring buffer is not an underrun */
+static void
+resetstream(bufferedao *self)
+{
+    self->streaming = 0;
+    self->starved = 0;
+    self->primed = 0;
+    resetinterval(self, 0);
+}
+
+/* account for the fill level fill of the ring buffer when the reader takes an item from it */
+static void
+adaptdepth(bufferedao *self, int fill)
+{
+    /* as long as the ring buffer is filled up initially, we learn nothing about the jitter */
+    if ( !self->primed )
+        return;
+
+    if ( self->lowwatermark < 0 || fill < self->lowwatermark )
+        self->lowwatermark = fill;
+    if ( fill > self->highwatermark )
+        self->highwatermark = fill;
+
+    if ( fill > self->intervalpeak )
+        self->intervalpeak = fill;
+    else if ( self->intervalpeak - fill > self->intervaldrop )
+        self->intervaldrop = self->intervalpeak - fill;
+
+    if ( ++self->intervalpos >= self->intervallength ) {
+        if ( 2*self->intervaldrop > self->depth )
+            setdepth(self, self->depth + self->depth/2 + 1);
+        else if ( 4*self->intervaldrop < self->depth ) {
+            if ( ++self->calmintervals >= SHRINKINTERVALS )
+                setdepth(self, self->depth - self->depth/4);
+        }
+        else
+            self->calmintervals = 0;
+        resetinterval(self, fill);
+    }
+}
+
+/* account for an ao_play call of duration latency in milliseconds */
+static void
+addlatency(bufferedao *self, double latency)
+{
+    int i;
+    for (i=0; i<NLATENCYBINS-1; i++)
+        if ( latency <= latencybins[i] )
+            break;
+    self->latencies[i]++;
+    self->writes++;
+    if ( latency > self->maxlatency )
+        self->maxlatency = latency;
+}
+
+/* convert number of items in the ring buffer into seconds */
+static double
+itemstoseconds(bufferedao *self, int items)
+{
+    return 1.0/(self->format.channels * self->format.bits / 8) * self->SIZE / self->format.rate * items;
+}
+
+/* convert fill level of the ring buffer into seconds or None if it is not known */
+static PyObject *
+watermarktopython(bufferedao *self, int watermark)
+{
+    if ( watermark < 0 ) {
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+    return PyFloat_FromDouble(itemstoseconds(self, watermark));
+}
 
 static ao_option *
 py_options_to_ao_options(PyObject *py_options)
@@ -133,12 +268,14 @@ bufferedao_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
 {
     bufferedao *self;
     int bufsize;
+    int minbufsize = -1;
+    int maxbufsize = -1;
     char *driver_name;
     int i;
     PyObject *py_options = NULL;
 
     static char *kwlist[] = {"bufsize", "SIZE", "driver_name", "bits", "rate", "channels", "byte_format",
-                                   "options", NULL};
+                                   "options", "minbufsize", "maxbufsize", NULL};
 
     self = (bufferedao *)type->tp_alloc(type, 0);
     if ( !self )
@@ -151,7 +288,7 @@ bufferedao_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
     self->format.byte_format = 4;    /* platform byte order */
 
     /* parse parameters... */
-    if ( !PyArg_ParseTupleAndKeywords(args, kwds, "iis|iiiiO!", kwlist,
+    if ( !PyArg_ParseTupleAndKeywords(args, kwds, "iis|iiiiO!ii", kwlist,
                                       &bufsize,
                                       &self->SIZE,
                                       &driver_name,
@@ -159,7 +296,9 @@ bufferedao_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
                                       &self->format.rate,
                                       &self->format.channels,
                                       &self->format.byte_format,
-                                      &PyDict_Type, &py_options) ) {
+                                      &PyDict_Type, &py_options,
+                                      &minbufsize,
+                                      &maxbufsize) ) {
         Py_DECREF(self);
         return NULL;
     }
@@ -182,8 +321,45 @@ bufferedao_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
         }
     }
 
-    /* calculate number of items in the ring buffer from bufsize which is in kB and SIZE in bytes */
-    self->buffersize = 1024*bufsize/self->SIZE + 1;
+    /* calculate number of items in the ring buffer from bufsize, minbufsize and maxbufsize
+     * which are in kB and SIZE in bytes. By default, the buffer depth is fixed */
+    if ( minbufsize < 0 || minbufsize > bufsize )
+        minbufsize = bufsize;
+    if ( maxbufsize < bufsize )
+        maxbufsize = bufsize;
+    self->depth = 1024*bufsize/self->SIZE;
+    self->mindepth = 1024*minbufsize/self->SIZE;
+    self->maxdepth = 1024*maxbufsize/self->SIZE;
+    /* the writer has to be able to put at least one item in the buffer */
+    if ( self->mindepth < 1 )
+        self->mindepth = 1;
+    if ( self->depth < self->mindepth )
+        self->depth = self->mindepth;
+    if ( self->maxdepth < self->depth )
+        self->maxdepth = self->depth;
+    self->intervallength = ADAPTINTERVAL * self->format.rate * self->format.channels * self->format.bits / 8 / self->SIZE;
+    if ( self->intervallength < 1 )
+        self->intervallength = 1;
+    self->intervalpos = 0;
+    self->intervalpeak = 0;
+    self->intervaldrop = 0;
+    self->calmintervals = 0;
+
+    self->streaming = 0;
+    self->starved = 0;
+    self->primed = 0;
+    self->underruns = 0;
+    self->writes = 0;
+    self->lowwatermark = -1;
+    self->highwatermark = -1;
+    for (i=0; i<NLATENCYBINS; i++)
+        self->latencies[i] = 0;
+    self->maxlatency = 0;
+    self->flushes = 0;
+
+    /* note that we can store actually only one item less then buffersize, because
+     * otherwise we are not able to detect whether the ring buffer is empty or full */
+    self->buffersize = self->maxdepth + 1;
     if ( !( self->buffer = (bufitem *) malloc(sizeof(bufitem) * self->buffersize) ) ) {
         Py_DECREF(self);
         return NULL;
@@ -223,6 +399,8 @@ bufferedao_start(bufferedao *self)
     char *buff;
     int bytes;
     int errorlogged;
+    int flushes;
+    struct timeval starttime, endtime;
 
     Py_BEGIN_ALLOW_THREADS
     while ( !self->done ) {
@@ -233,8 +411,12 @@ bufferedao_start(bufferedao *self)
 
         /* ring-buffer get code */
         pthread_mutex_lock(&self->buffermutex);
+        if ( self->in == self->out && self->streaming )
+            self->starved = 1;
         while ( self->in == self->out )
            pthread_cond_wait(&self->notempty, &self->buffermutex);
+        adaptdepth(self, NRITEMS());
+        flushes = self->flushes;
         /* we can safely drop the mutex here, assuming that we are the only reader, and thus 
          * the only one modyfing self->in and the corresponding buffer item */
         pthread_mutex_unlock(&self->buffermutex);
@@ -276,13 +458,24 @@ bufferedao_start(bufferedao *self)
                     pthread_mutex_lock(&self->devmutex);
                 }
             }
+            gettimeofday(&starttime, NULL);
             ao_play(self->dev, buff, bytes);
+            gettimeofday(&endtime, NULL);
             pthread_mutex_unlock(&self->devmutex);
         }
 
         /* we have to reacquire the mutex before sending the signal */
         pthread_mutex_lock(&self->buffermutex);
-        self->out = (self->out + 1) % self->buffersize;
+        /* after a flush, the ring buffer has already been emptied */
+        if ( flushes == self->flushes ) {
+            self->out = (self->out + 1) % self->buffersize;
+            if ( bytes ) {
+                addlatency(self, 1e3*(endtime.tv_sec-starttime.tv_sec) + 1e-3*(endtime.tv_usec-starttime.tv_usec));
+                /* the audio device may have been released in the meantime */
+                if ( self->dev )
+                    self->streaming = 1;
+            }
+        }
         pthread_mutex_unlock(&self->buffermutex);
 
         pthread_cond_signal(&self->notfull);
@@ -310,9 +503,7 @@ bufferedao_play(bufferedao *self, PyObject *args)
     Py_BEGIN_ALLOW_THREADS
     /* ring-buffer put code */
     pthread_mutex_lock(&self->buffermutex);
-    /* note that we can store actually only one item less then buffersize, because
-     * otherwise we are not able to detect whether the ring buffer is empty or full */
-    while ( NRITEMS() == self->buffersize-1 )
+    while ( NRITEMS() >= self->depth )
        pthread_cond_wait(&self->notfull, &self->buffermutex);
     /* we can safely drop the mutex here, assuming that we are the only writer, and thus 
      * the only one modyfing self->in and the corresponding buffer item */
@@ -324,6 +515,19 @@ bufferedao_play(bufferedao *self, PyObject *args)
     /* we have to reacquire the mutex before sending the signal */
     pthread_mutex_lock(&self->buffermutex);
     self->in = (self->in + 1) % self->buffersize;
+    if ( self->starved ) {
+        /* the ring buffer ran empty while streaming, so we need more headroom */
+        self->underruns++;
+        self->starved = 0;
+        self->lowwatermark = 0;
+        setdepth(self, 2*self->depth);
+        self->primed = 0;
+        resetinterval(self, 0);
+    }
+    else if ( !self->primed && NRITEMS() >= self->depth ) {
+        self->primed = 1;
+        resetinterval(self, NRITEMS());
+    }
     pthread_mutex_unlock(&self->buffermutex);
 
     pthread_cond_signal(&self->notempty);
@@ -344,6 +548,9 @@ bufferedao_closedevice(bufferedao *self)
         self->dev = NULL;
     }
     pthread_mutex_unlock(&self->devmutex);
+    pthread_mutex_lock(&self->buffermutex);
+    resetstream(self);
+    pthread_mutex_unlock(&self->buffermutex);
     Py_END_ALLOW_THREADS
 
     Py_INCREF(Py_None);
@@ -353,10 +560,57 @@ bufferedao_closedevice(bufferedao *self)
 static PyObject *
 bufferedao_queuelen(bufferedao *self)
 {
-    return PyFloat_FromDouble(1.0/(self->format.channels * self->format.bits / 8)
-                              * self->SIZE / self->format.rate * NRITEMS());
+    return PyFloat_FromDouble(itemstoseconds(self, NRITEMS()));
 }
+static PyObject *
+bufferedao_stats(bufferedao *self)
+{
+    long underruns, writes, latencycounts[NLATENCYBINS];
+    int depth, lowwatermark, highwatermark;
+    double maxlatency;
+    PyObject *latencies;
+    int i;
+
+    /* take a consistent snapshot of the statistics */
+    Py_BEGIN_ALLOW_THREADS
+    pthread_mutex_lock(&self->buffermutex);
+    underruns = self->underruns;
+    writes = self->writes;
+    for (i=0; i<NLATENCYBINS; i++)
+        latencycounts[i] = self->latencies[i];
+    depth = self->depth;
+    lowwatermark = self->lowwatermark;
+    highwatermark = self->highwatermark;
+    maxlatency = self->maxlatency;
+    pthread_mutex_unlock(&self->buffermutex);
+    Py_END_ALLOW_THREADS
+
+    if ( !(latencies = PyList_New(NLATENCYBINS)) )
+        return NULL;
+    for (i=0; i<NLATENCYBINS; i++) {
+        PyObject *bin;
+        if ( i < NLATENCYBINS-1 )
+            bin = Py_BuildValue("(dl)", latencybins[i], latencycounts[i]);
+        else
+            bin = Py_BuildValue("(Ol)", Py_None, latencycounts[i]);
+        if ( !bin ) {
+            Py_DECREF(latencies);
+            return NULL;
+        }
+        PyList_SET_ITEM(latencies, i, bin);
+    }
 
+    return Py_BuildValue("{s:l,s:l,s:d,s:d,s:d,s:N,s:N,s:N,s:d}",
+                         "underruns", underruns,
+                         "writes", writes,
+                         "bufferlength", itemstoseconds(self, depth),
+                         "minbufferlength", itemstoseconds(self, self->mindepth),
+                         "maxbufferlength", itemstoseconds(self, self->maxdepth),
+                         "lowwatermark", watermarktopython(self, lowwatermark),
+                         "highwatermark", watermarktopython(self, highwatermark),
+                         "latencies", latencies,
+                         "maxlatency", maxlatency);
+}
 
 static PyObject *
 bufferedao_flush(bufferedao *self)
@@ -365,6 +619,8 @@ bufferedao_flush(bufferedao *self)
     pthread_mutex_lock(&self->buffermutex);
     self->in = 0;
     self->out = 0;
+    self->flushes++;
+    resetstream(self);
     pthread_cond_signal(&self->notfull);
     pthread_mutex_unlock(&self->buffermutex);
     Py_END_ALLOW_THREADS
@@ -441,6 +697,9 @@ static PyMethodDef bufferedao_methods[] = {
     {"queuelen", (PyCFunction) bufferedao_queuelen, METH_NOARGS,
      "Return approximate length of currently buffered PCM data in seconds"
     },
+    {"stats", (PyCFunction) bufferedao_stats, METH_NOARGS,
+     "Return dictionary with statistics about underruns, buffer fill levels and device latencies"
+    },
     {"flush", (PyCFunction) bufferedao_flush, METH_NOARGS,
      "flush currently buffered PCM data"
     },
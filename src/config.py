@@ -383,18 +383,27 @@ class general(configsection):
     autoplaymode = configalternatives("off", ["off", "repeat", "random"])
     plugins = configlist("")
     playlistdir = configpath("")
+    resamplingquality = configalternatives("medium", ["low", "medium", "high"])
 
 class database(configsection):
     requestcachesize = configint("50000")
+    requestcachememory = configint("65536")
+    queuesize = configint("1000")
     class __template__(configsection):
         type = configalternatives("local", ["local", "remote"])
         dbfile = configpath("~/.pytone/main.db")
         cachesize = configint("1000")
+        mmapsize = configint("65536")
+        synchronous = configalternatives("normal", ["off", "normal", "full"])
+        tempstore = configalternatives("memory", ["default", "file", "memory"])
+        readers = configint("2")
         musicbasedir = configpath("")
         tracknrandtitlere = configre(r"^\[?(\d+)\]? ?[- ] ?(.*)\.(mp3|ogg)$")
         postprocessors = configlist("capitalize strip_leading_article add_decade_tag")
         autoregisterer = configboolean("on")
+        scanthreads = configint("4")
         playingstatslength = configint("100")
+        playstatsretention = configint("365")
         networklocation = confignetworklocation("localhost:1972")
 
 class tag(configsection):
@@ -424,9 +433,12 @@ class player(configsection):
         driver = configalternatives("oss", ["alsa", "alsa09", "alsa05", "arts", "esd", "oss", "sun", "macosx", "macosxau", "pulse"])
         device = configstring("/dev/dsp")
         bufsize = configint(100)
+        minbufsize = configint(50)
+        maxbufsize = configint(400)
         crossfading = configboolean("true")
         crossfadingstart = configfloat(5)
         crossfadingduration = configfloat(6)
+        decodeaheadbufsize = configint(256)
         aooptions = configstring("")
 
         # only for xmms player
@@ -447,9 +459,12 @@ class player(configsection):
         driver = configalternatives("oss", ["alsa", "alsa09", "alsa05", "arts", "esd", "oss", "sun", "macosx", "pulse"])
         device = configstring("/dev/dsp1")
         bufsize = configint(100)
+        minbufsize = configint(50)
+        maxbufsize = configint(400)
         crossfading = configboolean("true")
         crossfadingstart = configfloat(5)
         crossfadingduration = configfloat(6)
+        decodeaheadbufsize = configint(256)
         aooptions = configstring("")
 
         # only for xmms player
@@ -465,6 +480,7 @@ class filelistwindow(configsection):
     scrollmode = configalternatives("page", ["page", "line"])
     virtualdirectoriesattop = configboolean("false")
     skipsinglealbums = configboolean("true")
+    pagesize = configint("500")
 
 
 class playerwindow(configsection):
@@ -19,13 +19,20 @@
 # along with PyTone; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import collections
 import os.path
 
 import hub, requests
 import log
-import pcm
 import encoding
 
+# use the C extension module for the pcm processing if it has been built
+# and fall back to its NumPy implementation otherwise
+try:
+    import pcm
+except ImportError:
+    import pcmnumpy as pcm
+
 #
 # decoder class and simple decoder registry
 #
@@ -215,9 +222,9 @@ class decodedsong:
     """ song decoder and rate converter
 
     This class is for decoding of a song and the conversion of the
-    resulting pcm stream to a defined sample rate. Besides the
-    constructor, there is only one method, namely read, which
-    returns a pcm frame of or less than a given arbitrary size.
+    resulting pcm stream to a defined sample rate. The main method,
+    readinto, writes the converted pcm stream directly into a buffer
+    provided by the caller.
 
     """
 
@@ -255,48 +262,67 @@ class decodedsong:
         else:
             self.samplerate = self.decodedfile.samplerate()
 
-        self.buff = self.last_l = self.last_r = None
-        self.buffpos = 0
+        # frames already read from the decoder but not yet processed (see prefill)
+        self.frames = collections.deque()
+        self.prebufferedbytes = 0
+
+        # frame currently processed, position in it and state of rate conversion
+        self.frame = None
+        self.framepos = 0
+        self.ratestate = None
         self.ptime = 0
 
-    def read(self, size):
-        if self.buff is not None:
-            bytesleft = len(self.buff) - self.buffpos
+    def _nextframe(self):
+        if self.frames:
+            frame = self.frames.popleft()
+            self.prebufferedbytes -= len(frame)
         else:
-            bytesleft = 0
-
-        # fill buffer, if necessary 
-        while bytesleft < size:
-            newbuff = self.decodedfile.read()
-            if newbuff:
-                self.buff, self.last_l, self.last_r = \
-                           pcm.rate_convert(newbuff,
-                                            self.samplerate,
-                                            self.buff,
-                                            self.buffpos,
-                                            self.outrate,
-                                            self.last_l,
-                                            self.last_r)
-
-                # the new self.buff contains only new data
-                self.buffpos = 0
-                bytesleft = len(self.buff)
-            else:
-                size = bytesleft
+            frame = self.decodedfile.read()
+        self.frame = frame or None
+        self.framepos = 0
+        return self.frame
+
+    def readinto(self, buff, start, end, factor=1, mixingratio=1, mixingrate=None):
+        """ write pcm stream into buff[start:end] and return (position, mixingratio)
+
+        The pcm stream is scaled by factor. If mixingrate is not None, it is
+        mixed into the data already present in buff, see pcm.render. A returned
+        position smaller than end signals the end of the song.
+        """
+        while start < end:
+            if self.frame is None and not self._nextframe():
                 break
-
-        oldpos = self.buffpos
-        self.buffpos += size
-        self.ptime = self.decodedfile.ptime()
-        if self.buff:
-            return self.buff[oldpos:self.buffpos]
-        else:
-            return []
+            self.framepos, start, self.ratestate, mixingratio = \
+                           pcm.render(buff, start, end,
+                                      self.frame, self.framepos,
+                                      self.samplerate, self.outrate,
+                                      self.ratestate,
+                                      factor, mixingratio, mixingrate)
+            if self.framepos >= len(self.frame):
+                self.frame = None
+        self._updateptime()
+        return start, mixingratio
+
+    def prefill(self):
+        """ read next frame from decoder ahead of time and return whether the song has not yet ended """
+        frame = self.decodedfile.read()
+        if not frame:
+            return False
+        self.frames.append(frame)
+        self.prebufferedbytes += len(frame)
+        self._updateptime()
+        return True
+
+    def _updateptime(self):
+        # the prebuffered frames have not been played yet
+        self.ptime = max(self.decodedfile.ptime() - 0.25*self.prebufferedbytes/self.samplerate, 0)
 
     def seekrelative(self, seconds):
+        self.frames.clear()
+        self.prebufferedbytes = 0
         self.decodedfile.seekrelative(seconds)
-        self.buff = self.last_l = self.last_r = None
-        self.buffpos = 0
+        self.frame = self.ratestate = None
+        self.framepos = 0
         self.ptime = self.decodedfile.ptime()
 
     def playslower(self, speed_adj = 441):
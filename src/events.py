@@ -154,6 +154,28 @@ class song_skipped(dbevent):
         return "%r(%r)->%r" % (self.__class__.__name__, self.song, self.songdbid)
 
 
+class add_songs(dbevent):
+    """ add list of song metadata to database in one go """
+
+    def __init__(self, songdbid, songs):
+        self.songdbid = songdbid
+        self.songs = songs
+
+    def __repr__(self):
+        return "%r(%d songs)->%r" % (self.__class__.__name__, len(self.songs), self.songdbid)
+
+
+class update_songs(dbevent):
+    """ update list of songs in database in one go """
+
+    def __init__(self, songdbid, songs):
+        self.songdbid = songdbid
+        self.songs = songs
+
+    def __repr__(self):
+        return "%r(%d songs)->%r" % (self.__class__.__name__, len(self.songs), self.songdbid)
+
+
 class delete_song(dbevent):
     """ delete song from database """
     def __init__(self, songdbid, song):
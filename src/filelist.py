@@ -23,6 +23,9 @@ import item
 import slist
 import log
 
+# time in seconds we wait for the contents of a directory before showing a placeholder
+_loadwait = 0.1
+
 class filelist(slist.slist):
 
     def __init__(self, win, songdbids):
@@ -32,6 +35,10 @@ class filelist(slist.slist):
         # self.basedir = item.basedir(songdbids)
         self.dir = [self.basedir]
         self.shistory = []
+        # future for the contents of the current directory, if they are still being read,
+        # together with the arguments of the corresponding readdir call
+        self.pending = None
+        self.pendingargs = None
         self.readdir()
 
         self.win.channel.subscribe(events.songschanged, self.songschanged)
@@ -51,34 +58,125 @@ class filelist(slist.slist):
     def getselectedsubdir(self):
         return self.dir + [self.getselected()]
 
-    def readdir(self):
-        self.set(self.dir[-1].getcontents())
+    def readdir(self, keepselection=False, onready=None):
+        """ read contents of current directory
+
+        The contents are read in a separate thread such that the user interface does
+        not stall on a busy database. If they are not available after a short time,
+        a placeholder is shown (unless keepselection is set, in which case the old
+        contents are kept) and the contents are filled in when they arrive. Then,
+        onready is called if given.
+
+        Large directories are read page-wise on demand, see _readcontents.
+        """
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
+        dir = self.dir[-1]
+        if isinstance(dir, item.songs) and dir.songdbid is None:
+            # show the songs of the faster databases while the slower ones are still busy
+            def onpartialcontents(songs):
+                partial = hub.future()
+                partial.addcallback(lambda partial: self._partialcontentsread(pending, partial.result),
+                                    self.win.channel)
+                partial.setresult(songs)
+            pending = hub.callnoblocking(self._readcontents, (dir, onpartialcontents))
+        else:
+            pending = hub.callnoblocking(self._readcontents, (dir,))
+        if pending.wait(_loadwait):
+            self._setcontents(pending.result, keepselection, onready)
+        else:
+            self.pending = pending
+            self.pendingargs = keepselection, onready
+            if not keepselection:
+                self.set([item.placeholder(self.dir[-1].songdbid)])
+            pending.addcallback(self._contentsread, self.win.channel)
+
+    def _readcontents(self, dir, *args):
+        """ return contents of dir
+
+        If the directory contains more than a few pages of items, a pagedlist
+        is returned, which only reads the pages of items actually shown.
+        """
+        pagesize = config.filelistwindow.pagesize
+        if pagesize:
+            pagedcontents = dir.getpagedcontents()
+            if pagedcontents is not None and pagedcontents[1] > 2*pagesize:
+                head, length, tail = pagedcontents
+                contents = slist.pagedlist(head, length, tail, dir.getcontentspage, dir.getcontentskey,
+                                           item.placeholder(dir.songdbid), self._pageread, self.win.channel,
+                                           pagesize)
+                # read the first page right away
+                contents.readpage(len(head))
+                return contents
+        return dir.getcontents(*args)
+
+    def _setcontents(self, contents, keepselection, onready):
+        if isinstance(contents, slist.pagedlist):
+            # the number of items has been determined by _readcontents in a separate thread
+            self.dir[-1].setcontentslength(contents.length)
+        self.set(contents or [], keepselection=keepselection)
+        if onready is not None:
+            onready()
+
+    def _pageread(self, contents):
+        # replace the placeholders shown for the items of the page
+        if contents is self.items:
+            self._notifyselectionchanged()
+            self.win.update()
+
+    def _partialcontentsread(self, pending, contents):
+        if pending is self.pending and not pending.hascompleted():
+            self.set(contents, keepselection=True)
+            # the complete contents should not reset the selection
+            self.pendingargs = True, self.pendingargs[1]
+            self.win.update()
+
+    def _contentsread(self, pending):
+        # ignore results of directories which have been left in the meantime
+        if pending is self.pending:
+            self.pending = None
+            keepselection, onready = self.pendingargs
+            self._setcontents(pending.result, keepselection, onready)
+            self.win.update()
 
     def updatedir(self):
         """ reread directory trying to keep the current selection """
-        self.set(self.dir[-1].getcontents(), keepselection=True)
+        if self.pending is not None:
+            # the contents are still being read, so we simply start over
+            keepselection, onready = self.pendingargs
+            self.readdir(keepselection, onready)
+        else:
+            self.readdir(keepselection=True)
 
-    def dirdown(self):
+    def dirdown(self, onready=None):
+        """ enter the selected directory and call onready, if given, once its contents have been read """
         self.shistory.append((self.dir, self.selected, self.top))
         self.dir = self.getselectedsubdir()
-        self.readdir()
+        self.readdir(onready=lambda: self._skipsinglealbum(onready))
+
+    def _skipsinglealbum(self, onready):
         # In the case of the selected item having been an artist check
         # whether only one album is present. If yes directly jump to
         # this album.
         if config.filelistwindow.skipsinglealbums and isinstance(self.dir[-1], item.artist) and len(self) <= 2:
             self.dir = self.getselectedsubdir()
-            self.readdir()
+            self.readdir(onready=onready)
+        elif onready is not None:
+            onready()
 
     def dirup(self):
         if len(self.shistory)>0:
             dir, selected, top = self.shistory.pop()
             self.dir = dir
-            self.readdir()
-            self.selected = selected
-            self.top = top
-            # the window size could have changed in the meantime, so we have to update top
-            self._updatetop()
-            self._notifyselectionchanged()
+            def restoreselection():
+                if selected is not None and selected < len(self):
+                    self.selected = selected
+                    self.top = top
+                    # the window size could have changed in the meantime, so we have to update top
+                    self._updatetop()
+                    self._notifyselectionchanged()
+            self.readdir(onready=restoreselection)
 
     def focus_on(self, searchstring):
         # remove any previous focus
@@ -95,6 +193,9 @@ class filelist(slist.slist):
         self.readdir()
 
     def selectionpath(self):
+        if self.pending is not None:
+            # the header of some directories depends on their contents
+            return _("Loading...")
         return self.dir[-1].getheader(self.getselected())
 
     def insertrecursiveselection(self):
@@ -172,6 +273,8 @@ class filelist(slist.slist):
         return True
 
     def rescanselection(self, force):
+        if self.pending is not None:
+            return
         if ( isinstance(self.getselected(), item.basedir) or
              ( isinstance(self.getselected(), item.filesystemdir) and self.getselected().isbasedir()) ):
             # instead of rescanning of a whole filesystem we start the autoregisterer
@@ -234,16 +337,55 @@ class filelist(slist.slist):
         """ directly jump to given song """
         # In order to get the correct shistory, we more or less simulate
         # a walk through the directory hierarchy, starting from the basedir.
+        # Since each step depends on the previous one, we continue with the
+        # next step once the contents of a directory have been read or, for
+        # directories read page-wise, once they have been searched. The user
+        # interface is not blocked in the meantime, and leaving the directory
+        # being read abandons the walk.
+        song = event.song
         self.shistory = []
         self.dir = [self.basedir]
-        self.readdir()
-        # either we are able to locate the artist or we should look under compilations
-        if ( (event.song.artist_id and (self.selectbyid(event.song.artist_id) or self.selectbyid("compilations"))) or
-             self.selectbyid("noartist") ):
-            self.dirdown()
+
+        def songselected(found):
+            self.win.update()
+
+        def albumread():
+            self.selectbyid(song.id, onselected=songselected)
+
+        def albumselected(found):
+            if found:
+                self.dirdown(onready=albumread)
+            else:
+                albumread()
+
+        def artistread():
             # We might have skipped the album when there is only a single one of
             # the given artist.
-            if not isinstance(self.dir[-1], item.album) and self.selectbyid(event.song.album_id):
-                self.dirdown()
-            self.selectbyid(event.song.id)
-        self.win.update()
+            if isinstance(self.dir[-1], item.album):
+                albumread()
+            else:
+                self.selectbyid(song.album_id, onselected=albumselected)
+
+        def artistselected(found):
+            if not found:
+                self.win.update()
+                return
+            self.dirdown(onready=artistread)
+
+        def basedirread():
+            # either we are able to locate the artist or we should look under compilations
+            ids = ["noartist"]
+            if song.artist_id:
+                ids = [song.artist_id, "compilations"] + ids
+            self._selectbyids(ids, artistselected)
+
+        self.readdir(onready=basedirread)
+
+    def _selectbyids(self, ids, onselected):
+        """ select item with the first of ids present and call onselected with whether there is one """
+        def selected(found):
+            if found or len(ids) == 1:
+                onselected(found)
+            else:
+                self._selectbyids(ids[1:], onselected)
+        self.selectbyid(ids[0], onselected=selected)
@@ -17,8 +17,11 @@
 # along with PyTone; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import collections
 import exceptions
+import heapq
 import threading
+import time
 import Queue
 
 import events, log
@@ -30,127 +33,531 @@ class DenyRequest(exceptions.Exception):
     """ deny processing of a request """
     pass
 
-# from http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/87369
+class RequestTimeout(exceptions.Exception):
+    """ a request has not been processed in the given time """
+    pass
 
 class PriorityQueue(Queue.Queue):
 
+    """ queue of (item, priority) tuples returning the items with the lowest priority first
+
+    Items of equal priority are returned in the order in which they have been
+    put into the queue. The items of each priority are stored in a deque of
+    their own, while the priorities currently present in the queue are kept
+    in a heap. Thus putting and getting an item only takes logarithmic time
+    in the number of distinct priorities in the queue.
+
+    If maxsize is positive, at most maxsize background items, i.e., items
+    with a positive priority value, are queued. Putting further background
+    items blocks until some of them have been processed, whereas other
+    items are always accepted. In addition, the queue keeps track of its
+    length and of the time items have to wait in it.
+    """
+
     def _init(self, maxsize):
-        # we need to be sure to have a list as underlying queue
         self.maxsize = maxsize
-        self.queue = []
-        
+        # mapping priority -> deque of (time of put, item)
+        self.queues = {}
+        # heap of the priorities present in self.queues
+        self.priorities = []
+        self.length = 0
+        self.backgroundlength = 0
+        # statistics
+        self.maxlength = 0
+        self.ngets = 0
+        self.nblockedputs = 0
+        self.totalwaittime = 0.0
+        self.maxwaittime = 0.0
+
+    def _qsize(self):
+        return self.length
+
     def _put(self, item):
-	data, priority = item
-	self._insort_right((priority, data))
+        data, priority = item
+        try:
+            self.queues[priority].append((time.time(), data))
+        except KeyError:
+            self.queues[priority] = collections.deque([(time.time(), data)])
+            heapq.heappush(self.priorities, priority)
+        self.length += 1
+        if priority > 0:
+            self.backgroundlength += 1
+        if self.length > self.maxlength:
+            self.maxlength = self.length
 
     def _get(self):
-	return self.queue.pop(0)[1]
-
-    def _insort_right(self, x):
-	"""Insert item x in list, and keep it sorted assuming a is sorted.
-
-	If x is already in list, insert it to the right of the rightmost x.
-	"""
-	a = self.queue
-	lo = 0
-	hi = len(a)
+        priority = self.priorities[0]
+        queue = self.queues[priority]
+        puttime, data = queue.popleft()
+        if not queue:
+            del self.queues[priority]
+            heapq.heappop(self.priorities)
+        self.length -= 1
+        if priority > 0:
+            self.backgroundlength -= 1
+        waittime = time.time() - puttime
+        self.ngets += 1
+        self.totalwaittime += waittime
+        if waittime > self.maxwaittime:
+            self.maxwaittime = waittime
+        return data
+
+    def _isfull(self, priority):
+        return self.maxsize > 0 and priority > 0 and self.backgroundlength >= self.maxsize
+
+    def full(self):
+        """ return True if no further background items can be put into the queue """
+        self.mutex.acquire()
+        try:
+            return self._isfull(1)
+        finally:
+            self.mutex.release()
+
+    def put(self, item, block=True, timeout=None):
+        """ put (item, priority) tuple into the queue
+
+        If the queue is full and item is a background item, block until a
+        free slot is available or, if timeout is not None, at most timeout
+        seconds. If block is not set or the timeout expires, Queue.Full is
+        raised.
+        """
+        priority = item[1]
+        self.not_full.acquire()
+        try:
+            if self._isfull(priority):
+                self.nblockedputs += 1
+                if not block:
+                    raise Queue.Full
+                elif timeout is None:
+                    while self._isfull(priority):
+                        self.not_full.wait()
+                else:
+                    endtime = time.time() + timeout
+                    while self._isfull(priority):
+                        remaining = endtime - time.time()
+                        if remaining <= 0.0:
+                            raise Queue.Full
+                        self.not_full.wait(remaining)
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+        finally:
+            self.not_full.release()
+
+    def getstats(self, name):
+        """ return queuestats instance for the queue named name """
+        self.mutex.acquire()
+        try:
+            if self.ngets:
+                meanwaittime = self.totalwaittime/self.ngets
+            else:
+                meanwaittime = 0.0
+            return queuestats(name, self.length, self.maxlength, self.maxsize, self.ngets,
+                              meanwaittime, self.maxwaittime, self.nblockedputs)
+        finally:
+            self.mutex.release()
+
+
+class queuestats:
+
+    """ statistics of the queue of a channel """
+
+    def __init__(self, name, length, maxlength, maxsize, ngets,
+                 meanwaittime, maxwaittime, nblockedputs):
+        self.name = name
+        self.length = length
+        self.maxlength = maxlength
+        self.maxsize = maxsize
+        self.ngets = ngets
+        self.meanwaittime = meanwaittime
+        self.maxwaittime = maxwaittime
+        self.nblockedputs = nblockedputs
 
-	while lo < hi:
-	    mid = (lo+hi)/2
-	    if x[0] < a[mid][0]: hi = mid
-	    else: lo = mid+1
-	a.insert(lo, x)
+    def __repr__(self):
+        return ("queuestats(%r: length=%d, maxlength=%d, maxsize=%d, gets=%d, "
+                "meanwaittime=%.3fs, maxwaittime=%.3fs, blockedputs=%d)" %
+                (self.name, self.length, self.maxlength, self.maxsize, self.ngets,
+                 self.meanwaittime, self.maxwaittime, self.nblockedputs))
 
 #
-# request response class
+# futures and request response class
 #
 
-class requestresponse:
+class future:
+
+    """ result of a computation which may not have completed yet
+
+    Callbacks registered via addcallback are called with the future as
+    only argument once the result is available. They are not called by
+    the thread completing the future, but they are queued in the given
+    channel and thus executed by the thread processing this channel.
+    """
+
+    def __init__(self):
+        self.result = None
+        self.ready = threading.Event()
+        self.cancelled = False
+        # list of (callback, channel) tuples
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def setresult(self, result):
+        """ set result and deliver the callbacks """
+        self.lock.acquire()
+        try:
+            self.result = result
+            self.ready.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        finally:
+            self.lock.release()
+        for callback, channel in callbacks:
+            channel._notify(_completion(self, callback))
+
+    def addcallback(self, callback, channel):
+        """ call callback(self) in the thread processing channel once the result is available """
+        self.lock.acquire()
+        try:
+            if self.cancelled:
+                return
+            if not self.ready.isSet():
+                self.callbacks.append((callback, channel))
+                return
+        finally:
+            self.lock.release()
+        channel._notify(_completion(self, callback))
+
+    def cancel(self):
+        """ cancel computation and discard callbacks not yet called
+
+        Returns True if the computation has not completed yet. Note that
+        a computation which has already been started will still run to
+        completion, but its result is discarded.
+        """
+        self.lock.acquire()
+        try:
+            self.cancelled = True
+            self.callbacks = []
+            return not self.ready.isSet()
+        finally:
+            self.lock.release()
+
+    def wait(self, timeout=None):
+        """ wait for completion at most timeout seconds (or indefinitely if None)
+
+        Returns True if the result is available.
+        """
+        self.ready.wait(timeout)
+        return self.ready.isSet()
+
+    def waitforcompletion(self):
+        self.ready.wait()
+
+    def hascompleted(self):
+        return self.ready.isSet()
+
+    def getresult(self, timeout=None):
+        """ return result, raising RequestTimeout if it is not available after timeout seconds """
+        if not self.wait(timeout):
+            raise RequestTimeout("no result after %.1f seconds" % timeout)
+        return self.result
+
+
+class requestresponse(future):
+
     """ structure containing request + response upon request """
+
     def __init__(self, request):
-	self.request = request
-	self.result = None
-	self.ready = threading.Event()
+        future.__init__(self)
+        self.request = request
 
     def __repr__(self):
-	return "requestresponse(%r -> %r)" % (self.request, self.result)
+        return "requestresponse(%r -> %r)" % (self.request, self.result)
 
-    def waitforcompletion(self):
-	self.ready.wait()
 
-    def hascompleted(self):
-	return self.ready.isSet()
+class _completion:
+
+    """ item queued in a channel in order to call callback of a completed future """
+
+    def __init__(self, future, callback):
+        self.future = future
+        self.callback = callback
+
+    def __repr__(self):
+        return "_completion(%r)" % self.future
+
+
+class _call(future):
+
+    """ function call executed by one of the worker threads """
+
+    def __init__(self, function, args):
+        future.__init__(self)
+        self.function = function
+        self.args = args
+        # worker thread which has taken the call
+        self.worker = None
+
+    def __repr__(self):
+        return "_call(%r%r -> %r)" % (self.function, self.args, self.result)
+
+    def cancel(self):
+        running = future.cancel(self)
+        _workerslock.acquire()
+        try:
+            # A worker busy with the call cannot be interrupted. In order not to hold
+            # up the other calls, e.g., by a stalled database request, it is replaced
+            # right away and leaves once it is done.
+            if running and self.worker in _workers and len(_abandonedworkers) < _maxabandonedworkers:
+                _workers.remove(self.worker)
+                _abandonedworkers.append(self.worker)
+                _startworkers()
+        finally:
+            _workerslock.release()
+        return running
+
+
+# number of threads executing function calls submitted via callnoblocking
+_nworkers = 2
+# maximal number of additional threads still busy with cancelled calls
+_maxabandonedworkers = 8
+_calls = Queue.Queue()
+_workers = []
+_abandonedworkers = []
+_workerslock = threading.Lock()
+
+def _startworkers():
+    """ start worker threads until there are _nworkers of them (with _workerslock held) """
+    while len(_workers) < _nworkers:
+        worker = threading.Thread(target=_worker, name="hub worker")
+        worker.setDaemon(True)
+        worker.start()
+        _workers.append(worker)
+
+def _worker():
+    worker = threading.currentThread()
+    while True:
+        call = _calls.get()
+        _workerslock.acquire()
+        call.worker = worker
+        _workerslock.release()
+        if not call.cancelled:
+            try:
+                result = call.function(*call.args)
+            except:
+                log.debug_traceback()
+                result = None
+            call.setresult(result)
+        _workerslock.acquire()
+        try:
+            if worker in _abandonedworkers:
+                # we have been replaced while busy with a cancelled call
+                _abandonedworkers.remove(worker)
+                return
+        finally:
+            _workerslock.release()
+
+
+def callnoblocking(function, args=(), callback=None, channel=None):
+    """ call function(*args) in a separate worker thread and return a future for its result
+
+    This can be used to perform a sequence of blocking requests without
+    stalling the calling thread. If callback is set, it will be called
+    with the future as argument in the thread processing channel.
+    Exceptions raised by function are logged and result in None. A
+    cancelled call, which is already running, is not interrupted, but
+    its worker thread is replaced to keep other calls going.
+    """
+    _workerslock.acquire()
+    try:
+        _startworkers()
+    finally:
+        _workerslock.release()
+    call = _call(function, args)
+    if callback is not None:
+        call.addcallback(callback, channel)
+    _calls.put(call)
+    return call
 
 #
 # event and request dispatcher classes
 #
 
+def _issubclass(cls, types):
+    for type in types:
+        if issubclass(cls, type):
+            return True
+    return False
+
+
 class hub:
 
-    """ collects event channels from different threads """
+    """ collects event channels from different threads
+
+    Events and requests are only passed to the channels which subscribe to
+    the event or supply the request, respectively. The channels interested in
+    a given class of events or requests are determined once and then cached
+    until a channel changes its subscriptions or suppliers.
+    """
 
     def __init__(self):
-	self.channels = []
+        self.channels = []
+        # mapping class of event or request -> list of interested channels
+        self.routes = {}
 
     def connect(self, channel):
-	self.channels.append(channel)
+        self.channels.append(channel)
+        self.invalidateroutes()
 
     def disconnect(self, channel):
-	self.channels.remove(channel)
-
-    def newchannel(self):
-	achannel = channel(self)
-	self.connect(achannel)
-	return achannel
+        self.channels.remove(channel)
+        self.invalidateroutes()
+
+    def newchannel(self, name=None, maxsize=0):
+        """ create and connect a new channel
+
+        If maxsize is positive, the number of queued background events and
+        requests of the channel is limited to maxsize, cf. PriorityQueue.
+        """
+        achannel = channel(self, name, maxsize)
+        self.connect(achannel)
+        return achannel
+
+    def getqueuestats(self):
+        """ return list of queuestats instances for all channels """
+        return [channel.getqueuestats() for channel in self.channels[:]]
+
+    def invalidateroutes(self):
+        """ forget cached routes, has to be called when a channel changes its subscriptions """
+        self.routes = {}
+
+    def _route(self, item):
+        """ return list of channels interested in item (event or request response) """
+        if isinstance(item, events.event):
+            itemclass = item.__class__
+        else:
+            itemclass = item.request.__class__
+        # Note that we must not use self.routes after having computed the
+        # result, since the routes may have been invalidated in the meantime
+        routes = self.routes
+        try:
+            return routes[itemclass]
+        except KeyError:
+            if isinstance(item, events.event):
+                result = [channel for channel in self.channels[:]
+                          if _issubclass(itemclass, channel.subscribedtypes())]
+            else:
+                result = [channel for channel in self.channels[:]
+                          if _issubclass(itemclass, channel.suppliedtypes())]
+            routes[itemclass] = result
+            return result
 
     def notify(self, item, priority=0):
-	""" notify all channels belonging to hub of item (event or request) """
-	log.debug("event: %s (priority %d)" % (repr(item), priority))
-	for channel in self.channels:
-	    channel._notify(item, priority)
-
-    def request(self, request, priority=0):
-	""" submit a request (blocking)
-
-	this method submits a request, waits for the result and
-	returns it.  Requests with a high priority are treated first.
-	"""
-	# generate a request response object for the request,
-	# send it to hub and wait for result
-	log.debug("request: %s (priority %d)" % (repr(request), priority))
-	rr = requestresponse(request)
-	self.notify(rr, priority)
-	rr.waitforcompletion()
-	return rr.result
-
-#    def requestnoblocking(self, request, priority=0):
-#        """ submit a request (nonblocking)
-#
-#        this method submits a request and returns a requestresponse
-#        structure.  Requests with a high priority are treated first.
-#        """
-#        rr = requestresponse(request)
-#        self.notify(rr, priority)
-#        return rr
+        """ notify all channels interested in item (event or request) """
+        log.debug("event: %s (priority %d)" % (repr(item), priority))
+        for channel in self._route(item):
+            channel._notify(item, priority)
+
+    def request(self, request, priority=0, timeout=None):
+        """ submit a request (blocking)
+
+        this method submits a request, waits for the result and
+        returns it.  Requests with a high priority are treated first.
+        If the result is not available after timeout seconds, the request
+        is cancelled and RequestTimeout is raised.
+        """
+        # generate a request response object for the request,
+        # send it to hub and wait for result
+        log.debug("request: %s (priority %d)" % (repr(request), priority))
+        rr = requestresponse(request)
+        self.notify(rr, priority)
+        if not rr.wait(timeout):
+            rr.cancel()
+            raise RequestTimeout("%r not processed after %.1f seconds" % (request, timeout))
+        return rr.result
+
+    def requestnoblocking(self, request, priority=0, callback=None, channel=None):
+        """ submit a request (nonblocking)
+
+        this method submits a request and returns a requestresponse
+        structure, which is a future for the result.  Requests with a
+        high priority are treated first. If callback is set, it is
+        called with the requestresponse as argument in the thread
+        processing channel, once the request has been processed.
+        """
+        log.debug("request (nonblocking): %s (priority %d)" % (repr(request), priority))
+        rr = requestresponse(request)
+        if callback is not None:
+            rr.addcallback(callback, channel)
+        self.notify(rr, priority)
+        return rr
 
 
 class channel:
 
     """ collects event handlers for one thread """
 
-    def __init__(self, hub):
-	self.hub = hub
-	self.subscriptions = []
-	self.suppliers = []
-	self.queue = PriorityQueue(-1)
-	# self.queue = Queue.Queue(-1)
+    def __init__(self, hub, name=None, maxsize=0):
+        self.hub = hub
+        self.name = name
+        self.subscriptions = []
+        self.suppliers = []
+        # mapping class of event or request -> list of handlers
+        self.handlers = {}
+        self.queue = PriorityQueue(maxsize)
+
+    def getqueuestats(self):
+        return self.queue.getstats(self.name)
+
+    def subscribedtypes(self):
+        return [eventtype for eventtype, handler in self.subscriptions]
+
+    def suppliedtypes(self):
+        return [requesttype for requesttype, handler in self.suppliers]
+
+    def _gethandlers(self, itemclass, registrations):
+        handlers = self.handlers
+        try:
+            return handlers[itemclass]
+        except KeyError:
+            result = [handler for registeredclass, handler in registrations
+                      if issubclass(itemclass, registeredclass)]
+            handlers[itemclass] = result
+            return result
+
+    def _changed(self):
+        self.handlers = {}
+        self.hub.invalidateroutes()
+
+    def processitem(self, item):
+        """ process a single event or request """
+        if isinstance(item, events.event):
+            try:
+                for handler in self._gethandlers(item.__class__, self.subscriptions):
+                    handler(item)
+            except TerminateEventProcessing:
+                pass
+        elif isinstance(item, _completion):
+            if not item.future.cancelled:
+                item.callback(item.future)
+        elif not item.cancelled:
+            for handler in self._gethandlers(item.request.__class__, self.suppliers):
+                # compute result and signalise that
+                # request has been processed
+                try:
+                    result = handler(item.request)
+                    log.debug(u"got result %r for %r" % (result, item.request))
+                    item.setresult(result)
+                    break
+                except DenyRequest:
+                    pass
 
     def process(self, block=False, timeout=None):
-	""" process queued events and request
+        """ process queued events and request
 
-	If block is set, we wait for incoming events and requests.  In
+        If block is set, we wait for incoming events and requests.  In
         this case, a timeout in seconds can be specified, as well.
-	"""
+        """
 
         while True:
             try:
@@ -160,41 +567,27 @@ class channel:
             # after having get the first event, we do no longer block
             block = False
             timeout = None
-	    if isinstance(item, events.event):
-		try:
-		    for subscribedevent, handler in self.subscriptions:
-			if isinstance(item, subscribedevent):
-			    handler(item)
-		except TerminateEventProcessing:
-		    pass
-	    else:
-		for suppliedrequest, handler in self.suppliers:
-		    if isinstance(item.request, suppliedrequest):
-			# compute result and signalise that
-			# request has been processed
-			try:
-			    item.result = handler(item.request)
-			    log.debug(u"got result %r for %r" % (item.result, item.request))
-			    item.ready.set()
-			    break
-			except DenyRequest:
-			    pass
+            self.processitem(item)
 
     def subscribe(self, eventtype, handler):
-	self.subscriptions.append((eventtype, handler))
+        self.subscriptions.append((eventtype, handler))
+        self._changed()
 
     def unsubscribe(self, eventtype, handler):
-	self.subscriptions.remove((eventtype, handler))
+        self.subscriptions.remove((eventtype, handler))
+        self._changed()
 
     def supply(self, requesttype, handler):
-	self.suppliers.append((requesttype, handler))
+        self.suppliers.append((requesttype, handler))
+        self._changed()
 
     def unsupply(self, requesttype, handler):
-	self.suppliers.remove((requesttype, handler))
+        self.suppliers.remove((requesttype, handler))
+        self._changed()
 
     def _notify(self, item, priority=0):
-	""" notify channel of item (event or request) """
-	self.queue.put((item, -priority))
+        """ notify channel of item (event or request) """
+        self.queue.put((item, -priority))
 
 # set up default hub and provide easy access to its externally used methods
 _defaulthub = hub()
@@ -202,3 +595,5 @@ _defaulthub = hub()
 newchannel = _defaulthub.newchannel
 notify = _defaulthub.notify
 request = _defaulthub.request
+requestnoblocking = _defaulthub.requestnoblocking
+getqueuestats = _defaulthub.getqueuestats
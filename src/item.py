@@ -18,7 +18,7 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 
-import os.path, string, time
+import os.path, re, string, time
 import config, metadata
 import events, hub, requests
 import encoding
@@ -47,6 +47,15 @@ class filter:
     def SQL_args(self):
         return []
 
+    def maymatch(self, song):
+        """ return whether song (with metadata attached) could pass the filter
+
+        This is used for the invalidation of cached results and has to be
+        conservative, i.e., if in doubt, True has to be returned. Note
+        that the ids of the song may be None if they are not known.
+        """
+        return True
+
 
 class hiddenfilter(filter):
     " a filter which does not show up in the UI "
@@ -65,6 +74,9 @@ class urlfilter(hiddenfilter):
     def SQL_args(self):
         return [self.url]
 
+    def maymatch(self, song):
+        return song.url == self.url
+
 
 class compilationfilter(hiddenfilter):
     def __init__(self, iscompilation):
@@ -75,6 +87,9 @@ class compilationfilter(hiddenfilter):
         return "%s songs.compilation" % (not self.iscompilation and "NOT" or "")
         # return "(songs.compilation = %s)" % (self.iscompilation and "1" or "0")
 
+    def maymatch(self, song):
+        return bool(song.compilation) == bool(self.iscompilation)
+
 
 class artistfilter(hiddenfilter):
     def __init__(self, artist_id):
@@ -82,11 +97,16 @@ class artistfilter(hiddenfilter):
         hiddenfilter.__init__(self, "artist_id", artist_id)
 
     def SQL_WHERE_string(self):
-        return "artists.id = ? OR songs.album_artist_id = ?"
+        return "songs.artist_id = ? OR songs.album_artist_id = ?"
 
     def SQL_args(self):
         return [self.artist_id, self.artist_id]
 
+    def maymatch(self, song):
+        if song.artist_id is None and song.album_artist_id is None:
+            return True
+        return self.artist_id in (song.artist_id, song.album_artist_id)
+
 
 class noartistfilter(hiddenfilter):
     def __init__(self):
@@ -95,6 +115,9 @@ class noartistfilter(hiddenfilter):
     def SQL_WHERE_string(self):
         return "songs.artist_id IS NULL"
 
+    def maymatch(self, song):
+        return not song.artist
+
 
 class albumfilter(hiddenfilter):
     def __init__(self, album_id):
@@ -102,11 +125,14 @@ class albumfilter(hiddenfilter):
         hiddenfilter.__init__(self, "album_id", album_id)
 
     def SQL_WHERE_string(self):
-        return "albums.id = ?"
+        return "songs.album_id = ?"
 
     def SQL_args(self):
         return [self.album_id]
 
+    def maymatch(self, song):
+        return song.album_id is None or song.album_id == self.album_id
+
 
 class playlistfilter(hiddenfilter):
     def __init__(self, playlist_id):
@@ -130,18 +156,77 @@ class playedsongsfilter(filter):
     def SQL_WHERE_string(self):
         return "songs.playcount > 0"
 
+    def maymatch(self, song):
+        return song.playcount > 0
+
+
+_wordre = re.compile(r"\w+", re.UNICODE)
 
 class searchfilter(filter):
+
+    """ filters songs, for which every word of the search string is the prefix of a word
+    in the title, album, artist, album artist or tags
+
+    The full text search index of the database is used unless fulltextsearch is
+    turned off, in which case songs containing the search string in their title,
+    album or artist are found.
+    """
+
+    # set to False by the database if no full text search index is available
+    fulltextsearch = True
+
     def __init__(self, searchstring):
         self.searchstring = searchstring
+        # query for the full text search index matching all words as prefixes
+        self.ftsquery = " ".join(['"%s"*' % word.replace('"', '""') for word in searchstring.split()])
         filter.__init__(self, "Search: %s" % searchstring, None, searchstring)
 
     def SQL_WHERE_string(self):
-        #return "(songs.title LIKE ?)"
-        return "(songs.title LIKE ?) OR (albums.name LIKE ?) OR (artists.name LIKE ?)"
+        if not self.fulltextsearch:
+            return "(songs.title LIKE ?) OR (albums.name LIKE ?) OR (artists.name LIKE ?)"
+        if not self.ftsquery:
+            return ""
+        return "songs.id IN (SELECT rowid FROM songs_search WHERE songs_search MATCH ?)"
 
     def SQL_args(self):
-        return ["%%%s%%" % self.searchstring] * 3
+        if not self.fulltextsearch:
+            return ["%%%s%%" % self.searchstring] * 3
+        if not self.ftsquery:
+            return []
+        return [self.ftsquery]
+
+    def maymatch(self, song):
+        if not self.fulltextsearch:
+            if "%" in self.searchstring or "_" in self.searchstring:
+                # wildcards are not handled
+                return True
+            searchstring = self.searchstring.lower()
+            for s in (song.title, song.album, song.artist):
+                if s and searchstring in s.lower():
+                    return True
+            return False
+        words = []
+        for s in [song.title, song.album, song.artist, song.album_artist] + list(song.tags or []):
+            if s:
+                words.extend(_wordre.findall(s.lower()))
+        for searchword in _wordre.findall(self.searchstring.lower()):
+            if not _isascii(searchword):
+                # the index folds diacritics, which we do not attempt here
+                return True
+            for word in words:
+                if word.startswith(searchword) or not _isascii(word):
+                    break
+            else:
+                return False
+        return True
+
+
+def _isascii(s):
+    try:
+        s.encode("ascii")
+        return True
+    except UnicodeError:
+        return False
 
 
 class tagfilter(filter):
@@ -174,6 +259,9 @@ class tagfilter(filter):
         else:
             return []
 
+    def maymatch(self, song):
+        return (self.tag_name in song.tags) != self.inverted
+
 
 class podcastfilter(tagfilter):
     def __init__(self, inverted=False):
@@ -213,6 +301,9 @@ class ratingfilter(filter):
         else:
             return []
 
+    def maymatch(self, song):
+        return (song.rating or None) == (self.rating or None)
+
 
 class filters(tuple):
 
@@ -252,6 +343,34 @@ class filters(tuple):
             result.extend(filter.SQL_args())
         return result
 
+    def maymatch(self, song):
+        for filter in self:
+            if not filter.maymatch(song):
+                return False
+        return True
+
+# helper function for usage in getinfo methods, which returns a line describing
+# the number and the total length of songs given their aggregates
+def _songsaggregatesline(aggregates):
+    if aggregates is None:
+        # the aggregates are still being fetched
+        return [_("Songs:"), _("Loading..."), "", ""]
+    if not aggregates:
+        return ["", "", "", ""]
+    hours, seconds = divmod(aggregates.totallength, 3600)
+    return [_("Songs:"), "%d (%d:%02d:%02d)" % (aggregates.numberofsongs, hours, seconds // 60, seconds % 60),
+            "", ""]
+
+# helper function for artists and albums, which fetches the aggregates of the
+# songs matching their filters without blocking, cf. song.fetchmetadata
+def _fetchsongsaggregates(aitem, callback, channel):
+    def setaggregates(rr):
+        # a failed request is remembered as well, in order not to show a placeholder forever
+        aitem.aggregates = rr.result or False
+        callback(aitem)
+    return hub.requestnoblocking(requests.getsongsaggregates(aitem.songdbid, filters=aitem.filters),
+                                 callback=setaggregates, channel=channel)
+
 # helper function for usage in getinfo methods, which merges information about
 # filters in third and forth columns of lines
 def _mergefilters(lines, filters):
@@ -270,6 +389,12 @@ class item(object):
     """ base class for various items presentend in the database and
     playlist windows."""
 
+    # Items which exist in large numbers (songs, artists and albums) are
+    # compact handles without instance dictionary. Since a subclass only
+    # lacks the instance dictionary if all its base classes do so, we
+    # declare empty slots here and in diritem.
+    __slots__ = []
+
     def __init__(self, songdbid, id):
         """ each item has to be bound to a specific database
         identified by songdbid """
@@ -298,6 +423,8 @@ class diritem(item):
 
     """ item containing other items """
 
+    __slots__ = []
+
     def getname(self):
         return "[%s]/" % self.name
 
@@ -308,6 +435,29 @@ class diritem(item):
         """ return items contained in self """
         pass
 
+    def getpagedcontents(self):
+        """ return (head, length, tail) if the contents can be read page-wise and None otherwise
+
+        The contents then consist of the items in the list head, followed
+        by length items, which are read on demand via getcontentspage, and
+        the items in the list tail. This method may be called outside of the
+        thread of the user interface and therefore must not modify self.
+        """
+        return None
+
+    def setcontentslength(self, length):
+        """ store the number of items length read on demand, as returned by getpagedcontents """
+        pass
+
+    def getcontentspage(self, after, offset, limit):
+        """ return at most limit items following the item with key after or, if after is None,
+        starting at offset """
+        return []
+
+    def getcontentskey(self, item):
+        """ return key of item for getcontentspage or None if only offsets can be used """
+        return None
+
     def getcontentsrecursive(self):
         """ return items contained in self including subdirs (in arbitrary order)"""
         result = []
@@ -350,6 +500,24 @@ class diritem(item):
         return _mergefilters([[self.name, "", "", ""]], self.filters)
 
 
+class placeholder(item):
+
+    """ item shown instead of the contents of a directory which are still being read """
+
+    artist = album = None
+
+    def __init__(self, songdbid):
+        item.__init__(self, songdbid, None)
+
+    def getid(self):
+        return None
+
+    def getname(self):
+        return _("Loading...")
+
+    def getinfo(self):
+        return [[_("Loading..."), "", "", ""]]
+
 #
 # specialized classes
 #
@@ -366,7 +534,15 @@ def _formatnumbertotal(number, total):
 
 class song(item):
 
-    __slots__ = ["songdbid", "id", "album_id", "artist_id", "song", "playingtime"]
+    """ handle of a song in a database
+
+    The song metadata is stored separately in song_metadata and fetched
+    on demand. Accessing a metadata attribute of the song returns the
+    corresponding attribute of its metadata, whereas setting it requires
+    to set the attribute of song_metadata.
+    """
+
+    __slots__ = ["songdbid", "id", "album_id", "artist_id", "album_artist_id", "date_played", "song_metadata"]
 
     def __init__(self, songdbid, id, album_id, artist_id, album_artist_id, date_played=None):
         """ create song with given id together with its database."""
@@ -381,13 +557,16 @@ class song(item):
     def __repr__(self):
         return "song(%r) in %r database" % (self.id, self.songdbid)
 
-    # the following two methods have to be defined because we use song as a
-    # member of a set in the autoregisterer
+    # the following methods have to be defined because we use song as a
+    # member of a set in the autoregisterer and as dictionary key
     def __hash__(self):
-        return hash("%r-%d" % (self.songdbid, self.id))
+        return hash((self.songdbid, self.id))
 
     def __eq__(self, other):
-        return isinstance(other, song) and self.songdbid == other.songdbid and self.id == other.id
+        return isinstance(other, song) and (self.id, self.songdbid) == (other.id, other.songdbid)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
 
     def __getstate__(self):
         return (self.songdbid, self.id, self.album_id, self.artist_id, self.album_artist_id, self.date_played)
@@ -405,10 +584,35 @@ class song(item):
             self.song_metadata = hub.request(requests.getsong_metadata(self.songdbid, self.id))
         # return metadata if we have been able to fetch it, otherwise return None
         if self.song_metadata:
-            return getattr(self.song_metadata, attr)
+            value = getattr(self.song_metadata, attr)
+            if value is None and attr in ("comments", "lyrics"):
+                # comments and lyrics are not part of the song metadata fetched
+                # from the database, so we have to query them separately
+                texts = hub.request(requests.getsong_texts(self.songdbid, self.id)) or ([], [])
+                self.song_metadata.comments, self.song_metadata.lyrics = texts
+                value = getattr(self.song_metadata, attr)
+            return value
         else:
             return None
 
+    def hasmetadata(self):
+        """ return whether the song metadata is available without a request """
+        return self.song_metadata is not None
+
+    def fetchmetadata(self, callback, channel):
+        """ fetch song metadata without blocking
+
+        Once the metadata is available, callback is called with the song as
+        argument in the thread processing channel. Returns the future of the
+        corresponding request.
+        """
+        def setmetadata(rr):
+            if not self.song_metadata:
+                self.song_metadata = rr.result
+            callback(self)
+        return hub.requestnoblocking(requests.getsong_metadata(self.songdbid, self.id),
+                                     callback=setmetadata, channel=channel)
+
     def _updatesong_metadata(self):
         """ notify database of song changes """
         hub.notify(events.update_song(self.songdbid, self))
@@ -586,17 +790,16 @@ class song(item):
             self._updatesong_metadata()
 
     def addtag(self, tag):
+        # the tags are those of the song metadata, which we modify in place
         tags = self.tags
         if tags is not None and tag not in tags:
             tags.append(tag)
-            self.tags = tags
             self._updatesong_metadata()
 
     def removetag(self, tag):
         tags = self.tags
         if tags is not None and tag in tags:
             tags.remove(tag)
-            self.tags = tags
             self._updatesong_metadata()
 
     def toggledelete(self):
@@ -614,20 +817,108 @@ class song(item):
         return self.date_played or self.date_lastplayed
 
 
+class metadatafetcher:
+
+    """ fetch the metadata of songs and the song aggregates of artists and albums in the background
+
+    Once the metadata of a song or the aggregates of an artist or album
+    have arrived, callback is called with the item in the thread
+    processing channel. Songs which could not be found are remembered
+    in order not to request them over and over again. At most maxfailed
+    of them are kept, and all of them are forgotten, when a database
+    changes.
+    """
+
+    def __init__(self, callback, channel, maxfailed=100):
+        self.callback = callback
+        self.channel = channel
+        self.maxfailed = maxfailed
+        # mapping song -> pending or failed request for its metadata
+        self.requests = {}
+        # songs whose metadata could not be found, oldest first
+        self.failedsongs = []
+        # artist or album whose song aggregates are being fetched and the corresponding request
+        self.aggregatesitem = None
+        self.aggregatesrequest = None
+        channel.subscribe(events.dbevent, self.dbevent)
+
+    def ispending(self, song):
+        """ return whether the metadata of song is still being fetched
+
+        If necessary, the metadata is requested in the background.
+        """
+        if song.hasmetadata():
+            return False
+        rr = self.requests.get(song)
+        if rr is None:
+            self.requests[song] = song.fetchmetadata(self.metadatafetched, self.channel)
+            return True
+        return not rr.hascompleted()
+
+    def aggregatespending(self, aitem):
+        """ return whether the song aggregates of the artist or album aitem are still being fetched
+
+        If necessary, they are requested in the background. Since only the
+        aggregates of a single item are shown at a time, a pending request
+        for another item is cancelled.
+        """
+        if aitem.aggregates is not None:
+            return False
+        if aitem is not self.aggregatesitem:
+            if self.aggregatesrequest is not None:
+                self.aggregatesrequest.cancel()
+            self.aggregatesitem = aitem
+            self.aggregatesrequest = aitem.fetchaggregates(self.callback, self.channel)
+        return True
+
+    def metadatafetched(self, song):
+        if song.hasmetadata():
+            del self.requests[song]
+        elif song not in self.failedsongs:
+            self.failedsongs.append(song)
+            if len(self.failedsongs) > self.maxfailed:
+                del self.requests[self.failedsongs.pop(0)]
+        self.callback(song)
+
+    def dbevent(self, event):
+        # songs which could not be found may have been added in the meantime
+        for song in self.failedsongs:
+            del self.requests[song]
+        self.failedsongs = []
+        # the song aggregates may have changed as well
+        if self.aggregatesitem is not None:
+            if self.aggregatesrequest is not None:
+                self.aggregatesrequest.cancel()
+            self.aggregatesitem.aggregates = None
+            self.aggregatesitem = self.aggregatesrequest = None
+
+
 class artist(diritem):
 
     """ artist bound to specific songdb """
 
+    __slots__ = ["songdbid", "id", "name", "filters", "aggregates"]
+
     def __init__(self, songdbid, id, name, filters):
         self.songdbid = songdbid
         self.id = id
         self.name = name
 
         self.filters = filters.removed(compilationfilter).added(artistfilter(id))
+        # aggregates of the songs of the artist, once they have been fetched
+        self.aggregates = None
 
     def __repr__(self):
         return "artist(%r) in %r (filtered: %r)" % (self.name, self.songdbid, self.filters)
 
+    # slotted instances can only be pickled with protocol 2 unless we define the following methods
+    def __getstate__(self):
+        return self.songdbid, self.id, self.name, self.filters
+
+    def __setstate__(self, state):
+        self.songdbid, self.id, self.name, self.filters = state
+        self.aggregates = None
+
     def getname(self):
         return "%s/" % self.name
 
@@ -651,36 +942,54 @@ class artist(diritem):
     def getheader(self, item):
         return self.name + self.filters.getname()
 
+    def fetchaggregates(self, callback, channel):
+        """ fetch the aggregates of the songs of the artist without blocking """
+        return _fetchsongsaggregates(self, callback, channel)
+
     def getinfo(self):
         if self.name == metadata.VARIOUS:
             # this should not happen, actually
             artistname = _("Various")
         else:
             artistname = self.name
-        return _mergefilters([[_("Artist:"), artistname, "", ""]], self.filters)
+        l = [[_("Artist:"), artistname, "", ""],
+             _songsaggregatesline(self.aggregates)]
+        return _mergefilters(l, self.filters)
 
 
 class album(diritem):
 
     """ album bound to specific songdb """
 
+    __slots__ = ["songdbid", "id", "artist", "name", "filters", "aggregates"]
+
     def __init__(self, songdbid, id, artist, name, filters):
         self.songdbid = songdbid
         self.id = id
         self.artist = artist
         self.name = name
         self.filters = filters.added(albumfilter(id))
+        # cf. artist
+        self.aggregates = None
 
     def __repr__(self):
         return "album(%r) in %r" % (self.id, self.songdbid)
 
+    # cf. artist
+    def __getstate__(self):
+        return self.songdbid, self.id, self.artist, self.name, self.filters
+
+    def __setstate__(self, state):
+        self.songdbid, self.id, self.artist, self.name, self.filters = state
+        self.aggregates = None
+
     class _orderclass:
         def cmpitem(self, x, y):
             return ( x.disknumber and y.disknumber and cmp(x.disknumber, y.disknumber) or
                      x.tracknumber and y.tracknumber and cmp(x.tracknumber, y.tracknumber) or
-                     cmp(x.title, y.title) )
+                     cmp(metadata.sortkey(x.title), metadata.sortkey(y.title)) )
         def SQL_string(self):
-            return "ORDER BY songs.disknumber, songs.tracknumber, songs.title"
+            return "ORDER BY songs.disknumber, songs.tracknumber, songs.title_sortkey"
     order = _orderclass()
 
     def getid(self):
@@ -690,7 +999,8 @@ class album(diritem):
         return "%s/" % self.name
 
     def getcontents(self):
-        songs = hub.request(requests.getsongs(self.songdbid, sort=self.order, filters=self.filters))
+        songs = hub.request(requests.getsongs(self.songdbid, sort=self.order, filters=self.filters,
+                                              withmetadata=True))
         return songs
 
     def getcontentsrecursive(self):
@@ -699,6 +1009,10 @@ class album(diritem):
     def getcontentsrecursiverandom(self):
         return hub.request(requests.getsongs(self.songdbid, filters=self.filters, random=True))
 
+    def fetchaggregates(self, callback, channel):
+        """ fetch the aggregates of the songs of the album without blocking """
+        return _fetchsongsaggregates(self, callback, channel)
+
     def getinfo(self):
         if self.artist == metadata.VARIOUS:
             artistname = _("Various")
@@ -706,7 +1020,8 @@ class album(diritem):
             artistname = self.artist
         albumname =  self.name 
         l = [[_("Artist:"), artistname, "", ""],
-             [_("Album:"), albumname, "", ""]]
+             [_("Album:"), albumname, "", ""],
+             _songsaggregatesline(self.aggregates)]
         return _mergefilters(l, self.filters)
 
 
@@ -732,7 +1047,8 @@ class playlist(diritem):
     order = _orderclass()
 
     def getcontents(self):
-        return hub.request(requests.getsongs(self.songdbid, filters=self.filters, sort=self.order))
+        return hub.request(requests.getsongs(self.songdbid, filters=self.filters, sort=self.order,
+                                             withmetadata=True))
 
     getcontentsrecursive = getcontents
 
@@ -781,19 +1097,70 @@ class songs(totaldiritem):
 
     class _orderclass:
         def cmpitem(self, x, y):
-            return ( cmp(x.title, y.title) or
-                     cmp(x.album, y.album) or
-                     cmp(x.path, y.path)
-                     )
+            return cmp(self.getkey(x), self.getkey(y))
+        def getkey(self, song):
+            return metadata.sortkey(song.title), song.url
+        def SQL_keys(self):
+            # the same as getkey, such that we can page through the songs
+            return ["songs.title_sortkey", "songs.url"]
         def SQL_string(self):
-            return "ORDER BY songs.title, albums.name, songs.url"
+            return "ORDER BY %s" % ", ".join(self.SQL_keys())
     order = _orderclass()
 
-    def getcontents(self):
-        songs = hub.request(requests.getsongs(self.songdbid, filters=self.filters, sort=self.order))
+    class _searchorderclass(_orderclass):
+        """ order by relevance for the search strings of the searchfilters """
+        # the ranks of different databases are not comparable, so their results
+        # are interleaved instead of being merged
+        interleaved = True
+        def __init__(self, searchfilters):
+            self.ftsquery = " ".join([f.ftsquery for f in searchfilters])
+        def __repr__(self):
+            return "searchorder(%r)" % self.ftsquery
+        def SQL_JOIN_string(self):
+            # weights of the title, album, artist, album_artist and tags columns
+            return ( "JOIN (SELECT rowid AS song_id, bm25(songs_search, 10.0, 5.0, 5.0, 2.0, 1.0) AS rank "
+                     "      FROM songs_search WHERE songs_search MATCH '%s') AS search_ranks "
+                     "ON (search_ranks.song_id = songs.id)" % self.ftsquery.replace("'", "''") )
+        def SQL_keys(self):
+            # the rank is no suitable key for paging
+            return None
+        def SQL_string(self):
+            return "ORDER BY search_ranks.rank, songs.title, albums.name, songs.url"
+
+    def getorder(self):
+        """ return order of the songs, which is by relevance if they result from a search """
+        searchfilters = [f for f in self.filters or [] if isinstance(f, searchfilter) and f.ftsquery]
+        if searchfilters and searchfilter.fulltextsearch:
+            return self._searchorderclass(searchfilters)
+        return self.order
+
+    def getcontents(self, onpartialcontents=None):
+        """ return songs
+
+        When querying all databases, onpartialcontents may be set to a function,
+        which is called (by the database manager thread) with the songs of the
+        databases which have already answered, while others are still pending.
+        """
+        songs = hub.request(requests.getsongs(self.songdbid, filters=self.filters, sort=self.getorder(),
+                                              withmetadata=True, onpartialresult=onpartialcontents))
         self.nrsongs = len(songs)
         return songs
 
+    def getpagedcontents(self):
+        return [], hub.request(requests.getnumberofsongs(self.songdbid, filters=self.filters)), []
+
+    def setcontentslength(self, length):
+        self.nrsongs = length
+
+    def getcontentspage(self, after, offset, limit):
+        return hub.request(requests.getsongs(self.songdbid, filters=self.filters, sort=self.getorder(),
+                                             withmetadata=True, limit=limit, offset=offset, after=after))
+
+    def getcontentskey(self, song):
+        order = self.getorder()
+        if order.SQL_keys():
+            return order.getkey(song)
+
     def getinfo(self):
         if self.artist is not None:
             l = [[_("Artist:"), self.artist, "", ""],
@@ -830,14 +1197,8 @@ class randomsongs(totaldiritem):
         self.filters = filters
 
     def getcontents(self):
-        songs = []
-        while len(songs)<self.maxnr:
-            newsongs = hub.request(requests.getsongs(self.songdbid, filters=self.filters, random=True))
-            if len(newsongs) > 0:
-                songs.extend(newsongs)
-            else:
-                break
-        return songs[:self.maxnr]
+        return hub.request(requests.getrandomsongs(self.songdbid, filters=self.filters, number=self.maxnr,
+                                                   withmetadata=True))
 
 
 class lastplayedsongs(diritem):
@@ -854,11 +1215,12 @@ class lastplayedsongs(diritem):
         def cmpitem(self, x, y):
             return cmp(y.getplayingtime(), x.getplayingtime())
         def SQL_string(self):
-            return "ORDER BY playstats.date_played DESC LIMIT 100"
+            return "ORDER BY playstats_daily.date_lastplayed DESC LIMIT 100"
     order = _orderclass()
 
     def getcontents(self):
-        return hub.request(requests.getlastplayedsongs(self.songdbid, sort=self.order, filters=self.filters))
+        return hub.request(requests.getlastplayedsongs(self.songdbid, sort=self.order, filters=self.filters,
+                                                       withmetadata=True))
 
     getcontentsrecursive = getcontentsrecursivesorted = getcontents
 
@@ -887,7 +1249,8 @@ class topplayedsongs(diritem):
     order = _orderclass()
 
     def getcontents(self):
-        songs = hub.request(requests.getsongs(self.songdbid, sort=self.order, filters=self.filters))
+        songs = hub.request(requests.getsongs(self.songdbid, sort=self.order, filters=self.filters,
+                                              withmetadata=True))
         return songs
 
     getcontentsrecursive = getcontentsrecursivesorted = getcontents
@@ -917,7 +1280,8 @@ class lastaddedsongs(diritem):
     order = _orderclass()
 
     def getcontents(self):
-        return hub.request(requests.getsongs(self.songdbid, sort=self.order, filters=self.filters))
+        return hub.request(requests.getsongs(self.songdbid, sort=self.order, filters=self.filters,
+                                             withmetadata=True))
 
     getcontentsrecursive = getcontentsrecursivesorted = getcontents
 
@@ -946,6 +1310,22 @@ class albums(totaldiritem):
         self.nralbums = len(albums)
         return albums
 
+    def getpagedcontents(self):
+        if self.songdbid is None:
+            # the keys of the albums are specific to a database
+            return None
+        return [], hub.request(requests.getnumberofalbums(self.songdbid, filters=self.filters)), []
+
+    def setcontentslength(self, length):
+        self.nralbums = length
+
+    def getcontentspage(self, after, offset, limit):
+        return hub.request(requests.getalbums(self.songdbid, filters=self.filters,
+                                              limit=limit, offset=offset, after=after))
+
+    def getcontentskey(self, album):
+        return metadata.sortkey(album.name), album.id, album.artist
+
     def getheader(self, item):
         if self.nralbums is None:
             self.nralbums = len(self.getcontents())
@@ -1230,6 +1610,30 @@ class basedir(totaldiritem):
         else:
             return aartists + self.virtdirs
 
+    def getpagedcontents(self):
+        if self.songdbid is None:
+            # the keys of the artists are specific to a database
+            return None
+        filters = self.filters.added(compilationfilter(False))
+        nrartists = hub.request(requests.getnumberofartists(self.songdbid, filters=filters))
+        if config.filelistwindow.virtualdirectoriesattop:
+            return self.virtdirs, nrartists, []
+        else:
+            return [], nrartists, self.virtdirs
+
+    def setcontentslength(self, length):
+        self.nrartists = length
+        # reset cached value
+        self.nrsongs = None
+
+    def getcontentspage(self, after, offset, limit):
+        filters = self.filters.added(compilationfilter(False))
+        return hub.request(requests.getartists(self.songdbid, filters=filters,
+                                               limit=limit, offset=offset, after=after))
+
+    def getcontentskey(self, artist):
+        return metadata.sortkey(artist.name), artist.id
+
     def getcontentsrecursivesorted(self):
         # we cannot rely on the default implementation since we don't want
         # to have the albums and songs included trice
@@ -1336,4 +1740,3 @@ class focus_on(index):
             nfilters = filters((searchfilter(searchstring),))
         index.__init__(self, [songdbid], _("Search:"), searchstring, nfilters)
         self.id = "search: %s" % searchstring
-
@@ -47,6 +47,9 @@ class iteminfowin(window.window):
         self.activeview = selection
         self.keybindings = config.keybindings.general
 
+        self.channel = channel
+        self.metadatafetcher = item.metadatafetcher(self.metadatafetched, channel)
+
         h, w, y, x, border = layout
         window.window.__init__(self, screen, h, w, y, x,
                                config.colors.iteminfowindow,
@@ -61,15 +64,24 @@ class iteminfowin(window.window):
         h, w, y, x, self.border = layout
         window.window.resize(self, h, w, y, x)
 
+    def metadatafetched(self, song):
+        self.update()
+
     def update(self):
         # update window title
         aitem = self.items[self.activeview]
         title = _("No song")
         if isinstance(aitem, (item.song, services.playlist.playlistitem)):
             if isinstance(aitem, item.song):
-                atype = aitem.type
+                song = aitem
             else:
-                atype = aitem.song.type
+                song = aitem.song
+            if self.metadatafetcher.ispending(song):
+                # do not block on the database, but show a placeholder instead
+                aitem = item.placeholder(song.songdbid)
+                atype = None
+            else:
+                atype = song.type
             if atype == "mp3":
                 title = _("MP3 Info")
             elif atype == "ogg":
@@ -78,6 +90,9 @@ class iteminfowin(window.window):
                 title = _("Song Info")
         elif isinstance(aitem, item.diritem):
             title = _("Directory Info")
+            if isinstance(aitem, (item.artist, item.album)):
+                # the song aggregates are shown once they have arrived
+                self.metadatafetcher.aggregatespending(aitem)
         if self.activeview != selection:
             title = title + " " + _("[Player: %s]") % self.activeview
         self.settitle(title)
@@ -175,15 +190,23 @@ class iteminfowinlong(messagewin.messagewin):
                                        config.iteminfolongwindow.autoclosetime)
 
         self.item = None
+        self.metadatafetcher = item.metadatafetcher(self.aggregatesfetched, channel)
 
         channel.subscribe(events.selectionchanged, self.selectionchanged)
 
     def _outputlen(self, width):
         return 16
 
+    def aggregatesfetched(self, aitem):
+        if self.hasfocus() and aitem is self.item:
+            self.update()
+
     def showitems(self):
         # get lines to display
         empty= [["", "", "", ""]]
+        if isinstance(self.item, (item.artist, item.album)):
+            # the song aggregates are shown once they have arrived
+            self.metadatafetcher.aggregatespending(self.item)
         if self.item:
             info = self.item.getinfolong()
         else:
@@ -43,7 +43,7 @@ class mainscreen:
         self.layout = config.general.layout
         self.h, self.w = self.getmaxyx()
         log.debug("h=%d, w=%d" % (self.h, self.w))
-        self.channel = hub.newchannel()
+        self.channel = hub.newchannel("main screen")
         self.keybindings = config.keybindings.general
         self.done = False
 
@@ -68,7 +68,7 @@ class mainscreen:
         self.helpwin = helpwin.helpwin(screen, self.h, self.w, self.channel)
 
         self.logwin = logwin.logwin(screen, self.h, self.w, self.channel)
-        self.statswin = statswin.statswin(screen, self.h, self.w, self.channel, len(songdbids))
+        self.statswin = statswin.statswin(screen, self.h, self.w, self.channel, len(songdbids), playerids)
 
         self.iteminfowinlong = iteminfowin.iteminfowinlong(screen, self.h, self.w, self.channel)
         self.lyricswin = lyricswin.lyricswin(screen, self.h, self.w, self.channel)
@@ -19,7 +19,7 @@
 # along with PyTone; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import os.path, re, struct, string, time
+import os.path, re, struct, string, time, unicodedata
 import encoding
 import log
 
@@ -28,6 +28,26 @@ VARIOUS = u"___VARIOUS___"
 
 tracknrandtitlere = re.compile("^\[?(\d+)\]? ?[- ] ?(.*)\.(mp3|ogg)$")
 
+# leading articles which are ignored when sorting
+sortarticles = [u"the", u"a", u"an"]
+
+def sortkey(s):
+    """ return key for sorting the name or title s
+
+    The key is case- and accent-folded and does not contain a leading article.
+    The databases store it for artists, albums, tags, playlists and song titles.
+    """
+    if not s:
+        return u""
+    if not isinstance(s, unicode):
+        s = s.decode("utf-8", "replace")
+    s = u"".join([c for c in unicodedata.normalize("NFKD", s) if not unicodedata.combining(c)])
+    s = s.lower().strip()
+    for article in sortarticles:
+        if s.startswith(article + u" ") and len(s) > len(article) + 1:
+            return s[len(article)+1:].lstrip()
+    return s
+
 ##############################################################################
 # song metadata class
 ##############################################################################
@@ -42,8 +62,8 @@ class song_metadata:
     album_artist = None
     tags = None
     year = None
-    comments = []       # list of tuples (language, description, text)
-    lyrics = []         # list of tuples (language, description, text)
+    comments = []       # list of tuples (language, description, text), None if not yet loaded
+    lyrics = []         # list of tuples (language, description, text), None if not yet loaded
     bpm = None
     tracknumber = None
     trackcount = None
@@ -345,8 +345,7 @@ class clientchannel(threading.Thread):
 		    rid, obj = obj
                     log.debug("Received request result (id=%d) from networkreceiver" % rid)
 		    item = self.pendingrequests[rid]
-		    item.result = obj
-		    item.ready.set()
+		    item.setresult(obj)
 		    del self.pendingrequests[rid]
 
     def notify(self, item, priority=0):
@@ -34,6 +34,7 @@
 
 #include <Python.h>
 #include <stdio.h>
+#include <math.h>
 #include <sys/types.h>
 #include <assert.h>
 
@@ -393,7 +394,8 @@ static PyObject *py_upsample(PyObject *self, PyObject *args) {
 
 /* scale(buff, factor):
 
-inplace scale all elements of buf (interpreted as signed int16) by factor
+inplace scale all elements of the writable buffer buf (interpreted as
+signed int16) by factor
 */
 
 static PyObject *py_scale(PyObject *self, PyObject *args) {
@@ -404,14 +406,14 @@ static PyObject *py_scale(PyObject *self, PyObject *args) {
   float factor;
   int i;
 
-  if (PyArg_ParseTuple(args, "t#f", &b_c, &l, &factor )) {
+  if (PyArg_ParseTuple(args, "w#f", &b_c, &l, &factor )) {
       b_i  = (int16_t *) b_c;
       
       Py_BEGIN_ALLOW_THREADS
       for (i=0; i<l/2; i++) {
           double r = b_i[i] * factor;
-          if (r>32768) b_i[i] = 32768;
-          else if (r<-32767) b_i[i] = -32767;
+          if (r>32767) b_i[i] = 32767;
+          else if (r<-32768) b_i[i] = -32768;
           else b_i[i] = (int) r;
       }
       Py_END_ALLOW_THREADS
@@ -421,6 +423,472 @@ static PyObject *py_scale(PyObject *self, PyObject *args) {
   return returnObj;
 }
 
+/* polyphase resampler
+ *
+ * The sample rate is converted by a FIR filter of taps taps. For a conversion
+ * from in_rate to out_rate with L=out_rate/gcd and M=in_rate/gcd, the output
+ * samples lie at the fractions phase/L between two input samples, with phase
+ * advancing by M per output sample. The filter coefficients for all these
+ * phases (at most MAXPHASES, otherwise the phase is quantized) are computed
+ * once per pair of sample rates and kept in a cache.
+ *
+ * The quality of the conversion, which determines the filter, trades sound
+ * quality for CPU time: a windowed sinc filter of 16 ("high") or 8 taps
+ * ("medium") or a linear interpolation between the two neighbouring input
+ * samples ("low"), which is computed as a filter of 4 taps, two of which are
+ * zero.
+ */
+
+#define MAXTAPS 16
+#define MAXPHASES 1024
+#define MAXFILTERBANKS 32
+#define ROLLOFF 0.95
+
+typedef struct {
+  char *name;
+  int taps;                     /* a multiple of 4 not larger than MAXTAPS */
+  int linear;                   /* linear interpolation instead of windowed sinc */
+} resamplingquality;
+
+static resamplingquality qualities[] = {{"low", 4, 1}, {"medium", 8, 0}, {"high", 16, 0}};
+#define NQUALITIES (sizeof(qualities)/sizeof(qualities[0]))
+
+/* quality of rate conversions started from now on */
+static resamplingquality *quality = qualities+1;
+
+typedef struct filterbank {
+  int in_rate, out_rate;
+  resamplingquality *quality;
+  long long L, M;
+  int phases;
+  int taps;
+  float *coeffs;                /* phases*taps coefficients, each stored twice for both channels */
+  int refcount;                 /* number of resamplers + 1 if in cache */
+  struct filterbank *next;
+} filterbank;
+
+/* cache of filter banks, most recently used first */
+static filterbank *filterbanks = NULL;
+
+static void releasefilterbank(filterbank *bank) {
+  if (--bank->refcount == 0) {
+    free(bank->coeffs);
+    free(bank);
+  }
+}
+
+static filterbank *newfilterbank(int in_rate, int out_rate, resamplingquality *quality) {
+  filterbank *bank;
+  long long g = gcd(in_rate, out_rate);
+  double cutoff;
+  int taps = quality->taps;
+  int p, k;
+
+  if (!(bank = (filterbank *) malloc(sizeof(filterbank))))
+    return NULL;
+  bank->in_rate = in_rate;
+  bank->out_rate = out_rate;
+  bank->quality = quality;
+  bank->L = out_rate / g;
+  bank->M = in_rate / g;
+  bank->phases = bank->L < MAXPHASES ? bank->L : MAXPHASES;
+  bank->taps = taps;
+  if (!(bank->coeffs = (float *) malloc(bank->phases*2*taps*sizeof(float)))) {
+    free(bank);
+    return NULL;
+  }
+  bank->refcount = 0;
+  bank->next = NULL;
+
+  /* when downsampling, the cutoff frequency has to be lowered to prevent aliasing */
+  cutoff = ROLLOFF * (bank->L < bank->M ? (double) bank->L / bank->M : 1.0);
+
+  for (p=0; p<bank->phases; p++) {
+    double h[MAXTAPS];
+    double sum = 0;
+    for (k=0; k<taps; k++) {
+      /* distance of tap k from the output sample in input samples */
+      double t = k - taps/2 + 1 - (double) p / bank->phases;
+      if (quality->linear)
+        h[k] = fabs(t) < 1 ? 1 - fabs(t) : 0;
+      else {
+        double x = M_PI * cutoff * t;
+        double window = 0.42 + 0.5*cos(2*M_PI*t/taps) + 0.08*cos(4*M_PI*t/taps);
+        h[k] = (x == 0 ? 1 : sin(x)/x) * window;
+      }
+      sum += h[k];
+    }
+    for (k=0; k<taps; k++)
+      bank->coeffs[(p*taps+k)*2] = bank->coeffs[(p*taps+k)*2+1] = h[k]/sum;
+  }
+  return bank;
+}
+
+/* return filter bank for conversion from in_rate to out_rate in the current quality
+ * with an additional reference */
+
+static filterbank *getfilterbank(int in_rate, int out_rate) {
+  filterbank *bank, *previous = NULL;
+  int n = 0;
+
+  for (bank=filterbanks; bank; previous=bank, bank=bank->next, n++)
+    if (bank->in_rate == in_rate && bank->out_rate == out_rate && bank->quality == quality)
+      break;
+
+  if (bank) {
+    /* move to front */
+    if (previous) {
+      previous->next = bank->next;
+      bank->next = filterbanks;
+      filterbanks = bank;
+    }
+  }
+  else {
+    if (!(bank = newfilterbank(in_rate, out_rate, quality)))
+      return NULL;
+    /* the cache holds a reference of its own */
+    bank->refcount = 1;
+    bank->next = filterbanks;
+    filterbanks = bank;
+    /* drop least recently used filter banks */
+    if (n >= MAXFILTERBANKS) {
+      filterbank *last;
+      for (last=filterbanks, n=1; n<MAXFILTERBANKS; n++)
+        last = last->next;
+      while (last->next) {
+        filterbank *dropped = last->next;
+        last->next = dropped->next;
+        releasefilterbank(dropped);
+      }
+    }
+  }
+  bank->refcount++;
+  return bank;
+}
+
+/* resampler objects keep the streaming state of a rate conversion */
+
+typedef struct {
+  PyObject_HEAD
+  filterbank *bank;
+  /* last MAXTAPS stereo input samples stored twice in a ring buffer,
+   * such that hist+2*pos points to them in chronological order */
+  float hist[4*MAXTAPS];
+  int pos;
+  long long phase;
+} resamplerobject;
+
+static void resampler_dealloc(resamplerobject *self) {
+  if (self->bank)
+    releasefilterbank(self->bank);
+  PyObject_Del(self);
+}
+
+static PyTypeObject resamplertype = {
+  PyObject_HEAD_INIT(NULL)
+  0,                            /* ob_size */
+  "pcm.resampler",              /* tp_name */
+  sizeof(resamplerobject),      /* tp_basicsize */
+  0,                            /* tp_itemsize */
+  (destructor) resampler_dealloc, /* tp_dealloc */
+  0,                            /* tp_print */
+  0,                            /* tp_getattr */
+  0,                            /* tp_setattr */
+  0,                            /* tp_compare */
+  0,                            /* tp_repr */
+  0,                            /* tp_as_number */
+  0,                            /* tp_as_sequence */
+  0,                            /* tp_as_mapping */
+  0,                            /* tp_hash */
+  0,                            /* tp_call */
+  0,                            /* tp_str */
+  0,                            /* tp_getattro */
+  0,                            /* tp_setattro */
+  0,                            /* tp_as_buffer */
+  Py_TPFLAGS_DEFAULT,           /* tp_flags */
+  "streaming state of a sample rate conversion", /* tp_doc */
+};
+
+static void resampler_push(resamplerobject *r, float l, float rr) {
+  r->hist[2*r->pos] = r->hist[2*(r->pos+MAXTAPS)] = l;
+  r->hist[2*r->pos+1] = r->hist[2*(r->pos+MAXTAPS)+1] = rr;
+  r->pos = (r->pos+1) % MAXTAPS;
+}
+
+/* return resampler for conversion from in_rate to out_rate continuing the
+ * stream of state (if not None) or starting with the sample first */
+
+static resamplerobject *getresampler(PyObject *state, int in_rate, int out_rate, int16_t *first) {
+  resamplerobject *old = NULL;
+  resamplerobject *r;
+  int k;
+
+  if (state != Py_None) {
+    if (state->ob_type != &resamplertype) {
+      PyErr_SetString(PyExc_TypeError, "state has to be None or a resampler");
+      return NULL;
+    }
+    old = (resamplerobject *) state;
+    if (old->bank->in_rate == in_rate && old->bank->out_rate == out_rate && old->bank->quality == quality) {
+      Py_INCREF(old);
+      return old;
+    }
+  }
+
+  if (!(r = PyObject_New(resamplerobject, &resamplertype)))
+    return NULL;
+  if (!(r->bank = getfilterbank(in_rate, out_rate))) {
+    PyObject_Del(r);
+    return (resamplerobject *) PyErr_NoMemory();
+  }
+
+  if (old) {
+    /* the sample rates or the quality have changed, continue with the old stream */
+    memcpy(r->hist, old->hist, sizeof(r->hist));
+    r->pos = old->pos;
+    r->phase = old->phase * r->bank->L / old->bank->L;
+  }
+  else {
+    r->pos = 0;
+    for (k=0; k<MAXTAPS; k++)
+      resampler_push(r, first[0], first[1]);
+    r->phase = 0;
+  }
+  return r;
+}
+
+/* render(out, outpos, outlen, in, inpos, in_rate, out_rate, state, factor, mixingratio, mixingrate):
+
+convert the samples of in starting at byte inpos from in_rate to out_rate,
+scale them by factor and write them into the writable buffer out from
+byte outpos up to byte outlen. If mixingrate is not None, the samples are
+mixed into the data already present in out with the ratio mixingratio,
+which is changed by mixingrate per sample. state carries the streaming
+state of the rate conversion (a resampler) between successive calls. It
+has to be None at the beginning of a stream. If the sample rates are
+equal, the samples are only copied.
+
+Returns the tuple (inpos, outpos, state, mixingratio), where inpos==len(in)
+signals that the input has been consumed completely and outpos==outlen that
+out is full. Apart from a new resampler at the beginning of a stream or
+after a change of the sample rates, no memory is allocated in the process.
+*/
+
+static int16_t clip(float r) {
+  if (r>32767) return 32767;
+  else if (r<-32768) return -32768;
+  else return (int16_t) r;
+}
+
+static void emit(int16_t *out_i, float l, float r, float factor, 
+                 int mixing, float *mixingratio, float df) {
+  if (mixing) {
+    float f = *mixingratio;
+    out_i[0] = clip(out_i[0] * (1-f) + l * factor * f);
+    f += df;
+    out_i[1] = clip(out_i[1] * (1-f) + r * factor * f);
+    f += df;
+    if (f>1) f=1;
+    else if (f<0) f=0;
+    *mixingratio = f;
+  }
+  else {
+    out_i[0] = clip(l * factor);
+    out_i[1] = clip(r * factor);
+  }
+}
+
+/* convert the input samples of render with a filter of n taps
+ *
+ * This is a macro, such that the loop over the taps has a constant
+ * number of iterations, which the compiler can unroll.
+ */
+#define RESAMPLE(n)                                                     \
+  while (o < outlen) {                                                  \
+    float *c, *h;                                                       \
+    /* partial sums, which the compiler can compute in parallel */      \
+    float sums[8] = {0, 0, 0, 0, 0, 0, 0, 0};                           \
+    int j, k;                                                           \
+                                                                        \
+    /* advance input until the output sample lies in the middle of the history */ \
+    while (p >= L && i < inlen) {                                       \
+      hist[2*pos] = hist[2*(pos+MAXTAPS)] = in_i[i];                    \
+      hist[2*pos+1] = hist[2*(pos+MAXTAPS)+1] = in_i[i+1];              \
+      pos = (pos+1) % MAXTAPS;                                          \
+      i += 2;                                                           \
+      p -= L;                                                           \
+    }                                                                   \
+    if (p >= L)                                                         \
+      break;                                                            \
+                                                                        \
+    c = coeffs + (phases == L ? p : p*phases/L)*2*(n);                  \
+    /* the filter is applied to the last n input samples */             \
+    h = hist + 2*(pos+MAXTAPS-(n));                                     \
+    for (j=0; j<2*(n); j+=8)                                            \
+      for (k=0; k<8; k++)                                               \
+        sums[k] += c[j+k] * h[j+k];                                     \
+                                                                        \
+    emit(out_i+o,                                                       \
+         (sums[0] + sums[2]) + (sums[4] + sums[6]),                     \
+         (sums[1] + sums[3]) + (sums[5] + sums[7]),                     \
+         factor, mixing, mixingratio, df);                              \
+    o += 2;                                                             \
+    p += M;                                                             \
+  }
+
+static void render(int16_t *out_i, int *outpos, int outlen,
+                   int16_t *in_i, int *inpos, int inlen,
+                   resamplerobject *resampler,
+                   float factor, 
+                   int mixing, float *mixingratio, float mixingrate) {
+  int o = *outpos;
+  int i = *inpos;
+  float df = mixingrate/2;	/* we deal with stereo data */
+
+  if (!resampler) {
+    /* no rate conversion necessary */
+    while (o < outlen && i < inlen) {
+      emit(out_i+o, in_i[i], in_i[i+1], factor, mixing, mixingratio, df);
+      i += 2;
+      o += 2;
+    }
+  }
+  else {
+    filterbank *bank = resampler->bank;
+    long long L = bank->L;
+    long long M = bank->M;
+    long long p = resampler->phase;
+    int phases = bank->phases;
+    float *coeffs = bank->coeffs;
+    float *hist = resampler->hist;
+    int pos = resampler->pos;
+
+    switch (bank->taps) {
+    case 4:
+      RESAMPLE(4);
+      break;
+    case 8:
+      RESAMPLE(8);
+      break;
+    default:
+      RESAMPLE(MAXTAPS);
+    }
+    resampler->phase = p;
+    resampler->pos = pos;
+  }
+
+  *outpos = o;
+  *inpos = i;
+}
+
+static PyObject *py_render(PyObject *self, PyObject *args) {
+  PyObject *returnObj;
+
+  char *out_c;
+  int lout;
+  int outpos;
+  int outlen;
+
+  char *in_c;
+  int lin;
+  int lin_c;
+  int inpos;
+
+  int in_rate;
+  int out_rate;
+
+  PyObject *py_state;
+  resamplerobject *resampler = NULL;
+
+  float factor;
+  float mixingratio;
+  PyObject *py_mixingrate;
+  float mixingrate = 0;
+  int mixing;
+
+  if (!PyArg_ParseTuple(args,
+                        "w#iit#iiiOffO",
+                        &out_c, &lout, &outpos, &outlen,
+                        &in_c, &lin, &inpos,
+                        &in_rate, &out_rate,
+                        &py_state,
+                        &factor,
+                        &mixingratio, &py_mixingrate))
+    return NULL;
+
+  if (outpos < 0 || outlen > lout || inpos < 0 || inpos > lin || in_rate <= 0 || out_rate <= 0) {
+    PyErr_SetString(PyExc_ValueError, "invalid buffer position or sample rate");
+    return NULL;
+  }
+
+  if ((mixing = py_mixingrate != Py_None)) {
+    mixingrate = PyFloat_AsDouble(py_mixingrate);
+    if (PyErr_Occurred())
+      return NULL;
+  }
+
+  if (in_rate != out_rate) {
+    if (py_state == Py_None) {
+      if (inpos+4 > lin)
+        return Py_BuildValue("iiOf", lin, outpos, Py_None, mixingratio);
+      /* start the stream with the first input sample */
+      if (!(resampler = getresampler(py_state, in_rate, out_rate, (int16_t *) (in_c + inpos))))
+        return NULL;
+      inpos += 4;
+    }
+    else if (!(resampler = getresampler(py_state, in_rate, out_rate, NULL)))
+      return NULL;
+  }
+
+  /* we only process complete samples */
+  lin_c = lin;
+  outpos /= 2;
+  outlen = outlen/4*2;
+  inpos /= 2;
+  lin = lin/4*2;
+
+  Py_BEGIN_ALLOW_THREADS
+  render((int16_t *) out_c, &outpos, outlen,
+         (int16_t *) in_c, &inpos, lin,
+         resampler,
+         factor,
+         mixing, &mixingratio, mixingrate);
+  Py_END_ALLOW_THREADS
+
+  /* a trailing incomplete sample is dropped */
+  inpos = inpos == lin ? lin_c : 2*inpos;
+
+  if (resampler) {
+    returnObj = Py_BuildValue("iiOf", inpos, 2*outpos, resampler, mixingratio);
+    Py_DECREF(resampler);
+    return returnObj;
+  }
+  else
+    return Py_BuildValue("iiOf", inpos, 2*outpos, Py_None, mixingratio);
+}
+
+/* setresamplingquality(quality): set the quality of rate conversions started from now on
+
+quality is one of "low", "medium" and "high", see above. Streams being
+converted switch to the new quality with the next call of render.
+*/
+
+static PyObject *py_setresamplingquality(PyObject *self, PyObject *args) {
+  char *name;
+  int n;
+
+  if (!PyArg_ParseTuple(args, "s", &name))
+    return NULL;
+  for (n=0; n<NQUALITIES; n++)
+    if (!strcmp(qualities[n].name, name)) {
+      quality = qualities+n;
+      Py_INCREF(Py_None);
+      return Py_None;
+    }
+  PyErr_SetString(PyExc_ValueError, "unknown resampling quality");
+  return NULL;
+}
+
 /* exported methods */
 
 static PyMethodDef pcm_methods[] = {
@@ -428,9 +896,14 @@ static PyMethodDef pcm_methods[] = {
   {"rate_convert", py_rate_convert,  METH_VARARGS},
   {"upsample", py_upsample,  METH_VARARGS},
   {"scale", py_scale,  METH_VARARGS},
+  {"render", py_render,  METH_VARARGS},
+  {"setresamplingquality", py_setresamplingquality,  METH_VARARGS},
   {NULL, NULL}
 };
 
 void initpcm(void) {
+  resamplertype.ob_type = &PyType_Type;
+  if (PyType_Ready(&resamplertype) < 0)
+    return;
   (void) Py_InitModule("pcm", pcm_methods);
 }
@@ -0,0 +1,299 @@
+# -*- coding: ISO-8859-1 -*-
+
+# Copyright (C) 2002, 2003, 2004, 2005 Jrg Lehmann <joerg@luga.de>
+#
+# This file is part of PyTone (http://www.luga.de/pytone/)
+#
+# PyTone is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2
+# as published by the Free Software Foundation.
+#
+# PyTone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyTone; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+""" NumPy implementation of the pcm extension module
+
+This module provides the same functions as the C extension module pcm
+(see pcm/pcm.c) and is used in its place if the latter has not been built.
+All buffers are interpreted as 16 bit stereo PCM data in native byte order.
+Buffers returned by the functions are writable array.array instances.
+"""
+
+import array
+import numpy
+
+def _int16(buff, start=0, end=None):
+    """ return int16 array view of buff[start:end] """
+    if end is None:
+        end = len(buff)
+    end -= (end-start) % 2
+    return numpy.frombuffer(buff, numpy.int16, (end-start)//2, start)
+
+def _tobuffer(samples):
+    result = array.array("c")
+    result.fromstring(samples.astype(numpy.int16).tostring())
+    return result
+
+def _clip(samples):
+    """ convert float samples to int16 saturating at the range limits """
+    return numpy.clip(samples, -32768, 32767).astype(numpy.int16)
+
+def _gcd(m, n):
+    while n:
+        m, n = n, m % n
+    return m
+
+def _skips(in_rate, out_rate):
+    """ return distances of input and output samples on the lcm grid of both rates """
+    lcm_rate = in_rate*out_rate // _gcd(in_rate, out_rate)
+    return lcm_rate // in_rate, lcm_rate // out_rate
+
+#
+# polyphase resampler, see pcm/pcm.c for a description of the algorithm
+#
+
+MAXTAPS = 16
+MAXPHASES = 1024
+MAXFILTERBANKS = 32
+ROLLOFF = 0.95
+
+# resampling quality -> (number of taps, linear interpolation instead of windowed sinc)
+_qualities = {"low": (4, True), "medium": (8, False), "high": (16, False)}
+# quality of rate conversions started from now on
+_quality = "medium"
+
+# cache of filter banks: (in_rate, out_rate, quality) -> (L, M, phases, taps, coefficients)
+_filterbanks = {}
+# keys of _filterbanks, least recently used first
+_filterbankkeys = []
+
+def _getfilterbank(in_rate, out_rate, quality):
+    key = in_rate, out_rate, quality
+    try:
+        bank = _filterbanks[key]
+        _filterbankkeys.remove(key)
+    except KeyError:
+        g = _gcd(in_rate, out_rate)
+        L = out_rate // g
+        M = in_rate // g
+        phases = min(L, MAXPHASES)
+        taps, linear = _qualities[quality]
+        # distance of the taps from the output sample in input samples
+        t = numpy.arange(taps) - taps//2 + 1 - (numpy.arange(phases, dtype=numpy.float64)/phases)[:, numpy.newaxis]
+        if linear:
+            h = numpy.maximum(1 - abs(t), 0)
+        else:
+            # when downsampling, the cutoff frequency has to be lowered to prevent aliasing
+            cutoff = ROLLOFF * min(float(L)/M, 1.0)
+            x = numpy.pi * cutoff * t
+            window = 0.42 + 0.5*numpy.cos(2*numpy.pi*t/taps) + 0.08*numpy.cos(4*numpy.pi*t/taps)
+            h = numpy.where(x == 0, 1, numpy.sin(x)/numpy.where(x == 0, 1, x)) * window
+        coeffs = (h / h.sum(axis=1)[:, numpy.newaxis]).astype(numpy.float32)
+        bank = L, M, phases, taps, coeffs
+        _filterbanks[key] = bank
+        if len(_filterbankkeys) >= MAXFILTERBANKS:
+            del _filterbanks[_filterbankkeys.pop(0)]
+    _filterbankkeys.append(key)
+    return bank
+
+
+class resampler:
+
+    """ streaming state of a sample rate conversion
+
+    The state consists of the last MAXTAPS input samples and the phase of
+    the next output sample. It either starts with the sample first or
+    continues the stream of the resampler old.
+    """
+
+    def __init__(self, in_rate, out_rate, first=None, old=None):
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.quality = _quality
+        self.L, self.M, self.phases, self.taps, self.coeffs = _getfilterbank(in_rate, out_rate, _quality)
+        if old is not None:
+            self.history = old.history
+            self.phase = old.phase * self.L // old.L
+        else:
+            self.history = numpy.repeat(first.astype(numpy.float32)[numpy.newaxis, :], MAXTAPS, axis=0)
+            self.phase = 0
+
+    def convert(self, samples, capacity):
+        """ convert at most capacity output samples from samples
+
+        Returns the converted samples and the number of consumed input samples.
+        """
+        L, M, p0 = self.L, self.M, self.phase
+        available = len(samples)
+        # number of output samples for which enough input is available
+        number = min(capacity, max(((available+1)*L - p0 + M - 1) // M, 0))
+        ext = numpy.concatenate((self.history, samples.astype(numpy.float32)))
+        phases = p0 + numpy.arange(number, dtype=numpy.int64)*M
+        advances = phases // L
+        phases -= advances*L
+        if self.phases != L:
+            phases = phases*self.phases // L
+        # the filter is applied to the last taps input samples
+        windows = ext[advances[:, numpy.newaxis] + numpy.arange(MAXTAPS-self.taps, MAXTAPS)]
+        values = numpy.einsum("kt,ktc->kc", self.coeffs[phases], windows)
+        # determine how many input samples the C implementation would have consumed
+        if number == capacity:
+            consumed = number and int(advances[-1])
+        else:
+            consumed = min((p0 + number*M) // L, available)
+        self.history = ext[consumed:consumed+MAXTAPS].copy()
+        self.phase = p0 + number*M - consumed*L
+        return values, consumed
+
+def _interpolate(ext, number, phase, in_skip, out_skip):
+    """ linearly interpolate number samples
+
+    ext is an array of stereo samples, where ext[0] lies at phase 0
+    and ext[i] at phase i*in_skip. The first output sample lies at the
+    given phase and the following ones are out_skip apart.
+    """
+    phases = phase + numpy.arange(number, dtype=numpy.int64)*out_skip
+    advances = phases // in_skip
+    fractions = (phases - advances*in_skip).astype(numpy.float32)[:, numpy.newaxis]
+    last = ext[advances].astype(numpy.float32)
+    next = ext[advances+1].astype(numpy.float32)
+    return last + (next - last) * fractions / numpy.float32(in_skip)
+
+def _ramp(mixingratio, mixingrate, number, period):
+    """ return mixing ratios for number int16 values and the final ratio
+
+    As in the C implementation, the ratios are accumulated in single precision
+    and clamped to the interval [0, 1] after every period values.
+    """
+    df = numpy.float32(mixingrate/2.0)
+    ratios = numpy.empty(number+1, numpy.float32)
+    ratios[0] = mixingratio
+    ratios[1:] = df
+    ratios = numpy.add.accumulate(ratios, dtype=numpy.float32)
+    checked = ratios[period::period]
+    outside = numpy.nonzero((checked > 1) | (checked < 0))[0]
+    if len(outside):
+        first = period*(outside[0]+1)
+        bound = numpy.float32(checked[outside[0]] > 1)
+        for i in range(period):
+            ratios[first+i::period] = bound + i*df
+    return ratios[:number], float(ratios[number])
+
+#
+# the functions of the pcm module
+#
+
+def mix(buff1, buff2, mixingratio, mixingrate):
+    """ mix buff1 and buff2 and return (mixed buffer, new mixingratio)
+
+    The mixing ratio, i.e., the weight of buff2, changes by mixingrate per
+    sample. The shorter buffer is padded with silence.
+    """
+    samples1 = _int16(buff1)
+    samples2 = _int16(buff2)
+    n = max(len(samples1), len(samples2))
+    if len(samples1) < n:
+        samples1 = numpy.concatenate((samples1, numpy.zeros(n-len(samples1), numpy.int16)))
+    if len(samples2) < n:
+        samples2 = numpy.concatenate((samples2, numpy.zeros(n-len(samples2), numpy.int16)))
+    ratios, mixingratio = _ramp(numpy.float32(mixingratio), mixingrate, n, 1)
+    mixed = samples1 * (1-ratios) + samples2 * ratios
+    return _tobuffer(_clip(mixed)), mixingratio
+
+def rate_convert(buff, in_rate, prefix, start, out_rate, last_l, last_r):
+    """ convert buff from in_rate to out_rate and append it to prefix[start:]
+
+    Returns the tuple (converted buffer, last_l, last_r), where last_l and
+    last_r have to be passed to the next call for the same stream.
+    """
+    samples = _int16(buff, 0, len(buff)//4*4).reshape(-1, 2)
+    if prefix is not None and start is not None:
+        prefixsamples = _int16(prefix, start)
+    else:
+        prefixsamples = numpy.zeros(0, numpy.int16)
+
+    if in_rate == out_rate or not len(samples):
+        converted = samples.ravel()
+    else:
+        if last_l is None or last_r is None:
+            last = samples[0]
+        else:
+            last = numpy.array((last_l, last_r), numpy.int16)
+        ext = numpy.concatenate((last[numpy.newaxis, :], samples))
+        in_skip, out_skip = _skips(in_rate, out_rate)
+        number = (len(samples)*in_skip + out_skip - 1) // out_skip
+        converted = _interpolate(ext, number, 0, in_skip, out_skip).astype(numpy.int16).ravel()
+        last_l, last_r = int(samples[-1, 0]), int(samples[-1, 1])
+    return _tobuffer(numpy.concatenate((prefixsamples, converted))), last_l, last_r
+
+def upsample(buff):
+    """ convert mono buff into a stereo buffer """
+    return _tobuffer(numpy.repeat(_int16(buff), 2))
+
+def scale(buff, factor):
+    """ scale writable buff in place by factor """
+    samples = _int16(buff)
+    scaled = samples * numpy.float64(numpy.float32(factor))
+    samples[:] = _clip(scaled)
+
+def render(out, outpos, outlen, buff, inpos, in_rate, out_rate, state, factor, mixingratio, mixingrate):
+    """ convert, scale and possibly mix buff[inpos:] into out[outpos:outlen]
+
+    See the render function of the pcm extension module for a description of
+    the arguments and the result.
+    """
+    lin = len(buff)
+    if outpos < 0 or outlen > len(out) or inpos < 0 or inpos > lin or in_rate <= 0 or out_rate <= 0:
+        raise ValueError("invalid buffer position or sample rate")
+    samples = _int16(buff, 0, lin//4*4).reshape(-1, 2)
+    n = len(samples)
+    s0 = inpos // 4
+    capacity = max(outlen//4 - outpos//4, 0)
+
+    if in_rate == out_rate:
+        number = max(min(capacity, n - s0), 0)
+        values = samples[s0:s0+number].astype(numpy.float32)
+        consumed = s0 + number
+        newstate = None
+    else:
+        if state is None:
+            if s0 >= n:
+                return lin, outpos, None, mixingratio
+            # start the stream with the first input sample
+            newstate = resampler(in_rate, out_rate, first=samples[s0])
+            s0 += 1
+        elif state.in_rate != in_rate or state.out_rate != out_rate or state.quality != _quality:
+            newstate = resampler(in_rate, out_rate, old=state)
+        else:
+            newstate = state
+        values, consumed = newstate.convert(samples[s0:], capacity)
+        consumed += s0
+        number = len(values)
+
+    values = values.ravel() * numpy.float32(factor)
+    target = _int16(out, outpos//4*4, outpos//4*4 + 4*number)
+    if mixingrate is not None:
+        # the ratio is clamped after each stereo sample
+        ratios, mixingratio = _ramp(numpy.float32(mixingratio), mixingrate, len(values), 2)
+        target[:] = _clip(target * (1-ratios) + values * ratios)
+    else:
+        target[:] = _clip(values)
+
+    if consumed == n:
+        inpos = lin
+    else:
+        inpos = 4*consumed
+    return inpos, outpos + 4*number, newstate, mixingratio
+
+def setresamplingquality(quality):
+    """ set the quality ("low", "medium" or "high") of rate conversions started from now on """
+    global _quality
+    if quality not in _qualities:
+        raise ValueError("unknown resampling quality")
+    _quality = quality
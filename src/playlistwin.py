@@ -21,6 +21,7 @@ import curses, time
 
 import config
 import events, hub
+import item
 import playlist
 import statusbar
 import window
@@ -48,6 +49,8 @@ class playlistwin(window.window):
 
         self.playlist = playlist.playlist(self, playerid)
 
+        self.metadatafetcher = item.metadatafetcher(self.metadatafetched, self.channel)
+
         self.channel.subscribe(events.keypressed, self.keypressed)
         self.channel.subscribe(events.mouseevent, self.mouseevent)
         self.channel.subscribe(events.focuschanged, self.focuschanged)
@@ -75,6 +78,9 @@ class playlistwin(window.window):
         if not self.hasfocus():
             self.playlist._recenter()
 
+    def metadatafetched(self, song):
+        self.update()
+
     def activatefilelist(self):
         # before recentering we remove the focus from the playlist in order
         # to prevent wrong songchanged events being issued (which would lead to
@@ -191,7 +197,11 @@ class playlistwin(window.window):
                 adddict = {"playstarthours":   h,
                            "playstartminutes": m,
                            "playstartseconds": s}
-                name = encoding.encode(item.song.format(self.songformat, adddict=adddict))
+                if not self.metadatafetcher.ispending(item.song):
+                    name = encoding.encode(item.song.format(self.songformat, adddict=adddict))
+                else:
+                    # do not block on the database, but show a placeholder instead
+                    name = encoding.encode(_("Loading..."))
                 if self.playlist.playingitem and item is self.playlist.playingitem:
                     if self.playlist.selected==i and self.hasfocus():
                         attr = self.colors.selected_playingsong
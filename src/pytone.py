@@ -161,6 +161,8 @@ try:
     # Now that the basic services have been started, we can initialize
     # the players. This has to be done last because the players
     # immediately start requesting a new song
+    import decoder
+    decoder.pcm.setresamplingquality(config.general.resamplingquality)
     playerids = [services.player.initplayer("main", config.player.main),
                  services.player.initplayer("secondary", config.player.secondary)]
 
@@ -57,15 +57,38 @@ class dbrequestsongs(dbrequest):
     with the exception that the order of the items may be changed at
     will (for instance by sorting)
 
+    If withmetadata is set, the song metadata of the resulting songs
+    is fetched in one go and attached to the songs.
+
+    For requests spanning all databases (songdbid None), onpartialresult
+    can be set to a function, which is called with the merged songs of the
+    databases which have already answered, while others are still pending.
+    Note that it is called by the database manager thread.
+
+    If limit is set, only a page of at most limit songs is returned. It
+    starts after the song whose sort key (see the SQL_keys method of
+    sort) equals after, if this is given, and otherwise at offset.
     """
 
-    def __init__(self, songdbid, random=False, sort=False, filters=None):
+    def __init__(self, songdbid, random=False, sort=False, filters=None, withmetadata=False,
+                 onpartialresult=None, limit=None, offset=0, after=None):
         self.songdbid = songdbid
         self.sort = sort
         self.random = random
         self.filters = filters
+        self.withmetadata = withmetadata
+        self.onpartialresult = onpartialresult
+        self.limit = limit
+        self.offset = offset
+        self.after = after
 
     def __repr__(self):
+        # withmetadata and onpartialresult are deliberately left out, since they do not
+        # change the resulting list of songs and we want to share the cached result
+        if self.limit is not None:
+            return "%r(%r, %r, random=%r, limit=%r, offset=%r, after=%r)->%r" % (
+                self.__class__.__name__, self.sort, self.filters, self.random,
+                self.limit, self.offset, self.after, self.songdbid)
         return "%r(%r, %r, random=%r)->%r" % (self.__class__.__name__, self.sort, self.filters, self.random, self.songdbid)
 
 
@@ -74,12 +97,26 @@ class dbrequestlist(dbrequest):
     which have to be merged when querying multiple databases
 
     Note that the resulting list must not be changed by the caller!
+
+    If limit is set, only a page of at most limit items is returned. It
+    starts after the item whose key equals after, if this is given, and
+    otherwise at offset. The key of an artist is (sort key of name, id) and
+    the one of an album (sort key of name, id, artist name), see
+    metadata.sortkey. Since the ids are specific to a
+    database, after should only be used for a single database.
     """
-    def __init__(self, songdbid, filters=None):
+    def __init__(self, songdbid, filters=None, limit=None, offset=0, after=None):
         self.songdbid = songdbid
         self.filters = filters
+        self.limit = limit
+        self.offset = offset
+        self.after = after
 
     def __repr__(self):
+        if self.limit is not None:
+            return "%r(%r, limit=%r, offset=%r, after=%r)->%r" % (self.__class__.__name__, self.filters,
+                                                                self.limit, self.offset, self.after,
+                                                                self.songdbid)
         return "%r(%r)->%r" % (self.__class__.__name__, self.filters, self.songdbid)
 
 #
@@ -101,6 +138,37 @@ class getsong_metadata(dbrequestsingle):
         return "%r(%r)->%r" % (self.__class__.__name__, self.song_id, self.songdbid)
 
 
+class getsong_texts(dbrequestsingle):
+    """fetch comments and lyrics of song_id from database songdbid
+
+    The result is a tuple (comments, lyrics) of lists of (language, description, text) tuples.
+    """
+    def __init__(self, songdbid, song_id):
+        self.songdbid = songdbid
+        self.song_id = song_id
+
+    def __repr__(self):
+        return "%r(%r)->%r" % (self.__class__.__name__, self.song_id, self.songdbid)
+
+
+class getsongs_metadata(dbrequestsingle):
+    """fetch list of song metadata from database songdbid corresponding to the list song_ids
+
+    For songs not found in the database, the list contains None.
+    """
+    def __init__(self, songdbid, song_ids):
+        self.songdbid = songdbid
+        self.song_ids = song_ids
+
+    def __repr__(self):
+        return "%r(%r)->%r" % (self.__class__.__name__, self.song_ids, self.songdbid)
+
+
+class getsongfilesinfo(dbrequestsingle):
+    """return dictionary url -> (song, date_updated, size) for all songs in database songdbid"""
+    pass
+
+
 class gettag_id(dbrequestsingle):
     def __init__(self, songdbid, tag_name):
         self.songdbid = songdbid
@@ -122,6 +190,26 @@ class getlastplayedsongs(dbrequestsongs):
     pass
 
 
+class getrandomsongs(dbrequest):
+    """ return weighted random selection of at most number songs matching filters
+
+    The weights of the songs depend on their rating, play and skip counts and on
+    the time they have been played last. The selection stops as soon as the total
+    length of the songs exceeds length (in seconds), unless this is None.
+    The result is never cached.
+    """
+    def __init__(self, songdbid, filters=None, number=100, length=None, withmetadata=False):
+        self.songdbid = songdbid
+        self.filters = filters
+        self.number = number
+        self.length = length
+        self.withmetadata = withmetadata
+
+    def __repr__(self):
+        return "%r(%r, number=%r, length=%r)->%r" % (self.__class__.__name__, self.filters,
+                                                     self.number, self.length, self.songdbid)
+
+
 #
 # database requests which yield lists of other items
 #
@@ -179,6 +267,10 @@ class getnumberoftags(dbrequestnumber):
 class getnumberofratings(dbrequestnumber):
     pass
 
+class getsongsaggregates(dbrequestnumber):
+    """ return songsaggregates instance for the songs matching filters """
+    pass
+
 # autoregisterer request
 
 class autoregisterer_queryregistersong(dbrequest):
@@ -220,6 +312,18 @@ class getplaybackinfo(request):
         return "%r->%r" % (self.__class__.__name__, `self.playerid`)
 
 
+class getplayerstats(request):
+    """ request statistics about the audio output of player playerid
+
+    Returns services.player.playerstats instance or None, if the player
+    does not provide statistics."""
+    def __init__(self, playerid):
+        self.playerid = playerid
+
+    def __repr__(self):
+        return "%r->%r" % (self.__class__.__name__, `self.playerid`)
+
+
 class requestinput:
     def __init__(self, title, prompt, handler):
         self.title = title
@@ -22,13 +22,14 @@ import events, hub, log
 
 class service(threading.Thread):
 
-    def __init__(self, name, daemonize=False, hub=hub._defaulthub):
+    def __init__(self, name, daemonize=False, hub=hub._defaulthub, queuesize=0):
         threading.Thread.__init__(self)
         # as independent thread, we want our own event and request channel
-        # and need at least respond to a quit event
+        # and need at least respond to a quit event. If queuesize is positive,
+        # the number of queued background events and requests is limited.
         self.name = name
         self.setName("%s service" % name)
-        self.channel = hub.newchannel()
+        self.channel = hub.newchannel(name, queuesize)
         self.channel.subscribe(events.quit, self.quit)
         self.done = False
         self.setDaemon(daemonize)
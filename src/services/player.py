@@ -60,9 +60,12 @@ def initplayer(id, config):
                                         aodevice=driver,
                                         aooptions=aooptions,
                                         bufsize=config.bufsize,
+                                        minbufsize=config.minbufsize,
+                                        maxbufsize=config.maxbufsize,
                                         crossfading=config.crossfading,
                                         crossfadingstart=config.crossfadingstart,
                                         crossfadingduration=config.crossfadingduration,
+                                        decodeaheadbufsize=config.decodeaheadbufsize,
                                         )
         except:
             log.debug_traceback()
@@ -201,6 +204,33 @@ class playbackinfo:
         return self.crossfade and not self.state == STOP
 
 
+class playerstats:
+
+    """ statistics about the audio output of a player
+
+    All lengths of the audio buffer are given in seconds, latencies of
+    writes to the audio device in milliseconds. lowwatermark and
+    highwatermark are the lowest and highest fill level of the buffer
+    during playback, or None as long as they are not known.
+    latencies is a histogram of the durations of the device writes in
+    the form of a list of (upper bound, number of writes) tuples, where
+    the upper bound of the last bin is None.
+    """
+
+    def __init__(self, playerid, underruns, writes, bufferlength, minbufferlength, maxbufferlength,
+                 lowwatermark, highwatermark, latencies, maxlatency):
+        self.playerid = playerid
+        self.underruns = underruns
+        self.writes = writes
+        self.bufferlength = bufferlength
+        self.minbufferlength = minbufferlength
+        self.maxbufferlength = maxbufferlength
+        self.lowwatermark = lowwatermark
+        self.highwatermark = highwatermark
+        self.latencies = latencies
+        self.maxlatency = maxlatency
+
+
 class genericplayer(service.service):
     def __init__(self, id, playlistid, autoplay):
         """create a new player
@@ -246,6 +276,7 @@ class genericplayer(service.service):
         self.channel.subscribe(events.playerspeedreset, self.playerspeedreset)
 
         self.channel.supply(requests.getplaybackinfo, self.getplaybackinfo)
+        self.channel.supply(requests.getplayerstats, self.getplayerstats)
 
     def work(self):
         if self.isplaying():
@@ -382,6 +413,12 @@ class genericplayer(service.service):
         this method has to be implemented by specialized classes"""
         pass
 
+    def _playerstats(self):
+        """return playerstats instance or None if the player does not provide statistics
+
+        this method may be implemented by specialized classes"""
+        return None
+
     def _playerquit(self):
         """quit player
 
@@ -485,3 +522,9 @@ class genericplayer(service.service):
             raise hub.DenyRequest
         else:
             return self.playbackinfo
+
+    def getplayerstats(self, request):
+        if self.id != request.playerid:
+            raise hub.DenyRequest
+        else:
+            return self._playerstats()
@@ -17,15 +17,15 @@
 # along with PyTone; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import array
 import Queue
 import sys
 import threading
 import time
 
 import hub, events
-import pcm
 import decoder
-from services.player import genericplayer
+from services.player import genericplayer, playerstats
 import services.playlist
 import log
 
@@ -78,7 +78,14 @@ class ossaudiodev:
 
 
 class bufferedaudiodev(threading.Thread):
-    def __init__(self, aodevice, aooptions, bufsize, rate, SIZE):
+
+    # parameters of the adaptive buffering, see bufferedao.c
+    ADAPTINTERVAL = 5
+    SHRINKINTERVALS = 3
+    # upper bounds in milliseconds of the bins of the device latency histogram
+    LATENCYBINS = [1, 2, 5, 10, 20, 50, 100, 200, 500]
+
+    def __init__(self, aodevice, aooptions, bufsize, rate, SIZE, minbufsize=None, maxbufsize=None):
         self.aodevice = aodevice
         self.aooptions = aooptions
         self.rate = rate
@@ -87,9 +94,30 @@ class bufferedaudiodev(threading.Thread):
         # initially, we do not open the audio device
         self.audiodev = None
 
-        # output queue
-        queuesize = 1024*bufsize/self.SIZE + 1
-        self.queue = Queue.Queue(queuesize)
+        # output queue. We may only put depth items in it, where depth is
+        # adapted to the observed jitter between mindepth and maxdepth
+        if minbufsize is None or minbufsize > bufsize:
+            minbufsize = bufsize
+        if maxbufsize is None or maxbufsize < bufsize:
+            maxbufsize = bufsize
+        self.mindepth = max(1024*minbufsize/self.SIZE, 1)
+        self.depth = max(1024*bufsize/self.SIZE, self.mindepth)
+        self.maxdepth = max(1024*maxbufsize/self.SIZE, self.depth)
+        self.intervallength = max(self.ADAPTINTERVAL*self.rate*4/self.SIZE, 1)
+        self.calmintervals = 0
+        self.queue = Queue.Queue()
+        # condition protecting depth and the statistics, which is also
+        # used to wait until there is space in the queue
+        self.notfull = threading.Condition()
+
+        # statistics
+        self.underruns = 0
+        self.writes = 0
+        self.lowwatermark = None
+        self.highwatermark = None
+        self.latencies = [0] * (len(self.LATENCYBINS)+1)
+        self.maxlatency = 0
+        self._resetstream()
 
         self.done = False
         # wait if player thread is paused
@@ -130,30 +158,156 @@ class bufferedaudiodev(threading.Thread):
             self.audiodev = None
             openaudiodev.close()
             log.debug("audio device closed")
+        self.notfull.acquire()
+        try:
+            self._resetstream()
+        finally:
+            self.notfull.release()
+
+    # the following methods for the adaptive buffering and the statistics
+    # have to be called with self.notfull acquired
+
+    def _setdepth(self, depth):
+        self.depth = min(max(depth, self.mindepth), self.maxdepth)
+        self.calmintervals = 0
+
+    def _resetinterval(self, fill):
+        self.intervalpos = 0
+        self.intervalpeak = fill
+        self.intervaldrop = 0
+
+    def _resetstream(self):
+        """ mark output as interrupted, such that draining the queue is not an underrun """
+        self.streaming = False
+        self.starved = False
+        self.primed = False
+        self._resetinterval(0)
+
+    def _adaptdepth(self, fill):
+        """ account for the fill level of the queue, when an item is taken from it """
+        if not self.primed:
+            return
+        if self.lowwatermark is None or fill < self.lowwatermark:
+            self.lowwatermark = fill
+        if self.highwatermark is None or fill > self.highwatermark:
+            self.highwatermark = fill
+        if fill > self.intervalpeak:
+            self.intervalpeak = fill
+        else:
+            self.intervaldrop = max(self.intervaldrop, self.intervalpeak-fill)
+
+        self.intervalpos += 1
+        if self.intervalpos >= self.intervallength:
+            if 2*self.intervaldrop > self.depth:
+                self._setdepth(self.depth + self.depth//2 + 1)
+            elif 4*self.intervaldrop < self.depth:
+                self.calmintervals += 1
+                if self.calmintervals >= self.SHRINKINTERVALS:
+                    self._setdepth(self.depth - self.depth//4)
+            else:
+                self.calmintervals = 0
+            self._resetinterval(fill)
+
+    def _addlatency(self, latency):
+        """ account for a write to the audio device of duration latency in milliseconds """
+        for i in range(len(self.LATENCYBINS)):
+            if latency <= self.LATENCYBINS[i]:
+                break
+        else:
+            i = len(self.LATENCYBINS)
+        self.latencies[i] += 1
+        self.writes += 1
+        self.maxlatency = max(self.maxlatency, latency)
 
     def queuelen(self):
         """ return length of currently buffered PCM data in seconds"""
         return 1.0/4.0*self.queue.qsize()*self.SIZE/self.rate
 
+    def stats(self):
+        """ return dictionary with statistics about underruns, buffer fill levels and device latencies """
+        itemlength = 1.0/4.0*self.SIZE/self.rate
+        def watermark(fill):
+            if fill is not None:
+                return itemlength*fill
+        self.notfull.acquire()
+        try:
+            return { "underruns": self.underruns,
+                     "writes": self.writes,
+                     "bufferlength": itemlength*self.depth,
+                     "minbufferlength": itemlength*self.mindepth,
+                     "maxbufferlength": itemlength*self.maxdepth,
+                     "lowwatermark": watermark(self.lowwatermark),
+                     "highwatermark": watermark(self.highwatermark),
+                     "latencies": zip(self.LATENCYBINS + [None], self.latencies),
+                     "maxlatency": self.maxlatency }
+        finally:
+            self.notfull.release()
+
     def run(self):
         while not self.done:
             try:
                 if self.ispaused:
                     self.restart.wait()
                     self.restart.clear()
+                self.notfull.acquire()
+                try:
+                    if self.streaming and self.queue.empty():
+                        self.starved = True
+                finally:
+                    self.notfull.release()
                 buff, bytes = self.queue.get(1)
+                self.notfull.acquire()
+                try:
+                    self._adaptdepth(self.queue.qsize()+1)
+                finally:
+                    self.notfull.release()
                 if buff != 0 and bytes != 0:
                     audiodev = self.audiodev
                     while audiodev is None:
                         self.opendevice()
                         audiodev = self.audiodev
+                    starttime = time.time()
                     audiodev.play(buff, bytes)
+                    latency = 1000*(time.time()-starttime)
+                    self.notfull.acquire()
+                    try:
+                        self._addlatency(latency)
+                        # the audio device may have been released in the meantime
+                        if self.audiodev is not None:
+                            self.streaming = True
+                    finally:
+                        self.notfull.release()
+                self.notfull.acquire()
+                self.notfull.notify()
+                self.notfull.release()
             except:
                 log.warning("exception occured in bufferedaudiodev")
                 log.debug_traceback()
 
     def play(self, buff, bytes):
-        self.queue.put((buff, bytes))
+        self.notfull.acquire()
+        try:
+            while self.queue.qsize() >= self.depth:
+                self.notfull.wait()
+        finally:
+            self.notfull.release()
+        # the player reuses buff, so we have to copy it
+        self.queue.put((str(buffer(buff, 0, bytes)), bytes))
+        self.notfull.acquire()
+        try:
+            if self.starved:
+                # the queue ran empty while streaming, so we need more headroom
+                self.underruns += 1
+                self.starved = False
+                self.lowwatermark = 0
+                self._setdepth(2*self.depth)
+                self.primed = False
+                self._resetinterval(0)
+            elif not self.primed and self.queue.qsize() >= self.depth:
+                self.primed = True
+                self._resetinterval(self.queue.qsize())
+        finally:
+            self.notfull.release()
 
     def flush(self):
         while True:
@@ -161,6 +315,12 @@ class bufferedaudiodev(threading.Thread):
                 self.queue.get(0)
             except Queue.Empty:
                 break
+        self.notfull.acquire()
+        try:
+            self._resetstream()
+            self.notfull.notify()
+        finally:
+            self.notfull.release()
 
     def pause(self):
         self.ispaused = True
@@ -194,6 +354,7 @@ class decodedsong:
 
         # these method are handled by the decodedsong
         self.seekrelative = self.decodedsong.seekrelative
+        self.prefill = self.decodedsong.prefill
         self.playfaster = self.decodedsong.playfaster
         self.playslower = self.decodedsong.playslower
         self.resetplayspeed = self.decodedsong.resetplayspeed
@@ -201,12 +362,13 @@ class decodedsong:
     def __repr__(self):
         return "decodedsong(%r)" % repr(self.song)
 
-    def read(self, size):
-        # read decoded pcm stram and adjust for replaygain if necessary
-        buff = self.decodedsong.read(size)
-        if self.replaygain != 1:
-            pcm.scale(buff, self.replaygain)
-        return buff
+    def readinto(self, buff, start, end, volume=1, mixingratio=1, mixingrate=None):
+        # write decoded pcm stream into buff adjusting for replaygain and volume
+        return self.decodedsong.readinto(buff, start, end, self.replaygain*volume,
+                                         mixingratio, mixingrate)
+
+    def prebufferedbytes(self):
+        return self.decodedsong.prebufferedbytes
 
     def succeedsonalbum(self, otherdecodedsong):
         " checks whether otherdeocedsong follows self on the same album "
@@ -249,11 +411,125 @@ class decodedsong:
         return self.decodedsong.ptime
 
 
+class decodeahead(threading.Thread):
+
+    """ thread opening and pre-decoding the song to be played next
+
+    The player announces the playlist item which it expects to play next
+    via prepare. The decodeahead thread then opens the song and decodes
+    up to maxbytes of it in the background, such that the player can later
+    take over the decodedsong without having to wait for any file I/O.
+    """
+
+    def __init__(self, rate, maxbytes):
+        self.rate = rate
+        self.maxbytes = maxbytes
+
+        # queue of playlist items to be prepared
+        self.queue = Queue.Queue()
+
+        # the condition protects the currently prepared playlist item, the
+        # corresponding decodedsong (which is None, if the song could not be opened)
+        # and the flag busy, which is set while the song is being opened or decoded
+        self.condition = threading.Condition()
+        self.playlistitem = None
+        self.decodedsong = None
+        self.busy = False
+
+        self.done = False
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+    def _setbusy(self, busy):
+        self.condition.acquire()
+        try:
+            self.busy = busy
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def _open(self, playlistitem):
+        self.condition.acquire()
+        try:
+            if playlistitem is self.playlistitem:
+                return
+            self.playlistitem = playlistitem
+            self.decodedsong = None
+            self.busy = True
+        finally:
+            self.condition.release()
+        # the file I/O is done without holding the lock, such that the player
+        # only has to wait for it, if it wants to take over this very song
+        try:
+            try:
+                self.decodedsong = decodedsong(playlistitem, self.rate, ["track"])
+                log.debug("decodeahead: song opened: %r" % self.decodedsong)
+            except:
+                # leave it to the player to report the failure
+                log.debug_traceback()
+        finally:
+            self._setbusy(False)
+
+    def _prefill(self, playlistitem):
+        # decode chunk by chunk to let the player take over at any time
+        while not self.done and self.queue.empty():
+            self.condition.acquire()
+            try:
+                decodedsong = self.decodedsong
+                if ( playlistitem is not self.playlistitem or decodedsong is None or
+                     decodedsong.prebufferedbytes() >= self.maxbytes ):
+                    return
+                self.busy = True
+            finally:
+                self.condition.release()
+            try:
+                try:
+                    if not decodedsong.prefill():
+                        return
+                except:
+                    log.debug_traceback()
+                    return
+            finally:
+                self._setbusy(False)
+
+    def run(self):
+        while not self.done:
+            playlistitem = self.queue.get()
+            # only the most recently announced playlist item is of interest
+            while not self.queue.empty():
+                playlistitem = self.queue.get()
+            if playlistitem is not None:
+                self._open(playlistitem)
+                self._prefill(playlistitem)
+
+    def prepare(self, playlistitem):
+        self.queue.put(playlistitem)
+
+    def take(self, playlistitem):
+        """ return decodedsong prepared for playlistitem or None """
+        self.condition.acquire()
+        try:
+            if playlistitem is not self.playlistitem:
+                return None
+            # if the song is still being opened or decoded, we wait for it
+            while self.busy:
+                self.condition.wait()
+            result = self.decodedsong
+            self.playlistitem = self.decodedsong = None
+            return result
+        finally:
+            self.condition.release()
+
+    def quit(self):
+        self.done = True
+        self.queue.put(None)
+
+
 
 class player(genericplayer):
 
-    def __init__(self, id, playlistid, autoplay, aodevice, aooptions, bufsize,
-                 crossfading, crossfadingstart, crossfadingduration):
+    def __init__(self, id, playlistid, autoplay, aodevice, aooptions, bufsize, minbufsize, maxbufsize,
+                 crossfading, crossfadingstart, crossfadingduration, decodeaheadbufsize):
         self.rate = 44100
         self.SIZE = 4096
         self.volume = 1
@@ -261,18 +537,23 @@ class player(genericplayer):
 
         # use C version of buffered audio device if present
         if bufferedao_present:
-            self.audiodev = bufferedao.bufferedao(bufsize, self.SIZE, aodevice, byte_format=4, rate=self.rate, options=aooptions)
+            self.audiodev = bufferedao.bufferedao(bufsize, self.SIZE, aodevice, byte_format=4, rate=self.rate, options=aooptions,
+                                                  minbufsize=minbufsize, maxbufsize=maxbufsize)
             # we have to start a new thread for the bufferedao device
             thread.start_new(self.audiodev.start, ())
             log.debug("bufferedao device opened")
         else:
             # create audio device thread
-            self.audiodev = bufferedaudiodev(aodevice, aooptions, bufsize, self.rate, self.SIZE)
+            self.audiodev = bufferedaudiodev(aodevice, aooptions, bufsize, self.rate, self.SIZE,
+                                             minbufsize, maxbufsize)
             self.audiodev.start()
 
         # songs currently playing
         self.decodedsongs = []
 
+        # output buffer, which is reused for every chunk of pcm data
+        self.buff = array.array("c", "\0"*self.SIZE)
+
         self.crossfading = crossfading
         if self.crossfading:
             # crossfading parameters (all values in seconds and change/second, resp.)
@@ -287,6 +568,14 @@ class player(genericplayer):
 
         genericplayer.__init__(self, id, playlistid, autoplay)
 
+        # thread opening and pre-decoding the next song of the playlist
+        if playlistid is not None and decodeaheadbufsize > 0:
+            self.decodeahead = decodeahead(self.rate, 1024*decodeaheadbufsize)
+            self.decodeahead.start()
+            self.channel.subscribe(events.playlistchanged, self.playlistchanged)
+        else:
+            self.decodeahead = None
+
     def _flushqueue(self):
         """ delete internal player queue and flush audiodevice """
         self.decodedsongs = []
@@ -299,13 +588,13 @@ class player(genericplayer):
         # unpause buffered ao if necessary
         self.audiodev.unpause()
 
+        volume = self._volume_scale**(1-self.volume)
+
         if len(self.decodedsongs) == 1:
             song = self.decodedsongs[0]
-            buff = song.read(self.SIZE)
-            if len(buff) > 0:
-                if self.volume != 1:
-                    pcm.scale(buff, self._volume_scale**(1-self.volume))
-                self.audiodev.play(buff, len(buff))
+            bytes, mixingratio = song.readinto(self.buff, 0, self.SIZE, volume)
+            if bytes > 0:
+                self.audiodev.play(self.buff, bytes)
             else:
                 log.debug("internal player: song ends: %r (0 songs in queue)" % self.decodedsongs[0])
                 del self.decodedsongs[0]
@@ -313,59 +602,51 @@ class player(genericplayer):
             # reset songtransition mode, but before possibly requesting a new song
             self.songtransitionmode = None
 
-            if len(buff) == 0 or (self.crossfading and song.rtime() < self.crossfadingstart):
+            if bytes == 0 or (self.crossfading and song.rtime() < self.crossfadingstart):
                 self.requestnextsong()
 
         elif len(self.decodedsongs) == 2:
             if self.songtransitionmode == "crossfade":
-                # perform crossfading
-                buff1 = self.decodedsongs[0].read(self.SIZE)
-                buff2 = self.decodedsongs[1].read(self.SIZE)
-
-                if len(buff1) and len(buff2):
-                    # normal operation: no song has ended
-                    buff, self.crossfadingratio = pcm.mix(buff1, buff2,
-                                                          self.crossfadingratio,
-                                                          self.crossfadingrate)
-                    if self.crossfadingratio >= 1:
-                        self.crossfadingratio = 0
-                        log.debug("internal player: song ends: %r (1 song in queue)" %
-                              self.decodedsongs[0])
-                        del self.decodedsongs[0]
-                if len(buff1) == 0:
-                    buff = buff2
+                # perform crossfading: mix the new song into the old one as long as
+                # the latter lasts and continue with the new one only afterwards
+                bytes1, mixingratio = self.decodedsongs[0].readinto(self.buff, 0, self.SIZE, volume)
+                bytes2, self.crossfadingratio = self.decodedsongs[1].readinto(self.buff, 0, bytes1, volume,
+                                                                              self.crossfadingratio,
+                                                                              self.crossfadingrate)
+                if bytes2 == bytes1 and bytes1 < self.SIZE:
+                    bytes2, mixingratio = self.decodedsongs[1].readinto(self.buff, bytes1, self.SIZE, volume)
+                bytes = max(bytes1, bytes2)
+
+                if bytes1 < self.SIZE or self.crossfadingratio >= 1:
                     self.crossfadingratio = 0
                     log.debug("internal player: song ends: %r (1 song in queue)" % self.decodedsongs[0])
                     del self.decodedsongs[0]
-                if len(buff2) == 0:
-                    buff = buff1
+                elif bytes2 < bytes1:
                     self.crossfadingratio = 0
                     log.debug("internal player: song ends: %r" % self.decodedsongs[-1])
                     del self.decodedsongs[-1]
                     log.debug("internal player: %d songs in queue" % len(self.decodedsongs))
             elif self.songtransitionmode == "gapkill":
                 # just kill gap between songs
-                buff = self.decodedsongs[0].read(self.SIZE)
-                if len(buff) < self.SIZE:
+                bytes, mixingratio = self.decodedsongs[0].readinto(self.buff, 0, self.SIZE, volume)
+                if bytes < self.SIZE:
                     log.debug("internal player: song ends: %r (1 song in queue)" % self.decodedsongs[0])
                     del self.decodedsongs[0]
 
-                    buff2 = self.decodedsongs[0].read(self.SIZE)
-                    if len(buff2) == 0:
+                    bytes2, mixingratio = self.decodedsongs[0].readinto(self.buff, bytes, self.SIZE, volume)
+                    if bytes2 == bytes:
                         log.debug("internal player: song ends: %r" % self.decodedsongs[0])
                         del self.decodedsongs[0]
                         log.debug("internal player: %d songs in queue" % len(self.decodedsongs))
                     else:
-                        buff = buff + buff2
+                        bytes = bytes2
             else:
                 # neither crossfading nor gap killing
                 del self.decodedsongs[0]
-                buff = self.decodedsongs[0].read(self.SIZE)
+                bytes, mixingratio = self.decodedsongs[0].readinto(self.buff, 0, self.SIZE, volume)
 
-            if len(buff) > 0:
-                if self.volume != 1:
-                    pcm.scale(buff, self._volume_scale**(1-self.volume))
-                self.audiodev.play(buff, len(buff))
+            if bytes > 0:
+                self.audiodev.play(self.buff, bytes)
 
         # update playbackinfo
 
@@ -397,7 +678,12 @@ class player(genericplayer):
             del self.decodedsongs[0]
 
         try:
-            self.decodedsongs.append(decodedsong(song, self.rate, ["track"]))
+            nextdecodedsong = None
+            if self.decodeahead and isinstance(song, services.playlist.playlistitem):
+                nextdecodedsong = self.decodeahead.take(song)
+            if nextdecodedsong is None:
+                nextdecodedsong = decodedsong(song, self.rate, ["track"])
+            self.decodedsongs.append(nextdecodedsong)
             if self.crossfading:
                 self.songtransitionmode = "crossfade"
                 # Check whether two songs come after each other on an
@@ -453,5 +739,19 @@ class player(genericplayer):
     def _playerreleasedevice(self):
         self.audiodev.closedevice()
 
+    def _playerstats(self):
+        return playerstats(self.id, **self.audiodev.stats())
+
     def _playerquit(self):
         self.audiodev.quit()
+        if self.decodeahead:
+            self.decodeahead.quit()
+
+    # event handlers
+
+    def playlistchanged(self, event):
+        # prepare the first song in the playlist which has not yet been played
+        for playlistitem in list(event.items):
+            if not playlistitem.hasbeenplayed():
+                self.decodeahead.prepare(playlistitem)
+                break
@@ -42,6 +42,7 @@ class player(service.service):
 
         # provide player service
         self.channel.subscribe(events.playerevent, self.playerevent)
+        self.channel.supply(requests.getplayerstats, self.getplayerstats)
         
         # we also provide a playlist service
         self.channel.subscribe(events.playlistevent, self.playlistevent)
@@ -70,3 +71,11 @@ class player(service.service):
 
     def playlistgetcontents(self, request):
         return self.networkchannel.request(request)
+
+    def getplayerstats(self, request):
+        if request.playerid != self.id:
+            raise hub.DenyRequest
+        # we have to copy the request, because another thread may also access it
+        request = copy.copy(request)
+        request.playerid = self.remoteplayerid
+        return self.networkchannel.request(request)
@@ -486,9 +486,9 @@ class playlist(service.service):
             if not nextitem:
                 if self.autoplaymode == "random":
                     # add some randomly selected song to the end of the playlist
-                    randomsongs = hub.request(requests.getsongs("main", random=True))
+                    randomsongs = hub.request(requests.getrandomsongs("main", number=1))
                     if randomsongs:
-                        self._addsongs(randomsongs[0:1])
+                        self._addsongs(randomsongs)
                         nextitem = self._playnext()
                 elif self.autoplaymode == "repeat":
                     self._markallunplayed()
@@ -0,0 +1,275 @@
+# -*- coding: ISO-8859-1 -*-
+
+# Copyright (C) 2007 Jrg Lehmann <joerg@luga.de>
+#
+# This file is part of PyTone (http://www.luga.de/pytone/)
+#
+# PyTone is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2
+# as published by the Free Software Foundation.
+#
+# PyTone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyTone; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import sys
+
+#
+# estimation of the memory footprint of request results
+#
+
+# maximal number of list elements which are inspected when estimating
+# the size of a list
+_samplesize = 16
+
+# mapping class -> list of descriptors of the slots of the class and its base classes
+_slotdescriptors = {}
+
+def _getslotdescriptors(cls):
+    try:
+        return _slotdescriptors[cls]
+    except KeyError:
+        descriptors = []
+        for base in getattr(cls, "__mro__", ()):
+            slots = base.__dict__.get("__slots__", [])
+            if isinstance(slots, basestring):
+                slots = [slots]
+            descriptors.extend([base.__dict__[name] for name in slots if name not in ("__dict__", "__weakref__")])
+        _slotdescriptors[cls] = descriptors
+        return descriptors
+
+def _sizeof(obj, depth):
+    """ return size of obj in bytes including the objects it refers to
+    up to the given depth """
+    size = sys.getsizeof(obj)
+    if depth > 0:
+        if isinstance(obj, (list, tuple)):
+            for x in obj:
+                size += _sizeof(x, depth-1)
+        elif isinstance(obj, dict):
+            for key, value in obj.iteritems():
+                size += _sizeof(key, depth-1) + _sizeof(value, depth-1)
+        else:
+            # Note that we must not use getattr here, since item.song
+            # instances would then try to fetch their metadata
+            d = getattr(obj, "__dict__", None)
+            if d is not None:
+                size += sys.getsizeof(d)
+                for value in d.itervalues():
+                    size += _sizeof(value, depth-1)
+            for descriptor in _getslotdescriptors(type(obj)):
+                try:
+                    value = descriptor.__get__(obj)
+                except AttributeError:
+                    # slot not set
+                    continue
+                size += _sizeof(value, depth-1)
+    return size
+
+
+def estimatesize(result):
+    """ return tuple (number of objects, estimated size in bytes) of result
+
+    For lists and tuples, the size of the elements is extrapolated from
+    an evenly spaced sample of the list items. For songs, the size of
+    already attached metadata is taken into account.
+    """
+    if isinstance(result, (list, tuple)):
+        n = len(result)
+        size = sys.getsizeof(result)
+        if n:
+            sample = result[::max(1, n // _samplesize)]
+            size += n * sum([_sizeof(x, 3) for x in sample]) // len(sample)
+        return n + 1, size
+    else:
+        return 1, _sizeof(result, 3)
+
+#
+# least recently used cache
+#
+
+class _entry(object):
+
+    """ entry of the request cache, which is also a node in the doubly
+    linked list ordered by the time of the last access """
+
+    __slots__ = ["key", "request", "result", "dependencies", "nobjects", "size", "prev", "next"]
+
+    def __init__(self, key, request, result, dependencies, nobjects, size):
+        self.key = key
+        self.request = request
+        self.result = result
+        self.dependencies = dependencies
+        self.nobjects = nobjects
+        self.size = size
+        self.prev = self.next = None
+
+
+class _segment:
+
+    """ entries of the request cache belonging to one songdbid """
+
+    def __init__(self):
+        self.keys = set()
+        self.size = 0
+
+
+class requestcache:
+
+    """ least recently used cache for the results of database requests
+
+    The cache is bounded both by the total number of objects contained in
+    the cached results and by their estimated memory footprint. A maximal
+    value of 0 turns the corresponding limit off. Lookup, insertion and
+    eviction of an entry take constant time.
+
+    Entries are grouped in segments, one for each songdbid of the
+    requests (including None for requests spanning all databases), such
+    that all results for a given database can be dropped at once.
+    """
+
+    def __init__(self, maxobjects, maxbytes):
+        self.maxobjects = maxobjects
+        self.maxbytes = maxbytes
+        # mapping key -> _entry
+        self.entries = {}
+        # mapping songdbid -> _segment
+        self.segments = {}
+        # sentinel of the doubly linked list of entries: root.next is the
+        # least recently used entry, root.prev the most recently used one
+        self.root = _entry(None, None, None, None, 0, 0)
+        self.root.prev = self.root.next = self.root
+        # current number of objects and bytes referred to by the cache
+        self.nobjects = 0
+        self.size = 0
+        # cache use statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _key(self, request):
+        # Every dbrequest is hashable via its representation. Using the
+        # representation itself as key prevents hash collisions.
+        return repr(request)
+
+    def _link(self, entry):
+        """ insert entry as most recently used one in the linked list """
+        last = self.root.prev
+        entry.prev = last
+        entry.next = self.root
+        last.next = self.root.prev = entry
+
+    def _unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+        entry.prev = entry.next = None
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self.entries[entry.key]
+        self.nobjects -= entry.nobjects
+        self.size -= entry.size
+        songdbid = entry.request.songdbid
+        segment = self.segments[songdbid]
+        segment.keys.discard(entry.key)
+        segment.size -= entry.size
+        if not segment.keys:
+            del self.segments[songdbid]
+
+    def _isfull(self):
+        return ( (self.maxobjects and self.nobjects > self.maxobjects) or
+                 (self.maxbytes and self.size > self.maxbytes) )
+
+    def get(self, request):
+        """ return cached result of request or raise KeyError """
+        try:
+            entry = self.entries[self._key(request)]
+        except KeyError:
+            self.misses += 1
+            raise
+        self._unlink(entry)
+        self._link(entry)
+        self.hits += 1
+        return entry.result
+
+    def put(self, request, result, dependencies=None):
+        """ store result of request, evicting least recently used entries if necessary
+
+        Optionally, a description of the dependencies of the result can be
+        stored alongside, which can be used to decide which entries have
+        to be discarded when the underlying data changes. Note that request
+        must not be changed by the caller afterwards.
+        """
+        key = self._key(request)
+        if key in self.entries:
+            self._remove(self.entries[key])
+        nobjects, size = estimatesize(result)
+        if dependencies is not None:
+            size += _sizeof(dependencies, 1)
+        if ( (self.maxobjects and nobjects > self.maxobjects) or
+             (self.maxbytes and size > self.maxbytes) ):
+            # the result alone would exceed the cache size
+            return
+        entry = _entry(key, request, result, dependencies, nobjects, size)
+        self.entries[key] = entry
+        self._link(entry)
+        self.nobjects += nobjects
+        self.size += size
+        segment = self.segments.setdefault(request.songdbid, _segment())
+        segment.keys.add(key)
+        segment.size += size
+
+        while self._isfull():
+            self._remove(self.root.next)
+            self.evictions += 1
+
+    def clear(self):
+        """ remove all entries """
+        self.entries = {}
+        self.segments = {}
+        self.root.prev = self.root.next = self.root
+        self.nobjects = 0
+        self.size = 0
+
+    def clearsegment(self, songdbid):
+        """ remove all entries of requests for the database songdbid """
+        segment = self.segments.get(songdbid)
+        if segment is not None:
+            for key in list(segment.keys):
+                self._remove(self.entries[key])
+
+    def getentries(self, songdbid):
+        """ return list of entries of requests for the database songdbid
+
+        The attributes request, result and dependencies of the entries may be
+        inspected, but must not be changed. """
+        segment = self.segments.get(songdbid)
+        if segment is None:
+            return []
+        return [self.entries[key] for key in segment.keys]
+
+    def discard(self, entry):
+        """ remove entry obtained via getentries, if still present """
+        if self.entries.get(entry.key) is entry:
+            self._remove(entry)
+
+    def purge(self, predicate):
+        """ remove all entries whose request fulfills predicate """
+        for entry in self.entries.values():
+            if predicate(entry.request):
+                self._remove(entry)
+
+    def segmentstats(self):
+        """ return dictionary songdbid -> (number of entries, size in bytes) """
+        result = {}
+        for songdbid, segment in self.segments.items():
+            result[songdbid] = len(segment.keys), segment.size
+        return result
@@ -17,14 +17,62 @@
 # along with PyTone; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import copy, gc, math, random, service, time
+import copy, heapq, random, service
 import config
 import events, hub, requests
 import metadata
 import item
 import log
+import requestcache
 
-# helper function for the random selection of songs
+# helper functions for merging the results of several databases
+
+class _cmpwrapper:
+    """ wrapper making an item comparable according to cmpfunc """
+    def __init__(self, item, cmpfunc):
+        self.item = item
+        self.cmpfunc = cmpfunc
+    def __cmp__(self, other):
+        return self.cmpfunc(self.item, other.item)
+
+
+def _mergesorted(lists, cmpfunc):
+    """ k-way merge of the lists, each of which is sorted according to cmpfunc
+
+    Items comparing equal are taken from the lists in the given order.
+    """
+    heap = [(_cmpwrapper(l[0], cmpfunc), i, 0) for i, l in enumerate(lists) if l]
+    heapq.heapify(heap)
+    result = []
+    while heap:
+        k, i, j = heap[0]
+        l = lists[i]
+        result.append(l[j])
+        j += 1
+        if j < len(l):
+            heapq.heapreplace(heap, (_cmpwrapper(l[j], cmpfunc), i, j))
+        else:
+            heapq.heappop(heap)
+    return result
+
+
+def _interleave(lists):
+    """ merge the lists by taking one item of each of them in turn
+
+    Every prefix of the result consists of prefixes of the lists, such that
+    a page of the result can be computed from the first items of each list.
+    """
+    result = []
+    for j in range(max([len(l) for l in lists])):
+        for l in lists:
+            if j < len(l):
+                result.append(l[j])
+    return result
+
+
+def _cmpnames(x, y):
+    """ compare artists, albums, tags, etc. like the databases sort them """
+    return cmp(metadata.sortkey(getattr(x, "name", None)), metadata.sortkey(getattr(y, "name", None)))
 
 
 #
@@ -33,13 +81,120 @@ import log
 
 class songdbmanagerstats:
     def __init__(self, songdbsstats, requestcachesize, requestcachemaxsize,
-                 requestcacherequests, requestcachehits, requestcachemisses):
+                 requestcacherequests, requestcachehits, requestcachemisses,
+                 requestcachebytes, requestcachemaxbytes, requestcacheevictions,
+                 requestcachesegments):
         self.songdbsstats = songdbsstats
         self.requestcachesize = requestcachesize
         self.requestcachemaxsize = requestcachemaxsize
         self.requestcacherequests = requestcacherequests
         self.requestcachehits = requestcachehits
         self.requestcachemisses = requestcachemisses
+        self.requestcachebytes = requestcachebytes
+        self.requestcachemaxbytes = requestcachemaxbytes
+        self.requestcacheevictions = requestcacheevictions
+        # mapping songdbid -> (number of cached requests, size in bytes)
+        self.requestcachesegments = requestcachesegments
+
+#
+# dependencies of cached request results
+#
+
+# groups of song metadata fields, a change of which affects request results
+# in a similar way
+_fieldgroups = { "playstats": ["playcount", "date_lastplayed", "dates_played"],
+                 "skipstats": ["skipcount"],
+                 "rating": ["rating"],
+                 "tags": ["tags"],
+                 "structure": ["artist", "album", "album_artist", "compilation"] }
+# all other fields belong to the group "info"
+
+def changedfieldgroups(oldsong_metadata, newsong_metadata):
+    """ return set of groups of fields which differ in the two song metadata instances """
+    fields = {}
+    for field in oldsong_metadata.__dict__.keys() + newsong_metadata.__dict__.keys():
+        fields[field] = "info"
+    for group, groupfields in _fieldgroups.items():
+        for field in groupfields:
+            fields[field] = group
+    result = set()
+    for field, group in fields.items():
+        if group not in result and getattr(oldsong_metadata, field, None) != getattr(newsong_metadata, field, None):
+            result.add(group)
+    return result
+
+
+class resultdependencies:
+
+    """ description of the parts of a song database a cached request result depends on
+
+    - songids: frozenset of the ids of the songs contained in the result,
+      if the result is a list of songs, otherwise None
+    - fieldgroups: set of groups of song metadata fields, a change of which
+      may alter the result (see _fieldgroups)
+    - tagnames: set of names of tags, adding or removing of which to a song
+      may alter the result
+    - filters: filters of the request
+    """
+
+    def __init__(self, request, result):
+        self.songids = None
+        self.fieldgroups = set()
+        self.tagnames = set()
+        self.filters = getattr(request, "filters", None)
+
+        if isinstance(request, requests.dbrequestsongs):
+            if result:
+                self.songids = frozenset([song.id for song in result])
+            else:
+                self.songids = frozenset()
+            if request.sort:
+                sort = request.sort.SQL_string()
+                # the order of the songs may change
+                self.fieldgroups.add("info")
+                if "playcount" in sort or "date_lastplayed" in sort or "playstats" in sort:
+                    self.fieldgroups.add("playstats")
+            if isinstance(request, requests.getlastplayedsongs):
+                self.fieldgroups.add("playstats")
+        elif isinstance(request, (requests.getartists, requests.getalbums,
+                                  requests.getnumberofartists, requests.getnumberofalbums)):
+            self.fieldgroups.add("structure")
+        elif isinstance(request, (requests.gettags, requests.getnumberoftags)):
+            self.fieldgroups.add("tags")
+        elif isinstance(request, (requests.getratings, requests.getnumberofratings)):
+            self.fieldgroups.add("rating")
+        elif isinstance(request, requests.getsongsaggregates):
+            self.fieldgroups.add("info")
+            self.fieldgroups.add("playstats")
+
+        for filter in self.filters or []:
+            if isinstance(filter, item.tagfilter):
+                self.tagnames.add(filter.tag_name)
+            elif isinstance(filter, item.ratingfilter):
+                self.fieldgroups.add("rating")
+            elif isinstance(filter, item.playedsongsfilter):
+                self.fieldgroups.add("playstats")
+            elif isinstance(filter, item.urlfilter):
+                self.fieldgroups.add("info")
+                self.fieldgroups.add("structure")
+            elif isinstance(filter, item.searchfilter):
+                # the full text search index also covers the tags
+                self.fieldgroups.add("info")
+                self.fieldgroups.add("structure")
+                self.fieldgroups.add("tags")
+            elif isinstance(filter, (item.artistfilter, item.noartistfilter,
+                                     item.albumfilter, item.compilationfilter)):
+                self.fieldgroups.add("structure")
+
+    def contains(self, song_id):
+        return self.songids is not None and song_id in self.songids
+
+    def dependson(self, fieldgroups, tagnames):
+        return bool(self.fieldgroups & fieldgroups or self.tagnames & tagnames)
+
+    def maymatch(self, song):
+        """ return whether song could be contained in the result """
+        return self.filters is None or self.filters.maymatch(song)
 
 #
 # the song database manager class
@@ -58,23 +213,22 @@ class songdbmanager(service.service):
     """
 
     def __init__(self):
-        service.service.__init__(self, "songdb manager")
+        # Background events and requests, for instance from the song autoregisterer,
+        # are only queued up to the given number, further ones have to wait.
+        service.service.__init__(self, "songdb manager", queuesize=config.database.queuesize)
 
         # hub for the various song databases
         self.songdbhub = hub.hub()
 
         # list of registered songdbs
         self.songdbids = []
+        # songdbs among them, which are accessed via the network
+        self.remotesongdbids = []
 
-        # result cache containing a mapping hash(request) -> (request, result, lastaccess)
-        self.requestcache = {}
-        # maximal number of objects referred by request cache
-        self.requestcachemaxsize = config.database.requestcachesize
-        # cache use statististics
-        self.requestcachehits = 0
-        self.requestcachemisses = 0
-        # current number of objects referred to by items in result cache
-        self.requestcachesize = 0 
+        # least recently used cache for the request results, bounded by the maximal
+        # number of objects and the maximal memory (given in kB) referred to by it
+        self.requestcache = requestcache.requestcache(config.database.requestcachesize,
+                                                      1024*config.database.requestcachememory)
 
         # we are a database service provider...
         self.channel.supply(requests.dbrequestsingle, self.dbrequestsingle)
@@ -86,6 +240,8 @@ class songdbmanager(service.service):
         self.channel.supply(requests.getnumberofartists, self.getnumberofartists)
         self.channel.supply(requests.getnumberoftags, self.getnumberoftags)
         self.channel.supply(requests.getnumberofratings, self.getnumberofratings)
+        self.channel.supply(requests.getsongsaggregates, self.getsongsaggregates)
+        self.channel.supply(requests.getrandomsongs, self.getrandomsongs)
 
         # and need to be informed about database changes
         self.channel.subscribe(events.dbevent, self.dbevent)
@@ -95,7 +251,7 @@ class songdbmanager(service.service):
 
     def resetafterexception(self):
         # when an exception occurs, we clear the cache
-        self.requestcache = {}
+        self.requestcache.clear()
 
     def addsongdb(self, id, config):
         """ add songdb with id defined by config
@@ -119,6 +275,8 @@ class songdbmanager(service.service):
                 raise RuntimeError("Unkown metadata postprocesor '%s' for database '%r'" % (postprocessor_name, id))
 
         self.songdbids.append(id)
+        if type=="remote":
+            self.remotesongdbids.append(id)
         songdb.setName("song database thread (id=%s)" % id)
         songdb.start()
         if config.autoregisterer:
@@ -133,160 +291,207 @@ class songdbmanager(service.service):
         """ method decorator which caches results of the request """
         def newrequesthandler(self, request):
             log.debug("dbrequest cache: query for request: %r" % request)
-            requesthash = hash(request)
-            log.debug("dbrequest cache: sucessfully hashed request: %d" % requesthash)
             try:
-                # try to get the result from the cache
-                result = self.requestcache[requesthash][0]
-                # update atime
-                self.requestcache[requesthash][2] = time.time()
-                self.requestcachehits += 1
+                result = self.requestcache.get(request)
                 log.debug("dbrequest cache: hit for request: %r" % request)
             except KeyError:
                 # make a copy of request for later storage in cache
                 requestcopy = copy.copy(request)
                 result = requesthandler(self, request)
-                resultnoobjects = len(gc.get_referents(result)) + 1
-                self.requestcache[requesthash] = [result, requestcopy, time.time(), resultnoobjects]
-                self.requestcachemisses += 1
-                self.requestcachesize += resultnoobjects
-                # remove least recently used items from cache
-                if self.requestcachesize > self.requestcachemaxsize:
-                    log.debug("dbrequest cache: purging old items")
-                    cachebytime = [(item[2], key) for key, item in self.requestcache.items()]
-                    cachebytime.sort()
-                    for atime, key in cachebytime[-10:]:
-                        self.requestcachesize -= self.requestcache[key][3]
-                        del self.requestcache[key]
+                self.requestcache.put(requestcopy, result, resultdependencies(requestcopy, result))
                 log.debug("db request cache miss for request: %r (%d requests and %d objects cached)" %
-                          (request, len(self.requestcache), self.requestcachesize))
+                          (request, len(self.requestcache), self.requestcache.nobjects))
             return result
         return newrequesthandler
 
-    def _genrandomchoice(self, songs):
-        """ returns random selection of songs up to the maximal length
-        configured. Note that this method changes as a side-effect the
-        parameter songs"""
-
-        # consider trivial case separately
-        if not songs:
-            return []
-
-        # choose item, avoiding duplicates. Stop after a predefined
-        # total length (in seconds). Take rating of songs/albums/artists
-        # into account
-        length = 0
-        result = []
-
-        # generate an initial random sample of large enough size samplesize 
-        # to choose from
-        samplesize = min(100, len(songs))
-        sample = random.sample(songs, samplesize)
-        currenttime = time.time()
-
-        # relative percentage of songs accepted with a given rating
-        ratingdistribution = [5, 10, 20, 30, 35]
-
-        # normalize distribution
-        normfactor = float(sum(ratingdistribution))
-        ratingdistribution = [x/normfactor for x in ratingdistribution]
-
-        # scale for rating reduction: for playing times longer
-        # ago than lastplayedscale seconds, the rating is not
-        # influenced.
-        lastplayedscale = 60.0 * 60 * 24
-
-        while length < config.general.randominsertlength:
-            for song in sample:
-                # we have to query the song from our databases 
-                # since otherwise this is done automatically leading to
-                # a deadlock
-                if song.song_metadata is None:
-                    song.song_metadata = self.songdbhub.request(requests.getsong_metadata(song.songdbid, song.id))
-                    # if the song has been deleted in the meantime, we proceed to the next one
-                    if song.song_metadata is None:
-                        continue
-                if song.rating:
-                    rating = song.rating
-                else:
-                    # punish skipped songs if they have not been rated
-                    rating = min(5, max(1, 3 + max(0, 0.5*(song.playcount - song.skipcount))))
-                if song.date_lastplayed:
-                    # Simple heuristic algorithm to consider song ratings
-                    # for random selection. Certainly not optimal!
-                    last = max(0, (currenttime-song.date_lastplayed)/60)
-                    rating -= 2 * math.exp(-last/lastplayedscale)
-                    if rating < 1:
-                        rating = 1
-                if rating == 5:
-                    threshold = ratingdistribution[4]
-                else:
-                    # get threshold by linear interpolation
-                    intpart = int(rating)
-                    rest = rating-intpart
-                    threshold = (ratingdistribution[intpart-1] +
-                                 (ratingdistribution[intpart] - ratingdistribution[intpart-1])*rest)
-                if random.random() <= threshold or len(sample) == 1:
-                    result.append(song)
-                    length += song.length
-                    if length >= config.general.randominsertlength or len(result) >= samplesize:
-                        return result
-            # recreate sample without already chosen songs, if we ran out of songs
-            sample = [song for song in sample if song not in result]
-        return result
-
+    def _attachmetadata(self, songs):
+        """ fetch and attach the metadata of all songs which do not yet carry it
 
-    def selectrandom(requesthandler):
-        """ method decorator which returns a random selection of the request result if requested
+        Only one request is issued per database, irrespective of the number of songs.
+        """
+        songsbydb = {}
+        for song in songs:
+            if song.song_metadata is None:
+                songsbydb.setdefault(song.songdbid, []).append(song)
+        for songdbid, dbsongs in songsbydb.items():
+            if songdbid not in self.songdbids:
+                log.error("songdbmanager: invalid songdbid '%r' for song" % songdbid)
+                continue
+            songs_metadata = self.songdbhub.request(requests.getsongs_metadata(songdbid,
+                                                                               [song.id for song in dbsongs]))
+            for song, song_metadata in zip(dbsongs, songs_metadata):
+                song.song_metadata = song_metadata
+
+    def fetchmetadata(requesthandler):
+        """ method decorator which attaches the song metadata to the resulting songs if requested
 
         Note that the result has to be a list of songs.
         """
         def newrequesthandler(self, request):
             songs = requesthandler(self, request)
-            if request.random:
-                 return self._genrandomchoice(songs)
-            else:
-                 return songs
+            if request.withmetadata and songs:
+                self._attachmetadata(songs)
+            return songs
         return newrequesthandler
 
-    def sortresult(requesthandler):
-        """ method decorator which sorts the result list if requested """
+    def selectrandom(requesthandler):
+        """ method decorator which returns a random selection of the songs matching the request if requested
+
+        The selection is done by the databases without reading all songs.
+        """
         def newrequesthandler(self, request):
-            result = requesthandler(self, request)
-            # XXX turned off
-            if request.sort and 0:
-                result.sort(request.sort)
-            return result
+            if request.random:
+                return self.getrandomsongs(requests.getrandomsongs(request.songdbid, filters=request.filters,
+                                                                   length=config.general.randominsertlength))
+            return requesthandler(self, request)
         return newrequesthandler
 
     # cache update
 
+    def _clearcache(self, songdbid):
+        """ remove all cached results for the database songdbid (and all compound queries) """
+        log.debug("dbrequest cache: emptying cache for database %r" % songdbid)
+        self.requestcache.clearsegment(songdbid)
+        self.requestcache.clearsegment(None)
+
+    def _updatecacheforsong(self, songdbid, song, oldsong_metadata, newsong_metadata,
+                            fieldgroups, tagnames):
+        """ discard or patch cached results affected by a change of song
+
+        oldsong_metadata and newsong_metadata describe the song before
+        and after the change, either of them may be None if not known or
+        if the song is being added or deleted. fieldgroups is the set of
+        changed field groups and tagnames the set of tags added to or
+        removed from the song.
+
+        Returns the list of cached songs, whose metadata has to be fetched
+        again, because newsong_metadata is not known.
+        """
+        # song is None for newly added songs, whereas newsong_metadata is None for deleted ones
+        added = song is None
+        deleted = oldsong_metadata is not None and newsong_metadata is None
+        # the ids of a song remain valid unless the structure of the song has changed
+        idsvalid = song is not None and "structure" not in fieldgroups
+        probes = []
+        for song_metadata in oldsong_metadata, newsong_metadata:
+            if song_metadata is not None:
+                if idsvalid or song_metadata is oldsong_metadata:
+                    probe = item.song(songdbid, song.id, song.album_id, song.artist_id, song.album_artist_id)
+                else:
+                    probe = item.song(songdbid, None, None, None, None)
+                probe.song_metadata = song_metadata
+                probes.append(probe)
+
+        def maymatch(dependencies):
+            if not probes:
+                # we cannot decide
+                return True
+            for probe in probes:
+                if dependencies.maymatch(probe):
+                    return True
+            return False
+
+        if newsong_metadata is not None:
+            # copy of the new metadata shared by all patched songs
+            patchedsong_metadata = copy.copy(newsong_metadata)
+        stalesongs = []
+        discarded = patched = 0
+        for entry in self.requestcache.getentries(songdbid) + self.requestcache.getentries(None):
+            dependencies = entry.dependencies
+            if dependencies is None:
+                discard = True
+            elif not added and dependencies.contains(song.id):
+                discard = deleted or dependencies.dependson(fieldgroups, tagnames)
+                if not discard:
+                    # only information not relevant for the result has changed, so we
+                    # just update the song metadata in place
+                    for asong in entry.result:
+                        if asong.id == song.id and asong.songdbid == song.songdbid and asong is not song:
+                            if newsong_metadata is not None:
+                                asong.song_metadata = patchedsong_metadata
+                            else:
+                                stalesongs.append(asong)
+                    patched += 1
+            elif added:
+                # the new song may show up in every result it matches
+                discard = maymatch(dependencies)
+            elif deleted:
+                # lists of songs not containing the song cannot change
+                discard = dependencies.songids is None and maymatch(dependencies)
+            else:
+                discard = dependencies.dependson(fieldgroups, tagnames) and maymatch(dependencies)
+            if discard:
+                self.requestcache.discard(entry)
+                discarded += 1
+        log.debug("dbrequest cache: %d results discarded and %d patched" % (discarded, patched))
+        return stalesongs
+
+    def _refreshmetadata(self, songdbid, songs):
+        """ fetch the metadata of songs in songdbid in one go and attach it to them """
+        song_ids = []
+        for song in songs:
+            if song.id not in song_ids:
+                song_ids.append(song.id)
+        songs_metadata = self.songdbhub.request(requests.getsongs_metadata(songdbid, song_ids))
+        song_metadatas = dict(zip(song_ids, songs_metadata))
+        for song in songs:
+            song.song_metadata = song_metadatas[song.id]
+
     def updatecache(self, event):
-        """ update/clear requestcache when database event sent """
-        if isinstance(event, (events.checkpointdb, events.autoregistersongs)):
-            return
-        if isinstance(event, events.update_song):
+        """ update requestcache when database event sent
+
+        Only the cached results which are affected by the event are discarded.
+        Returns the list of cached songs, whose metadata has to be fetched again
+        once the database has processed the event.
+        """
+        if isinstance(event, (events.checkpointdb, events.autoregistersongs, events.autoregisterplaylists,
+                              events.autoregisterer_rescansongs)):
+            return []
+        if isinstance(event, events.song_skipped):
+            # nothing depends on the skip count, so we only have to patch the results
+            return self._updatecacheforsong(event.songdbid, event.song, None, None, set(["skipstats"]), set())
+        elif isinstance(event, events.song_played):
+            return self._updatecacheforsong(event.songdbid, event.song, None, None, set(["playstats"]), set())
+        elif isinstance(event, events.update_song):
             oldsong_metadata = self.songdbhub.request(requests.getsong_metadata(event.songdbid, event.song.id))
             newsong_metadata = event.song.song_metadata
-            # The following is an optimization for an update_song event which occurs rather often
-            # Not very pretty, but for the moment enough
-            if ( oldsong_metadata.album == newsong_metadata.album and
-                 oldsong_metadata.artist == newsong_metadata.artist and
-                 oldsong_metadata.tags == newsong_metadata.tags and
-                 oldsong_metadata.rating == newsong_metadata.rating ):
-                # only the playing information was changed, so we just
-                # delete the relevant cache results
-
-                for key, item in self.requestcache.items():
-                    if isinstance(item[1], (requests.getsongs)):
-                        del self.requestcache[key]
-                return
-        # otherwise we delete the queries for the correponding database (and all compound queries)
-        log.debug("dbrequest cache: emptying cache for database %r" % event.songdbid)
-        for key, item in self.requestcache.items():
-            songdbid = item[1].songdbid
-            if songdbid is None or songdbid == event.songdbid:
-                del self.requestcache[key]
+            if oldsong_metadata is None or newsong_metadata is None:
+                self._clearcache(event.songdbid)
+                return []
+            fieldgroups = changedfieldgroups(oldsong_metadata, newsong_metadata)
+            tagnames = set(oldsong_metadata.tags) ^ set(newsong_metadata.tags)
+            self._updatecacheforsong(event.songdbid, event.song, oldsong_metadata, newsong_metadata,
+                                     fieldgroups, tagnames)
+        elif isinstance(event, events.update_songs):
+            oldsongs_metadata = self.songdbhub.request(requests.getsongs_metadata(event.songdbid,
+                                                                                  [song.id for song in event.songs]))
+            for song, oldsong_metadata in zip(event.songs, oldsongs_metadata):
+                newsong_metadata = song.song_metadata
+                if oldsong_metadata is None or newsong_metadata is None:
+                    self._clearcache(event.songdbid)
+                    return []
+                fieldgroups = changedfieldgroups(oldsong_metadata, newsong_metadata)
+                tagnames = set(oldsong_metadata.tags) ^ set(newsong_metadata.tags)
+                self._updatecacheforsong(event.songdbid, song, oldsong_metadata, newsong_metadata,
+                                         fieldgroups, tagnames)
+        elif isinstance(event, events.add_song):
+            song_metadata = event.song
+            self._updatecacheforsong(event.songdbid, None, None, song_metadata,
+                                     set(_fieldgroups.keys() + ["info"]), set(song_metadata.tags))
+        elif isinstance(event, events.add_songs):
+            for song_metadata in event.songs:
+                self._updatecacheforsong(event.songdbid, None, None, song_metadata,
+                                         set(_fieldgroups.keys() + ["info"]), set(song_metadata.tags))
+        elif isinstance(event, events.delete_song):
+            song_metadata = self.songdbhub.request(requests.getsong_metadata(event.songdbid, event.song.id))
+            if song_metadata is None:
+                self._clearcache(event.songdbid)
+                return []
+            self._updatecacheforsong(event.songdbid, event.song, song_metadata, None,
+                                     set(_fieldgroups.keys() + ["info"]), set(song_metadata.tags))
+        else:
+            self._clearcache(event.songdbid)
+        return []
 
     # event handlers
 
@@ -301,9 +506,13 @@ class songdbmanager(service.service):
 
         # first update result cache (to allow the updatecache method
         # to query the old state of the database)
-        self.updatecache(event)
+        stalesongs = self.updatecache(event)
         # and then send the event to the database
         self.songdbhub.notify(event)
+        # cached songs whose metadata could not be patched in place are
+        # updated by a single request, which the database processes after the event
+        if stalesongs:
+            self._refreshmetadata(event.songdbid, stalesongs)
 
     # request handlers
 
@@ -314,45 +523,136 @@ class songdbmanager(service.service):
 
         return self.songdbhub.request(request)
 
+    def _requestall(self, request, onresult=None, usecache=True):
+        """ issue request for all databases concurrently and return the list of their results
+
+        Results already present in the cache are taken from there (if
+        usecache is set), all other requests are sent to the databases at
+        once, such that we only have to wait for the slowest database
+        instead of all of them in turn. Each time a database has answered
+        while others are still pending, onresult is called with the list
+        of results available so far (None for pending ones).
+        """
+        results = [None] * len(self.songdbids)
+        # channel on which the completed requests are delivered to us
+        completions = hub.channel(self.songdbhub, "songdb manager fan-out")
+        pending = [0]
+        def completed(rr, i=None):
+            results[i] = rr.result
+            if usecache:
+                self.requestcache.put(rr.request, rr.result, resultdependencies(rr.request, rr.result))
+            pending[0] -= 1
+            if pending[0] and onresult is not None:
+                onresult(results)
+        for i, songdbid in enumerate(self.songdbids):
+            nrequest = self._dbrequest(request, songdbid)
+            try:
+                if not usecache:
+                    raise KeyError
+                results[i] = self.requestcache.get(nrequest)
+            except KeyError:
+                pending[0] += 1
+                self.songdbhub.requestnoblocking(nrequest,
+                                                 callback=lambda rr, i=i: completed(rr, i),
+                                                 channel=completions)
+        while pending[0]:
+            completions.process(block=True)
+        return results
+
+    def _dbrequest(self, request, songdbid):
+        """ return copy of request for the database songdbid
+
+        Remote databases do not sort the songs (see songdbs.remote), so they
+        cannot return a page of them either. Instead, all their songs are
+        requested and sorted and paged by us.
+        """
+        nrequest = copy.copy(request)
+        nrequest.songdbid = songdbid
+        if songdbid in self.remotesongdbids and isinstance(request, requests.dbrequestsongs):
+            nrequest.limit = None
+            nrequest.offset = 0
+            nrequest.after = None
+        return nrequest
+
+    def _mergesongs(self, results, sort):
+        """ merge lists of songs of several databases, which are sorted according to sort """
+        results = [result for result in results if result]
+        if len(results) > 1 and getattr(sort, "interleaved", False):
+            # the songs are ranked by each database separately
+            return _interleave(results)
+        fromremote = [result for result in results if result[0].songdbid in self.remotesongdbids]
+        if (len(results) > 1 or fromremote) and sort and hasattr(sort, "cmpitem"):
+            # comparing the songs requires their metadata
+            for result in results:
+                self._attachmetadata(result)
+            # remote databases do not sort the songs
+            sortedresults = []
+            for result in results:
+                result = result[:]
+                result.sort(sort.cmpitem)
+                sortedresults.append(result)
+            return _mergesorted(sortedresults, sort.cmpitem)
+        merged = []
+        for result in results:
+            merged.extend(result)
+        return merged
+
+    def _pagerequest(self, request):
+        """ return copy of request for a single database covering the requested page of all databases
+
+        The page of the merged result is contained in the merged pages starting
+        at the beginning (or after the given key) of each database.
+        """
+        nrequest = copy.copy(request)
+        if request.limit is not None and request.after is None:
+            nrequest.limit = request.offset + request.limit
+            nrequest.offset = 0
+        return nrequest
+
+    def _page(self, request, merged):
+        """ return the requested page of the merged result """
+        if request.limit is None:
+            return merged
+        if request.after is None:
+            return merged[request.offset:request.offset+request.limit]
+        if [song for song in merged if song.songdbid in self.remotesongdbids]:
+            # remote databases return all songs and not only those after the key, cf. _dbrequest
+            merged = [song for song in merged if request.sort.getkey(song) > request.after]
+        return merged[:request.limit]
+
     def dbrequestsongs(self, request):
         # make a copy of the original request, because we will subsequently modify it
         nrequest = copy.copy(request)
-        # also reset the sort function as otherwise
-        # sending over the network (which requires pickling the
-        # request) fails
-        # XXX we disable this at the moment
         if request.songdbid is None:
-            nrequest.sort = False
-            resulthash = {}
-            for songdbid in self.songdbids:
-                nrequest.songdbid = songdbid
-                # Query the songs in the database songdbid via dbrequestsongs to cache
-                # the result.
-                # Note that in the case of getlastplayedsongs requests, we cheat
-                # a little bit, since then the result of the database request is a tuple
-                # (playingtime, dbsong).
-                for dbsong in self.dbrequestsongs(nrequest):
-                    resulthash[dbsong] = songdbid
-            return resulthash.values()
+            nrequest = self._pagerequest(request)
+            # the random selection is done on the merged result
+            nrequest.random = False
+            nrequest.onpartialresult = None
+            onresult = None
+            if request.onpartialresult is not None:
+                def onresult(results):
+                    request.onpartialresult(self._mergesongs(results, request.sort))
+            return self._page(request, self._mergesongs(self._requestall(nrequest, onresult), request.sort))
         elif request.songdbid not in self.songdbids:
             log.error("songdbmanager: invalid songdbid '%r' for database request" % request.songdbid)
             return
+        elif request.songdbid in self.remotesongdbids and request.limit is not None:
+            # we have to sort and page the songs ourselves, cf. _dbrequest
+            nrequest = self._dbrequest(request, request.songdbid)
+            return self._page(request, self._mergesongs([self.songdbhub.request(nrequest)], request.sort))
         else:
             return self.songdbhub.request(nrequest)
-    dbrequestsongs = selectrandom(cacheresult(sortresult(dbrequestsongs)))
+    dbrequestsongs = fetchmetadata(selectrandom(cacheresult(dbrequestsongs)))
 
     def dbrequestlist(self, request):
         # make a copy of the original request, because we will subsequently modify it
         nrequest = copy.copy(request)
 
         if request.songdbid is None:
-            resulthash = {}
-            for songdbid in self.songdbids:
-                nrequest.songdbid = songdbid
-                for result in self.dbrequestlist(nrequest):
-                    resulthash[result] = songdbid
-            # sort results
-            return resulthash.keys()
+            nrequest = self._pagerequest(request)
+            # the databases sort the items by their name
+            return self._page(request,
+                              _mergesorted([result for result in self._requestall(nrequest) if result], _cmpnames))
         elif request.songdbid not in self.songdbids:
             log.error("songdbmanager: invalid songdbid '%r' for database request" % request.songdbid)
         else:
@@ -363,6 +663,42 @@ class songdbmanager(service.service):
             return self.songdbhub.request(nrequest)
     dbrequestlist = cacheresult(dbrequestlist)
 
+    def getrandomsongs(self, request):
+        if request.songdbid is None:
+            # Every database makes its own selection. We then successively take the next
+            # song of a database chosen with a probability proportional to its number of
+            # songs matching the filters.
+            numbers = [self.getnumberofsongs(requests.getnumberofsongs(songdbid, filters=request.filters)) or 0
+                       for songdbid in self.songdbids]
+            songlists = [result or [] for result in self._requestall(request, usecache=False)]
+            # the length of the songs is needed below
+            for songlist in songlists:
+                self._attachmetadata(songlist)
+            songs = []
+            length = 0
+            positions = [0] * len(songlists)
+            while len(songs) < request.number and (request.length is None or length < request.length):
+                available = [i for i, songlist in enumerate(songlists) if positions[i] < len(songlist)]
+                if not available:
+                    break
+                u = random.random() * sum([numbers[i] for i in available])
+                for i in available:
+                    u -= numbers[i]
+                    if u < 0:
+                        break
+                song = songlists[i][positions[i]]
+                positions[i] += 1
+                songs.append(song)
+                length += song.length or 0
+        elif request.songdbid not in self.songdbids:
+            log.error("songdbmanager: invalid songdbid '%r' for database request" % request.songdbid)
+            return []
+        else:
+            songs = self.songdbhub.request(request)
+        if request.withmetadata and songs:
+            self._attachmetadata(songs)
+        return songs
+
     def getdatabasestats(self, request):
         if request.songdbid is None:
             return "Virtual", ""
@@ -373,30 +709,37 @@ class songdbmanager(service.service):
 
     # requests which return number of items of a certain kind
 
-    def getnumberofsongs(self, request):
-        if request.songdbid is not None and request.songdbid not in self.songdbids:
-            log.error("songdbmanager: invalid songdbid '%r' for database request" % request.songdbid)
-        # XXX use filters in sqlite instead
-        if request.songdbid is not None and request.filters is None:
-            return self.songdbhub.request(request)
-        else:
-            return len(self.dbrequestsongs(requests.getsongs(songdbid=request.songdbid,
-                                                             filters=request.filters)))
-    getnumberofsongs = cacheresult(getnumberofsongs)
-
-    def _requestnumbers(self, request, listrequest):
-        """ helper method for a request which queries for the number of items.
+    def _requestnumbers(self, request, listrequest=None):
+        """ helper method for a request which queries for the number (or other aggregates) of items.
 
-        If a database is specified, the corresponding database request is
-        executed directly. Otherwise, the length of the result of listrequest
-        is returned. """
-        if request.songdbid is not None and request.songdbid not in self.songdbids:
+        The request is passed on to the databases, which compute the result
+        without materializing the items. For a request spanning several
+        databases, the results of the individual databases are added, unless
+        the same item may be present in more than one of them. In this case,
+        the length of the merged result of listrequest is returned.
+        """
+        if request.songdbid is None:
+            if listrequest is not None and len(self.songdbids) > 1:
+                return len(self.dbrequestlist(listrequest(songdbid=None, filters=request.filters)))
+            # databases which failed to answer do not contribute
+            results = [result for result in self._requestall(request) if result is not None]
+            if not results:
+                return None
+            return sum(results[1:], results[0])
+        elif request.songdbid not in self.songdbids:
             log.error("songdbmanager: invalid songdbid '%r' for database request" % request.songdbid)
-        elif request.songdbid is None or request.filters:
-            return len(self.dbrequestlist(listrequest(songdbid=request.songdbid, filters=request.filters)))
         else:
             return self.songdbhub.request(request)
 
+    def getnumberofsongs(self, request):
+        # songs from different databases are always different
+        return self._requestnumbers(request)
+    getnumberofsongs = cacheresult(getnumberofsongs)
+
+    def getsongsaggregates(self, request):
+        return self._requestnumbers(request)
+    getsongsaggregates = cacheresult(getsongsaggregates)
+
     def getnumberofalbums(self, request):
         return self._requestnumbers(request, requests.getalbums)
     getnumberofalbums = cacheresult(getnumberofalbums)
@@ -417,7 +760,10 @@ class songdbmanager(service.service):
         songdbsstats = []
         for songdbid in self.songdbids:
             songdbsstats.append(self.songdbhub.request(requests.getdatabasestats(songdbid)))
+        cache = self.requestcache
         return songdbmanagerstats(songdbsstats,
-                                  self.requestcachesize, self.requestcachemaxsize,
-                                  len(self.requestcache),
-                                  self.requestcachehits, self.requestcachemisses)
+                                  cache.nobjects, cache.maxobjects,
+                                  len(cache),
+                                  cache.hits, cache.misses,
+                                  cache.size, cache.maxbytes, cache.evictions,
+                                  cache.segmentstats())
@@ -0,0 +1,151 @@
+# -*- coding: ISO-8859-1 -*-
+
+# Copyright (C) 2002, 2003, 2004 Jrg Lehmann <joerg@luga.de>
+#
+# This file is part of PyTone (http://www.luga.de/pytone/)
+#
+# PyTone is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2
+# as published by the Free Software Foundation.
+#
+# PyTone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyTone; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""in-memory bitsets of the song ids with a given tag, rating or compilation flag
+
+A set of songs is represented by a long integer, whose n-th bit is set
+if the song with id n belongs to the set. Since SQLite assigns the song
+ids consecutively, these bitsets are compact, and the tag and rating
+filters can be combined by intersecting and complementing them, which
+Python performs a machine word at a time.
+"""
+
+import binascii, threading
+
+# positions of the bits set in every possible byte
+_bitpositions = [[bit for bit in range(8) if byte & (1 << bit)] for byte in range(256)]
+
+
+def fromids(ids):
+    """ return bitset containing the ids """
+    ids = list(ids)
+    if not ids:
+        return 0L
+    bytes = bytearray(max(ids)//8 + 1)
+    for id in ids:
+        bytes[id >> 3] |= 1 << (id & 7)
+    bytes.reverse()
+    return long(binascii.hexlify(bytes), 16)
+
+
+def toids(bitset):
+    """ return sorted list of the ids contained in bitset """
+    hexstring = "%x" % bitset
+    if len(hexstring) % 2:
+        hexstring = "0" + hexstring
+    bytes = bytearray(binascii.unhexlify(hexstring))
+    bytes.reverse()
+    ids = []
+    for i, byte in enumerate(bytes):
+        if byte:
+            ids.extend([(i << 3) + bit for bit in _bitpositions[byte]])
+    return ids
+
+
+def count(bitset):
+    """ return number of ids contained in bitset """
+    return bin(bitset).count("1")
+
+
+class songbitsets:
+
+    """ bitsets of all songs and of the songs with a given tag, rating or compilation flag
+
+    songs is an iterable of (song_id, rating, compilation) tuples and taggings
+    one of (song_id, tag name) tuples.
+    """
+
+    def __init__(self, songs, taggings):
+        self.lock = threading.Lock()
+        self.all = 0L
+        self.compilations = 0L
+        # mapping rating (None for songs which have not been rated) -> bitset
+        self.ratings = {}
+        # mapping tag name -> bitset
+        self.tags = {}
+        # number of updates so far, which identifies the current state of the bitsets
+        self.generation = 0
+        self._add(songs, taggings)
+
+    def _add(self, songs, taggings):
+        allsongs = []
+        compilations = []
+        ratings = {}
+        for song_id, rating, compilation in songs:
+            allsongs.append(song_id)
+            ratings.setdefault(rating, []).append(song_id)
+            if compilation:
+                compilations.append(song_id)
+        tags = {}
+        for song_id, tag in taggings:
+            tags.setdefault(tag, []).append(song_id)
+        self.all |= fromids(allsongs)
+        self.compilations |= fromids(compilations)
+        for rating, song_ids in ratings.items():
+            self.ratings[rating] = self.ratings.get(rating, 0L) | fromids(song_ids)
+        for tag, song_ids in tags.items():
+            self.tags[tag] = self.tags.get(tag, 0L) | fromids(song_ids)
+
+    def update(self, song_ids, songs, taggings):
+        """ replace the entries of the songs with song_ids by songs and taggings
+
+        Songs with one of the song_ids which are missing in songs are removed.
+        """
+        mask = ~fromids(song_ids)
+        self.lock.acquire()
+        try:
+            self.all &= mask
+            self.compilations &= mask
+            for mapping in self.ratings, self.tags:
+                for key, bitset in mapping.items():
+                    bitset &= mask
+                    if bitset:
+                        mapping[key] = bitset
+                    else:
+                        del mapping[key]
+            self._add(songs, taggings)
+            self.generation += 1
+        finally:
+            self.lock.release()
+
+    def select(self, conditions):
+        """ return tuple (bitset of the songs satisfying all conditions, bitset of all songs, generation)
+
+        conditions is a list of tuples (kind, key, inverted), where kind is
+        "tag", "rating" or "compilation" and key is the tag name, the rating
+        (None for songs which have not been rated) or ignored, respectively.
+        If inverted is set, the songs not satisfying the condition are selected.
+        """
+        self.lock.acquire()
+        try:
+            result = self.all
+            for kind, key, inverted in conditions:
+                if kind == "tag":
+                    bitset = self.tags.get(key, 0L)
+                elif kind == "rating":
+                    bitset = self.ratings.get(key, 0L)
+                else:
+                    bitset = self.compilations
+                if inverted:
+                    result &= ~bitset
+                else:
+                    result &= bitset
+            return result, self.all, self.generation
+        finally:
+            self.lock.release()
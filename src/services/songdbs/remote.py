@@ -63,6 +63,12 @@ class songdb(service.service):
         # we have to copy the request, because another thread may also access it
         request = copy.copy(request)
         request.songdbid = self.remotesongdbid
+        if isinstance(request, requests.dbrequestsongs):
+            # neither the sort order nor the callback for partial results can be pickled,
+            # so the songs are sorted (and thus also paged) by the caller if necessary,
+            # see songdbmanager._dbrequest
+            request.sort = False
+            request.onpartialresult = None
         result = self.networkchannel.request(request)
         log.debug("result %s" % `result`)
         # we change the databasestats accordingly
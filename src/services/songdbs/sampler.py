@@ -0,0 +1,144 @@
+# -*- coding: ISO-8859-1 -*-
+
+# Copyright (C) 2002, 2003, 2004 Jrg Lehmann <joerg@luga.de>
+#
+# This file is part of PyTone (http://www.luga.de/pytone/)
+#
+# PyTone is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2
+# as published by the Free Software Foundation.
+#
+# PyTone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyTone; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""weighted random selection of songs
+
+The chance of a song to be selected depends on its rating (or, for
+songs which have not been rated, on its play and skip counts) and is
+reduced for songs which have been played recently. Since the latter
+changes with time, the weights without this reduction are kept in a
+Fenwick tree, which allows to draw a song and to update its weight in
+O(log n) time. The reduction is then applied by rejecting drawn songs
+with the corresponding probability.
+"""
+
+import math, random, threading
+
+# relative percentage of songs accepted with a given rating
+_ratingdistribution = [5, 10, 20, 30, 35]
+_normfactor = float(sum(_ratingdistribution))
+_ratingdistribution = [x/_normfactor for x in _ratingdistribution]
+
+# scale for rating reduction: for playing times longer
+# ago than lastplayedscale seconds, the rating is not
+# influenced.
+_lastplayedscale = 60.0 * 60 * 24
+
+
+def songweight(rating, playcount, skipcount, date_lastplayed=None, currenttime=None):
+    """ return weight of song for random selection
+
+    If currenttime is given, the weight of a song played recently is reduced.
+    Note that this never increases the weight.
+    """
+    if not rating:
+        # punish skipped songs if they have not been rated
+        rating = min(5, max(1, 3 + max(0, 0.5*((playcount or 0) - (skipcount or 0)))))
+    if currenttime is not None and date_lastplayed:
+        # Simple heuristic algorithm to consider song ratings
+        # for random selection. Certainly not optimal!
+        last = max(0, (currenttime-date_lastplayed)/60)
+        rating -= 2 * math.exp(-last/_lastplayedscale)
+        if rating < 1:
+            rating = 1
+    if rating >= 5:
+        return _ratingdistribution[4]
+    # get weight by linear interpolation
+    intpart = int(rating)
+    rest = rating-intpart
+    return ( _ratingdistribution[intpart-1] +
+             (_ratingdistribution[intpart] - _ratingdistribution[intpart-1])*rest )
+
+
+class weightedsampler:
+
+    """ Fenwick tree of the weights of the songs indexed by their id
+
+    All methods may be called from different threads.
+    """
+
+    def __init__(self, weights):
+        """ weights is a dictionary song id -> weight """
+        self.lock = threading.Lock()
+        self._build(max(weights.keys() or [0]), weights)
+
+    def _build(self, size, weights):
+        # we use 1-based indices, which coincide with the song ids
+        self.size = size
+        self.weights = [0.0] * (size+1)
+        for id, weight in weights.items():
+            self.weights[id] = weight
+        self.tree = self.weights[:]
+        for i in range(1, size+1):
+            j = i + (i & -i)
+            if j <= size:
+                self.tree[j] += self.tree[i]
+        self.total = sum(self.weights)
+
+    def setweight(self, id, weight):
+        """ set weight of song with id (0 for deleted songs) """
+        self.lock.acquire()
+        try:
+            if id > self.size:
+                if not weight:
+                    return
+                weights = dict([(i, w) for i, w in enumerate(self.weights) if w])
+                weights[id] = weight
+                # grow geometrically to keep the amortized cost of added songs low
+                self._build(max(id, 2*self.size), weights)
+                return
+            delta = weight - self.weights[id]
+            self.weights[id] = weight
+            self.total += delta
+            i = id
+            while i <= self.size:
+                self.tree[i] += delta
+                i += i & -i
+        finally:
+            self.lock.release()
+
+    def draw(self, n):
+        """ return list of n song ids drawn independently according to their weights
+
+        Note that the list may contain duplicates and is empty if all weights vanish.
+        """
+        self.lock.acquire()
+        try:
+            if self.total <= 0:
+                return []
+            result = []
+            topstep = 1
+            while 2*topstep <= self.size:
+                topstep *= 2
+            for k in range(n):
+                u = random.random() * self.total
+                pos = 0
+                step = topstep
+                while step:
+                    if pos+step <= self.size and self.tree[pos+step] <= u:
+                        pos += step
+                        u -= self.tree[pos]
+                    step //= 2
+                # guard against rounding errors at the upper end
+                id = min(pos+1, self.size)
+                if self.weights[id] > 0:
+                    result.append(id)
+            return result
+        finally:
+            self.lock.release()
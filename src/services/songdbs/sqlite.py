@@ -23,7 +23,17 @@ import errno
 import math
 import sys
 import random
+import threading
 import time
+import Queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 try:
     import sqlite3 as sqlite
@@ -38,6 +48,8 @@ import item
 import service
 import encoding
 import config as configmodule
+import sampler
+import bitsets
 
 
 create_tables = """
@@ -131,6 +143,137 @@ CREATE INDEX playlistcontents_song_id ON playlistcontents(song_id);
 CREATE INDEX playlistcontents_playlist_id ON playlistcontents(playlist_id);
 """
 
+#
+# schema migrations
+#
+# List of (version, description, migration) tuples ordered by version, where
+# migration is either a list of SQL statements or a function accepting a cursor.
+# A database with schema version n (stored as user_version) is brought up to date
+# by applying all migrations with a version larger than n. The initial schema
+# given by create_tables has version 1. Note that SQLite commits before schema
+# changes, so migrations have to be written such that they can be reapplied
+# after an interruption, e.g., using IF NOT EXISTS clauses.
+
+def _movesongtexts(cur):
+    """ move the pickled comments and lyrics out of the songs table into tables of their own """
+    for table in songcolumns_lists:
+        cur.execute(create_songtexts_table % table)
+    # a second cursor for inserting while we iterate over the songs
+    insertcur = cur.connection.cursor()
+    for row in cur.execute("""SELECT id, comments, lyrics FROM songs
+                              WHERE comments IS NOT NULL OR lyrics IS NOT NULL"""):
+        for table in songcolumns_lists:
+            try:
+                frames = _textframes(loads(row[table]))
+            except Exception:
+                frames = []
+            insertcur.executemany(songtexts_insert % table,
+                                  [[row["id"], position] + frame for position, frame in enumerate(frames)])
+    insertcur.close()
+    cur.execute("UPDATE songs SET comments = NULL, lyrics = NULL")
+    # shrink the rows of the songs table, which have been bloated by the lyrics
+    cur.execute("VACUUM")
+
+# tables whose entries are sorted by the sort key of their name
+sortedtables = ["artists", "albums", "tags", "playlists"]
+
+def _addsortkeys(cur):
+    """ add and fill columns containing the sort keys of names and song titles """
+    def addcolumn(table, column):
+        if column not in [r["name"] for r in cur.execute("PRAGMA table_info(%s)" % table)]:
+            cur.execute("ALTER TABLE %s ADD COLUMN %s TEXT" % (table, column))
+    for table in sortedtables:
+        addcolumn(table, "sortname")
+        rows = cur.execute("SELECT id, name FROM %s" % table).fetchall()
+        cur.executemany("UPDATE %s SET sortname = ? WHERE id = ?" % table,
+                        [(metadata.sortkey(r["name"]), r["id"]) for r in rows])
+        cur.execute("CREATE INDEX IF NOT EXISTS %s_sortname ON %s(sortname)" % (table, table))
+    for table in ["artists", "albums", "tags"]:
+        cur.execute("DROP INDEX IF EXISTS %s_name_nocase" % table)
+    addcolumn("songs", "title_sortkey")
+    rows = cur.execute("SELECT id, title FROM songs").fetchall()
+    cur.executemany("UPDATE songs SET title_sortkey = ? WHERE id = ?",
+                    [(metadata.sortkey(r["title"]), r["id"]) for r in rows])
+    # songs view (cf. item.songs.order) and songs of an album (cf. item.album.order)
+    cur.execute("CREATE INDEX IF NOT EXISTS title_sortkey_song ON songs(title_sortkey, url)")
+    cur.execute("CREATE INDEX IF NOT EXISTS album_order_song ON songs(album_id, disknumber, tracknumber, title_sortkey)")
+    cur.execute("ANALYZE")
+
+migrations = [
+    (2, "indexes for browsing", [
+        # artists view and artist filters
+        "CREATE INDEX IF NOT EXISTS album_artist_id_song ON songs(album_artist_id)",
+        "CREATE INDEX IF NOT EXISTS artists_name_nocase ON artists(name COLLATE NOCASE)",
+        # albums view
+        "CREATE INDEX IF NOT EXISTS albums_name_nocase ON albums(name COLLATE NOCASE)",
+        # tags view and tag filters
+        "CREATE INDEX IF NOT EXISTS tags_name_nocase ON tags(name COLLATE NOCASE)",
+        "CREATE INDEX IF NOT EXISTS taggings_tag_id_song_id ON taggings(tag_id, song_id)",
+        "CREATE INDEX IF NOT EXISTS taggings_song_id_tag_id ON taggings(song_id, tag_id)",
+        "DROP INDEX IF EXISTS taggings_tag_id",
+        "DROP INDEX IF EXISTS taggings_song_id",
+        # top played, last added and rated songs
+        "CREATE INDEX IF NOT EXISTS playcount_song ON songs(playcount, date_lastplayed)",
+        "CREATE INDEX IF NOT EXISTS date_lastplayed_song ON songs(date_lastplayed)",
+        "CREATE INDEX IF NOT EXISTS date_added_song ON songs(date_added)",
+        "CREATE INDEX IF NOT EXISTS rating_song ON songs(rating)",
+        # last played songs
+        "CREATE INDEX IF NOT EXISTS playstats_song_id ON playstats(song_id, date_played)",
+        "CREATE INDEX IF NOT EXISTS playstats_date_played ON playstats(date_played, song_id)",
+        "ANALYZE"]),
+    (3, "per-day playing statistics", [
+        # number of plays and last playing time of a song per day (counted since the epoch),
+        # which are kept when the individual playing times have expired
+        """CREATE TABLE IF NOT EXISTS playstats_daily (
+             song_id         INTEGER CONSTRAINT fk_song_id REFERENCES songs(id),
+             day             INTEGER,
+             playcount       INTEGER,
+             date_lastplayed TIMESTAMP,
+             PRIMARY KEY (song_id, day)
+           )""",
+        "CREATE INDEX IF NOT EXISTS playstats_daily_date_lastplayed ON playstats_daily(date_lastplayed)",
+        """INSERT OR REPLACE INTO playstats_daily (song_id, day, playcount, date_lastplayed)
+             SELECT song_id, CAST(date_played/86400 AS INTEGER), count(*), max(date_played)
+             FROM playstats GROUP BY 1, 2""",
+        "ANALYZE"]),
+    (4, "comments and lyrics in tables of their own", _movesongtexts),
+    (5, "sort keys", _addsortkeys),
+    ]
+
+# full text search index over the song information used by item.searchfilter,
+# where the rowid is the id of the song
+create_search_table = """
+CREATE VIRTUAL TABLE songs_search USING fts5(
+  title, album, artist, album_artist, tags,
+  tokenize = "unicode61 remove_diacritics 1",
+  prefix = "2 3"
+);
+"""
+
+populate_search_table = """
+INSERT INTO songs_search (rowid, title, album, artist, album_artist, tags)
+  SELECT songs.id, songs.title, albums.name, artists.name, album_artists.name,
+         (SELECT group_concat(tags.name, ' ') FROM taggings
+          JOIN tags ON tags.id = taggings.tag_id
+          WHERE taggings.song_id = songs.id)
+  FROM songs
+  LEFT JOIN albums  ON albums.id == songs.album_id
+  LEFT JOIN artists ON artists.id == songs.artist_id
+  LEFT JOIN artists AS album_artists ON album_artists.id == songs.album_artist_id
+"""
+
+def _hasfulltextsearch():
+    """ check whether SQLite has been compiled with support for FTS5 """
+    con = sqlite.connect(":memory:")
+    try:
+        try:
+            con.execute("CREATE VIRTUAL TABLE test USING fts5(text)")
+            return True
+        except sqlite.Error:
+            return False
+    finally:
+        con.close()
+
 songcolumns_plain = ["url", "type", "title",  "year", "bpm",
                      "length", "tracknumber", "trackcount", "disknumber", "diskcount",
                      "compilation", "bitrate", "is_vbr", "samplerate", 
@@ -141,8 +284,99 @@ songcolumns_plain = ["url", "type", "title",  "year", "bpm",
 
 songcolumns_indices = ["album_id", "artist_id", "album_artist_id"]
 songcolumns_w_indices = songcolumns_plain + songcolumns_indices
+# columns written when storing a song, the last of which is computed from the title
+songcolumns_stored = songcolumns_w_indices + ["title_sortkey"]
+# Comments and lyrics are stored in tables of the same names (and not in the
+# corresponding obsolete columns of the songs table), such that the rows of the
+# songs table stay small. They are only loaded on demand.
 songcolumns_lists = ["comments", "lyrics"]
-songcolumns_all = songcolumns_w_indices + songcolumns_lists
+
+create_songtexts_table = """
+CREATE TABLE IF NOT EXISTS %s (
+  song_id        INTEGER CONSTRAINT fk_song_id REFERENCES songs(id),
+  position       INTEGER,
+  language       TEXT,
+  description    TEXT,
+  text           TEXT,
+  PRIMARY KEY (song_id, position)
+);
+"""
+
+songtexts_insert = ( "INSERT OR REPLACE INTO %s (song_id, position, language, description, text) "
+                     "VALUES (?, ?, ?, ?, ?)" )
+
+def _textframes(frames):
+    """ return comments or lyrics as list of [language, description, text] lists
+
+    Some metadata decoders return a single string or a single frame instead of a
+    list of frames.
+    """
+    if not frames:
+        return []
+    if isinstance(frames, basestring):
+        return [[u"", u"", frames]]
+    if len(frames) == 3 and [frame for frame in frames if isinstance(frame, basestring)] == list(frames):
+        return [list(frames)]
+    result = []
+    for frame in frames:
+        if isinstance(frame, basestring):
+            result.append([u"", u"", frame])
+        else:
+            result.append(list(frame))
+    return result
+
+# helper function for the page-wise reading of ordered lists
+
+def _SQL_page(wherestring, args, keys, limit, offset, after):
+    """ return wherestring, orderstring, limitstring and args for a page of rows ordered by keys
+
+    keys is a list of SQL expressions. If after is not None, the page starts
+    after the row, for which these expressions take the values after. This
+    allows SQLite to directly seek to the start of the page when the
+    expressions are indexed. Otherwise, the first offset rows are skipped.
+    """
+    orderstring = "ORDER BY %s" % ", ".join(keys)
+    if limit is None:
+        return wherestring, orderstring, "", args
+    if after is not None:
+        # (key_0, ..., key_n) > (after_0, ..., after_n) in lexicographic order
+        conditions = []
+        args = list(args)
+        for i, key in enumerate(keys):
+            conditions.append(" AND ".join(["%s = ?" % k for k in keys[:i]] + ["%s > ?" % key]))
+            args.extend(after[:i+1])
+        condition = " OR ".join(["(%s)" % c for c in conditions])
+        if wherestring:
+            wherestring = "%s AND (%s)" % (wherestring, condition)
+        else:
+            wherestring = "WHERE (%s)" % condition
+        offset = 0
+    return wherestring, orderstring, "LIMIT %d OFFSET %d" % (limit, offset), args
+
+
+class _songidsfilter(item.hiddenfilter):
+
+    """ filter for a set of song ids
+
+    It replaces the tag, rating and compilation filters, which have been
+    evaluated by means of the in-memory bitsets, see songdb._compilefilters.
+    The song ids are either stored in the temporary table named table or,
+    if table is None, given as list song_ids. If inverted is set, the songs
+    not contained in the set pass the filter.
+    """
+
+    def __init__(self, inverted, table=None, song_ids=None):
+        self.inverted = inverted
+        self.table = table
+        self.song_ids = song_ids
+        item.hiddenfilter.__init__(self, "song_ids", None)
+
+    def SQL_WHERE_string(self):
+        if self.table is not None:
+            return "songs.id %sIN temp.%s" % (self.inverted and "NOT " or "", self.table)
+        # The ids are integers and can thus be inserted directly, which
+        # also avoids the limit on the number of SQL variables.
+        return "songs.id %sIN (%s)" % (self.inverted and "NOT " or "", ",".join(map(str, self.song_ids)))
 
 # secure unpickler which does not accept any instances
 
@@ -162,7 +396,8 @@ def dumps(obj):
 
 class songdbstats:
     def __init__(self, id, type, basedir, location, dbfile, cachesize,
-                 numberofsongs, numberofalbums, numberofartists, numberoftags):
+                 numberofsongs, numberofalbums, numberofartists, numberoftags,
+                 totallength=0, totalsize=0):
         self.id = id
         self.type = type
         self.basedir = basedir
@@ -173,6 +408,36 @@ class songdbstats:
         self.numberofalbums = numberofalbums
         self.numberofartists = numberofartists
         self.numberoftags = numberoftags
+        self.totallength = totallength
+        self.totalsize = totalsize
+
+
+class songsaggregates:
+
+    """ aggregated information about a set of songs
+
+    Instances for disjoint sets of songs, e.g., from different databases,
+    can be combined by adding them.
+    """
+
+    def __init__(self, numberofsongs, totallength, totalsize, totalplaycount, numberofplayedsongs):
+        self.numberofsongs = numberofsongs
+        self.totallength = totallength
+        self.totalsize = totalsize
+        self.totalplaycount = totalplaycount
+        self.numberofplayedsongs = numberofplayedsongs
+
+    def __repr__(self):
+        return ("songsaggregates(%d songs, length=%d, size=%d, playcount=%d, played songs=%d)" %
+                (self.numberofsongs, self.totallength, self.totalsize,
+                 self.totalplaycount, self.numberofplayedsongs))
+
+    def __add__(self, other):
+        return songsaggregates(self.numberofsongs + other.numberofsongs,
+                               self.totallength + other.totallength,
+                               self.totalsize + other.totalsize,
+                               self.totalplaycount + other.totalplaycount,
+                               self.numberofplayedsongs + other.numberofplayedsongs)
 
 #
 # songdb class
@@ -180,7 +445,10 @@ class songdbstats:
 
 class songdb(service.service):
 
-    currentdbversion = 1
+    currentdbversion = migrations[-1][0]
+
+    # is the full text search index songs_search maintained?
+    fulltextsearch = False
 
     def __init__(self, id, config, songdbhub):
         service.service.__init__(self, "%r songdb" % id, hub=songdbhub)
@@ -188,7 +456,13 @@ class songdb(service.service):
         self.basedir = config.musicbasedir
         self.dbfile = config.dbfile
         self.cachesize = config.cachesize
+        self.mmapsize = config.mmapsize
+        self.synchronous = config.synchronous
+        self.tempstore = config.tempstore
         self.playingstatslength = config.playingstatslength
+        self.playstatsretention = config.playstatsretention
+        # time of the last removal of expired playing times
+        self.playstatspruned = 0
 
         if not os.path.isdir(self.basedir):
             raise errors.configurationerror("musicbasedir '%r' of database %r is not a directory." % 
@@ -200,10 +474,34 @@ class songdb(service.service):
         # currently active cursor - initially, none
         self.cur = None
 
+        # connections are thread specific, see the con property
+        self._local = threading.local()
+        # set as soon as the database file has been set up
+        self._initialized = threading.Event()
+
+        # number of received and applied database events, which allows
+        # read requests served by other threads to wait for pending changes
+        self.eventsreceived = 0
+        self.eventsapplied = 0
+        self.eventsappliedcondition = threading.Condition()
+
+        # weights of the songs for their random selection, which are set up on
+        # first use and then kept up to date, see _getsampler
+        self.sampler = None
+        self.samplerlock = threading.Lock()
+
+        # bitsets of the songs with a given tag, rating or compilation flag, which
+        # are set up on startup and then kept up to date, see _getbitsets
+        self.bitsets = None
+        self.bitsetslock = threading.Lock()
+
         # we need to be informed about database changes
+        self.channel.subscribe(events.dbevent, self._eventreceived)
         self.channel.subscribe(events.add_song, self.add_song)
         self.channel.subscribe(events.update_song, self.update_song)
         self.channel.subscribe(events.delete_song, self.delete_song)
+        self.channel.subscribe(events.add_songs, self.add_songs)
+        self.channel.subscribe(events.update_songs, self.update_songs)
         self.channel.subscribe(events.song_played, self.song_played)
         self.channel.subscribe(events.song_skipped, self.song_skipped)
 
@@ -212,33 +510,53 @@ class songdb(service.service):
         self.channel.subscribe(events.delete_playlist, self.delete_playlist)
 
         self.channel.subscribe(events.clearstats, self.clearstats)
+        # this has to be the last subscription to database events
+        self.channel.subscribe(events.dbevent, self._eventapplied)
 
         # we are a database service provider...
         self.channel.supply(requests.getdatabasestats, self.getdatabasestats)
-        self.channel.supply(requests.getsong_metadata, self.getsong_metadata)
-        self.channel.supply(requests.getartists, self.getartists)
-        self.channel.supply(requests.getalbums, self.getalbums)
         self.channel.supply(requests.gettag_id, self.gettag_id)
-        self.channel.supply(requests.getsongs, self.getsongs)
-        self.channel.supply(requests.getnumberofsongs, self.getnumberofsongs)
-        self.channel.supply(requests.getnumberofalbums, self.getnumberofalbums)
-        self.channel.supply(requests.getnumberofartists, self.getnumberofartists)
-        self.channel.supply(requests.getnumberoftags, self.getnumberoftags)
         self.channel.supply(requests.getnumberofratings, self.getnumberofratings)
-        self.channel.supply(requests.gettags, self.gettags)
-        self.channel.supply(requests.getratings, self.getratings)
-        self.channel.supply(requests.getlastplayedsongs, self.getlastplayedsongs)
-        self.channel.supply(requests.getplaylists, self.getplaylists)
+
+        # requests for browsing the database are served by a pool of reader
+        # threads (unless the database lives in memory), such that they need
+        # not wait for the completion of running write transactions
+        readrequests = [(requests.getsong_metadata, self.getsong_metadata),
+                        (requests.getsongs_metadata, self.getsongs_metadata),
+                        (requests.getsongfilesinfo, self.getsongfilesinfo),
+                        (requests.getsongs, self.getsongs),
+                        (requests.getartists, self.getartists),
+                        (requests.getalbums, self.getalbums),
+                        (requests.gettags, self.gettags),
+                        (requests.getratings, self.getratings),
+                        (requests.getlastplayedsongs, self.getlastplayedsongs),
+                        (requests.getplaylists, self.getplaylists),
+                        (requests.getnumberofsongs, self.getnumberofsongs),
+                        (requests.getnumberofalbums, self.getnumberofalbums),
+                        (requests.getnumberofartists, self.getnumberofartists),
+                        (requests.getnumberoftags, self.getnumberoftags),
+                        (requests.getsongsaggregates, self.getsongsaggregates),
+                        (requests.getrandomsongs, self.getrandomsongs),
+                        (requests.getsong_texts, self.getsong_texts)]
+        if config.readers > 0 and self.dbfile != ":memory:":
+            self.readers = songdbreaders(self, config.readers, songdbhub)
+            for requestclass, handler in readrequests:
+                self.readers.supply(requestclass, handler)
+            self.readers.start()
+        else:
+            self.readers = None
+            for requestclass, handler in readrequests:
+                self.channel.supply(requestclass, handler)
 
         self.autoregisterer = songautoregisterer(self.basedir, self.id, self.isbusy,
-                                                 config.tracknrandtitlere, config.postprocessors)
+                                                 config.tracknrandtitlere, config.postprocessors,
+                                                 config.scanthreads)
         self.autoregisterer.start()
 
     def run(self):
         # self.con = sqlite.connect(":memory:")
         log.debug("dbfile: '%r'" % self.dbfile)
-        self.con = sqlite.connect(self.dbfile)
-        self.con.row_factory = sqlite.Row
+        self.con = self._connect()
 
         dbversion = self.con.execute("PRAGMA user_version").fetchone()[0]
         log.debug("Found on-disk db version: %d" % dbversion)
@@ -247,7 +565,20 @@ class songdb(service.service):
             self._txn_begin()
             self.con.executescript(create_tables)
             self._txn_commit()
-            self.con.execute("PRAGMA user_version=%d" % self.currentdbversion)
+            self.con.execute("PRAGMA user_version=1")
+            dbversion = 1
+        self._migrate(dbversion)
+        self._initsearchindex()
+        self._txn_begin()
+        try:
+            self._pruneplaystats(time.time())
+        except:
+            self._txn_abort()
+            raise
+        else:
+            self._txn_commit()
+        self._getbitsets()
+        self._initialized.set()
         log.debug("Starting db sevice")
         service.service.run(self)
         self.close()
@@ -255,6 +586,120 @@ class songdb(service.service):
     def close(self):
         self.con.close()
 
+    def _migrate(self, dbversion):
+        """ bring database schema from version dbversion up to date """
+        if dbversion > self.currentdbversion:
+            log.warning(_("database %r: schema version %d is newer than the supported version %d") %
+                        (self.id, dbversion, self.currentdbversion))
+            return
+        for version, description, migration in migrations:
+            if version <= dbversion:
+                continue
+            log.info(_("database %r: updating schema to version %d (%s)") % (self.id, version, description))
+            self._txn_begin()
+            try:
+                if callable(migration):
+                    migration(self.cur)
+                else:
+                    for statement in migration:
+                        self.cur.execute(statement)
+                self.cur.execute("PRAGMA user_version=%d" % version)
+            except:
+                self._txn_abort()
+                raise
+            else:
+                self._txn_commit()
+
+    def _initsearchindex(self):
+        """ create and fill full text search index if not yet present """
+        if not _hasfulltextsearch():
+            log.warning(_("database %r: SQLite lacks FTS5 support, searching will be slow") % self.id)
+            item.searchfilter.fulltextsearch = False
+            return
+        self.fulltextsearch = True
+        if self.con.execute("SELECT name FROM sqlite_master WHERE name = 'songs_search'").fetchone() is None:
+            log.info(_("database %r: creating full text search index") % self.id)
+            self._txn_begin()
+            try:
+                self.cur.execute(create_search_table)
+                self.cur.execute(populate_search_table)
+            except:
+                self._txn_abort()
+                raise
+            else:
+                self._txn_commit()
+
+    def resetafterexception(self):
+        # the failed event will not be applied anymore
+        self._seteventsapplied(self.eventsreceived)
+
+    # connection handling
+
+    def _getcon(self):
+        return self._local.con
+
+    def _setcon(self, con):
+        self._local.con = con
+
+    # the connection to the database used by the current thread
+    con = property(_getcon, _setcon)
+
+    def _connect(self, readonly=False):
+        """ open connection to the database file using the configured settings
+
+        The writing connection switches the database to WAL mode, in which
+        readers and the writer do not block each other.
+        """
+        con = sqlite.connect(self.dbfile)
+        con.row_factory = sqlite.Row
+        # a negative cache size is interpreted by SQLite as size in kB
+        con.execute("PRAGMA cache_size = %d" % -self.cachesize)
+        con.execute("PRAGMA mmap_size = %d" % (1024*self.mmapsize))
+        con.execute("PRAGMA temp_store = %s" % self.tempstore)
+        if readonly:
+            con.execute("PRAGMA query_only = ON")
+        else:
+            con.execute("PRAGMA journal_mode = WAL")
+            con.execute("PRAGMA synchronous = %s" % self.synchronous)
+        return con
+
+    def openreadconnection(self):
+        """ open read-only connection for the current thread once the database is set up """
+        while not self._initialized.isSet():
+            if self.done:
+                return False
+            self._initialized.wait(1)
+        self.con = self._connect(readonly=True)
+        self._local.readonly = True
+        return True
+
+    # synchronisation with threads reading the database
+
+    def _eventreceived(self, event):
+        if event.songdbid == self.id:
+            self.eventsreceived += 1
+
+    def _eventapplied(self, event):
+        if event.songdbid == self.id:
+            self._seteventsapplied(self.eventsreceived)
+
+    def _seteventsapplied(self, eventsapplied):
+        self.eventsappliedcondition.acquire()
+        try:
+            self.eventsapplied = eventsapplied
+            self.eventsappliedcondition.notifyAll()
+        finally:
+            self.eventsappliedcondition.release()
+
+    def waitforevents(self, eventsapplied):
+        """ wait until the given number of database events has been applied """
+        self.eventsappliedcondition.acquire()
+        try:
+            while self.eventsapplied < eventsapplied and not self.done:
+                self.eventsappliedcondition.wait(1)
+        finally:
+            self.eventsappliedcondition.release()
+
     # transaction machinery
 
     def _txn_begin(self):
@@ -281,6 +726,7 @@ class songdb(service.service):
         self._txn_begin()
         try:
             self.cur.execute("DELETE FROM playstats")
+            self.cur.execute("DELETE FROM playstats_daily")
             self.cur.execute("UPDATE songs SET playcount = 0, skipcount = 0, date_lastplayed = NULL ")
 
         except:
@@ -288,6 +734,8 @@ class songdb(service.service):
             raise
         else:
             self._txn_commit()
+            # all weights have changed
+            self.sampler = None
 
     #
     # methods for adding, updating and deleting songs
@@ -295,28 +743,49 @@ class songdb(service.service):
 
     # helper methods
 
+    # While a batch of songs is added or updated, the ids of the already queried
+    # index entries are kept in a dictionary (table, values) -> id
+    _indexids = None
+
     def _queryindex(self, table, indexnames, values):
         " query indexnames in table and return id "
-        newindexentry = False
+        if self._indexids is not None:
+            id = self._indexids.get((table, tuple(values)))
+            if id is not None:
+                return id
         wheres = " AND ".join(["%s = ?" % indexname for indexname in indexnames])
         self.cur.execute("SELECT id FROM %s WHERE %s" % (table, wheres), values)
         r = self.cur.fetchone()
+        if self._indexids is not None:
+            self._indexids[(table, tuple(values))] = r["id"]
         return r["id"]
 
     def _queryregisterindex(self, table, indexnames, values):
         " register in table and return if tuple (id, newentry) "
+        if self._indexids is not None:
+            id = self._indexids.get((table, tuple(values)))
+            if id is not None:
+                return id, False
         newindexentry = False
         wheres = " AND ".join(["%s = ?" % indexname for indexname in indexnames])
         self.cur.execute("SELECT id FROM %s WHERE %s" % (table, wheres), values)
         r = self.cur.fetchone()
         if r is None:
-            self.cur.execute("INSERT INTO %s (%s) VALUES (%s)" % (table, ", ".join(indexnames),
-                                                                  ", ".join(["?"]*len(indexnames))), 
-                             values)
-            self.cur.execute("SELECT id FROM %s WHERE %s" % (table, wheres), values)
-            r = self.cur.fetchone()
+            columns = list(indexnames)
+            insertvalues = list(values)
+            if table in sortedtables:
+                columns.append("sortname")
+                insertvalues.append(metadata.sortkey(values[indexnames.index("name")]))
+            self.cur.execute("INSERT INTO %s (%s) VALUES (%s)" % (table, ", ".join(columns),
+                                                                  ", ".join(["?"]*len(columns))), 
+                             insertvalues)
+            id = self.cur.lastrowid
             newindexentry = True
-        return r["id"], newindexentry
+        else:
+            id = r["id"]
+        if self._indexids is not None:
+            self._indexids[(table, tuple(values))] = id
+        return id, newindexentry
 
     def _checkremoveindex(self, indextable, reftable, indexnames, value):
         "remove entry from indextable if no longer referenced in reftable and return whether this has happened"
@@ -327,84 +796,133 @@ class songdb(service.service):
                                [value]*len(indexnames)).fetchone()[0]
         if num == 0:
             self.cur.execute("DELETE FROM %s WHERE id = ?" % indextable, [value])
+            if self._indexids:
+                # removed entries are rare, so we simply forget all ids
+                self._indexids = {}
             return True
         else:
             return False
 
-    _song_insert = "INSERT INTO songs (%s) VALUES (%s)" % (",".join(songcolumns_all),
-                                                           ",".join(["?"] * len(songcolumns_all)))
+    def _querysongids(self, urls):
+        " return dictionary url -> id for the songs with the given urls "
+        song_ids = {}
+        for i in range(0, len(urls), self._maxidsperquery):
+            chunk = urls[i:i+self._maxidsperquery]
+            for r in self.cur.execute("SELECT id, url FROM songs WHERE url IN (%s)" % ", ".join(["?"] * len(chunk)),
+                                      chunk).fetchall():
+                song_ids[r["url"]] = r["id"]
+        return song_ids
+
+    def _songrow(self, song):
+        " return column values of song in the order of songcolumns_stored "
+        return [getattr(song, columnname) for columnname in songcolumns_w_indices] + [metadata.sortkey(song.title)]
+
+    def _writesongtexts(self, songs):
+        """ store comments and lyrics of songs given as list of (song_id, song metadata) tuples
+
+        Comments or lyrics which have not been loaded (and are thus None) are left untouched.
+        """
+        for table in songcolumns_lists:
+            song_ids = []
+            rows = []
+            for song_id, song in songs:
+                frames = getattr(song, table)
+                if frames is not None:
+                    song_ids.append([song_id])
+                    rows.extend([[song_id, position] + frame
+                                 for position, frame in enumerate(_textframes(frames))])
+            self.cur.executemany("DELETE FROM %s WHERE song_id = ?" % table, song_ids)
+            self.cur.executemany(songtexts_insert % table, rows)
+
+    _search_insert = "INSERT INTO songs_search (rowid, title, album, artist, album_artist, tags) VALUES (?, ?, ?, ?, ?, ?)"
+
+    def _searchrow(self, song_id, song):
+        " return row of full text search index for song "
+        return [song_id, song.title, song.album, song.artist, song.album_artist, " ".join(song.tags)]
+
+    def _notifyindexchanges(self, changedartists, changedalbums, changedtags):
+        if changedartists:
+            hub.notify(events.artistschanged(self.id))
+        if changedalbums:
+            hub.notify(events.albumschanged(self.id))
+        if changedtags:
+            hub.notify(events.tagschanged(self.id))
+
+    _song_insert = "INSERT INTO songs (%s) VALUES (%s)" % (",".join(songcolumns_stored),
+                                                           ",".join(["?"] * len(songcolumns_stored)))
 
     def _add_song(self, song):
         """add song metadata to database"""
-        log.debug("adding song: %r" % song)
+        self._add_songs([song])
+
+    def _add_songs(self, songs):
+        """add list of song metadata to database in a single transaction"""
+        log.debug("adding %d songs" % len(songs))
 
-        if not isinstance(song, metadata.song_metadata):
-            log.error("add_song: song has to be a meta.song instance, not a %r instance" % 
-                      song.__class__)
+        for song in songs:
+            if not isinstance(song, metadata.song_metadata):
+                log.error("add_song: song has to be a meta.song instance, not a %r instance" % 
+                          song.__class__)
+        songs = [song for song in songs if isinstance(song, metadata.song_metadata)]
+        if not songs:
             return
 
         self._txn_begin()
+        self._indexids = {}
         try:
-            # query and register artist, album_artist and album
-            if song.artist:
-                song.artist_id, newartist = self._queryregisterindex("artists", ["name"], [song.artist])
-            else:
-                song.artist_id, newartist = None, False
-            if song.album_artist:
-                song.album_artist_id, newartist2 = self._queryregisterindex("artists", ["name"], 
-                                                                            [song.album_artist])
-                newartist = newartist or newartist2
-                if song.album:
-                    song.album_id, newalbum = self._queryregisterindex("albums", ["artist_id", "name"], 
-                                                                       [song.album_artist_id, song.album])
+            changedartists = changedalbums = changedtags = False
+            for song in songs:
+                # query and register artist, album_artist and album
+                if song.artist:
+                    song.artist_id, newartist = self._queryregisterindex("artists", ["name"], [song.artist])
+                    changedartists |= newartist
                 else:
-                    song.album_id, newalbum = None, False
-            else:
-                song.album_artist_id = None
-                song.album_id = None
-                newalbum = False
-
-            # pickle the comments and lyrics lists
-            comments = dumps(song.comments)
-            lyrics = dumps(song.lyrics)
-
-            # register song
-            self.cur.execute(self._song_insert,
-                             [getattr(song, columnname) for columnname in songcolumns_w_indices] + [comments, lyrics])
+                    song.artist_id = None
+                if song.album_artist:
+                    song.album_artist_id, newartist = self._queryregisterindex("artists", ["name"], 
+                                                                               [song.album_artist])
+                    changedartists |= newartist
+                    if song.album:
+                        song.album_id, newalbum = self._queryregisterindex("albums", ["artist_id", "name"], 
+                                                                           [song.album_artist_id, song.album])
+                        changedalbums |= newalbum
+                    else:
+                        song.album_id = None
+                else:
+                    song.album_artist_id = None
+                    song.album_id = None
 
-            self.cur.execute("SELECT id FROM songs WHERE url = ?", (song.url,))
-            r = self.cur.fetchone()
-            song_id = r["id"]
+            # register songs
+            self.cur.executemany(self._song_insert, [self._songrow(song) for song in songs])
+            song_ids = self._querysongids([song.url for song in songs])
+            self._writesongtexts([(song_ids[song.url], song) for song in songs])
 
             # register song tags
-            newtag = False
-            for tag in song.tags:
-                tag_id, newtag2 = self._queryregisterindex("tags", ["name"], [tag])
-                newtag = newtag or newtag2
-                self.cur.execute("INSERT INTO taggings (song_id, tag_id) VALUES (?, ?)", 
-                                 (song_id, tag_id))
+            taggings = []
+            for song in songs:
+                for tag in song.tags:
+                    tag_id, newtag = self._queryregisterindex("tags", ["name"], [tag])
+                    changedtags |= newtag
+                    taggings.append((song_ids[song.url], tag_id))
+            self.cur.executemany("INSERT INTO taggings (song_id, tag_id) VALUES (?, ?)", taggings)
+
+            if self.fulltextsearch:
+                self.cur.executemany(self._search_insert,
+                                     [self._searchrow(song_ids[song.url], song) for song in songs])
         except:
+            self._indexids = None
             self._txn_abort()
             raise
         else:
+            self._indexids = None
             self._txn_commit()
-            if newartist:
-                hub.notify(events.artistschanged(self.id))
-            if newalbum:
-                hub.notify(events.albumschanged(self.id))
-            if newtag:
-                hub.notify(events.tagschanged(self.id))
+            self._updatesampler(song_ids.values())
+            self._updatebitsets(song_ids.values())
+            self._notifyindexchanges(changedartists, changedalbums, changedtags)
             # we don't issue a songschanged event because the resulting queries put a too high load 
             # on the database
             # hub.notify(events.songschanged(self.id))
 
-            #for r in cur.execute("SELECT id, name FROM artists"):
-            #    log.info("AR: %r %r" % (r["id"], r["name"]))
-            #for r in cur.execute("SELECT id, artist_id, name FROM albums"):
-            #    log.info("AL: %r %r %r" % (r["id"], r["artist_id"], r["name"]))
-            #for r in cur.execute("SELECT id, title FROM songs"):
-            #    log.info("S: %r %r" % (r["id"], r["title"]))
-
     def _delete_song(self, song):
         """delete song from database"""
         log.debug("delete song: %r" % song)
@@ -415,6 +933,10 @@ class songdb(service.service):
         try:
             # remove song
             self.cur.execute("DELETE FROM songs WHERE id = ?", [song.id])
+            for table in songcolumns_lists:
+                self.cur.execute("DELETE FROM %s WHERE song_id = ?" % table, [song.id])
+            if self.fulltextsearch:
+                self.cur.execute("DELETE FROM songs_search WHERE rowid = ?", [song.id])
 
             # remove corresponding album and artists
             deletedalbum = self._checkremoveindex("albums", "songs", ["album_id"], song.album_id)
@@ -442,125 +964,141 @@ class songdb(service.service):
             raise
         else:
             self._txn_commit()
-            if deletedartist:
-                hub.notify(events.artistschanged(self.id))
-            if deletedalbum:
-                hub.notify(events.albumschanged(self.id))
-            if deletedtag:
-                hub.notify(events.tagschanged(self.id))
+            self._updatesampler([song.id])
+            self._updatebitsets([song.id])
+            self._notifyindexchanges(deletedartist, deletedalbum, deletedtag)
         # XXX send event?
 
     _song_update = ( "INSERT OR REPLACE INTO songs (id, %s) VALUES (?, %s)" % 
-                     (",".join(songcolumns_all), ",".join(["?"] * len(songcolumns_all))) )
+                     (",".join(songcolumns_stored), ",".join(["?"] * len(songcolumns_stored))) )
 
     def _update_song(self, song):
         """updates entry of song"""
-        log.debug("updating song %r" % song)
-        if not isinstance(song, item.song):
-            log.error("_update_song: song has to be a item.song instance, not a %r instance" %
-                      newsong.__class__)
-            return
-        if not song.song_metadata:
-            log.error("_update_song: song doesn't contain song metadata")
+        self._update_songs([song])
+
+    def _update_songs(self, songs):
+        """updates entries of list of songs in a single transaction"""
+        log.debug("updating %d songs" % len(songs))
+        for song in songs:
+            if not isinstance(song, item.song):
+                log.error("_update_song: song has to be a item.song instance, not a %r instance" %
+                          song.__class__)
+            elif not song.song_metadata:
+                log.error("_update_song: song doesn't contain song metadata")
+        songs = [song for song in songs if isinstance(song, item.song) and song.song_metadata]
+        oldsongs = self._getsongs_metadata([song.id for song in songs])
+        for song, oldsong in zip(songs, oldsongs):
+            if oldsong is None:
+                log.error("_update_song: song %r not found in database" % song)
+        songs = [(song, oldsong) for song, oldsong in zip(songs, oldsongs) if oldsong is not None]
+        if not songs:
             return
-        oldsong = self._getsong_metadata(song.id)
 
         self._txn_begin()
+        self._indexids = {}
         try:
-
-            # query artist, album_artist and album of oldsong (in comparison to the _add_song method, we do not have
-            # to add entries to the indices
-            if oldsong.artist:
-                oldsong.artist_id = self._queryindex("artists", ["name"], [oldsong.artist])
-            else:
-                oldsong.artist_id = None
-            if oldsong.album_artist:
-                oldsong.album_artist_id = self._queryindex("artists", ["name"], [oldsong.album_artist])
-                if oldsong.album:
-                    oldsong.album_id = self._queryindex("albums", ["artist_id", "name"], [oldsong.album_artist_id, oldsong.album])
-                else:
-                    oldsong.album_id = None
-            else:
-                oldsong.album_artist_id = None
-                oldsong.album_id = None
-
             # flags for changes of corresponding tables
             changedartists = False
             changedalbums = False
             changedtags = False
-            # register new artists, album_artists and albums if necessary
-            if oldsong.artist != song.artist:
-                if song.artist:
-                    song.artist_id, newartist = self._queryregisterindex("artists", ["name"], [song.artist])
-                    changedartists |= newartist
+
+            for song, oldsong in songs:
+                # query artist, album_artist and album of oldsong (in comparison to the _add_song method, we do not have
+                # to add entries to the indices
+                if oldsong.artist:
+                    oldsong.artist_id = self._queryindex("artists", ["name"], [oldsong.artist])
                 else:
-                    song.artist_id = None
-            if oldsong.album_artist != song.album_artist:
-                if song.album_artist:
-                    song.album_artist_id, newartist = self._queryregisterindex("artists", ["name"], [song.album_artist])
-                    changedartists |= newartist
-                    if song.album:
-                        song.album_id, newalbum = self._queryregisterindex("albums", ["artist_id", "name"], 
-                                                                           [song.album_artist_id, song.album])
-                        changedalbums |= newalbum
+                    oldsong.artist_id = None
+                if oldsong.album_artist:
+                    oldsong.album_artist_id = self._queryindex("artists", ["name"], [oldsong.album_artist])
+                    if oldsong.album:
+                        oldsong.album_id = self._queryindex("albums", ["artist_id", "name"], [oldsong.album_artist_id, oldsong.album])
                     else:
-                        song.album_id = None
+                        oldsong.album_id = None
                 else:
-                    song.album_artist_id = None
-                    song.album_id = None
-            elif oldsong.album != song.album and song.album:
-                # only the album name changed
-                song.album_id, newalbum = self._queryregisterindex("albums", ["artist_id", "name"], 
-                                                                   [song.album_artist_id, song.album])
-                changedalbums |= newalbum
+                    oldsong.album_artist_id = None
+                    oldsong.album_id = None
 
-            # encode the comments and lyrics lists
-            comments = dumps(song.comments)
-            lyrics = dumps(song.lyrics)
+                # register new artists, album_artists and albums if necessary
+                if oldsong.artist != song.artist:
+                    if song.artist:
+                        song.artist_id, newartist = self._queryregisterindex("artists", ["name"], [song.artist])
+                        changedartists |= newartist
+                    else:
+                        song.artist_id = None
+                if oldsong.album_artist != song.album_artist:
+                    if song.album_artist:
+                        song.album_artist_id, newartist = self._queryregisterindex("artists", ["name"], [song.album_artist])
+                        changedartists |= newartist
+                        if song.album:
+                            song.album_id, newalbum = self._queryregisterindex("albums", ["artist_id", "name"], 
+                                                                               [song.album_artist_id, song.album])
+                            changedalbums |= newalbum
+                        else:
+                            song.album_id = None
+                    else:
+                        song.album_artist_id = None
+                        song.album_id = None
+                elif oldsong.album != song.album and song.album:
+                    # only the album name changed
+                    song.album_id, newalbum = self._queryregisterindex("albums", ["artist_id", "name"], 
+                                                                       [song.album_artist_id, song.album])
+                    changedalbums |= newalbum
 
             # update songs table
-            self.cur.execute(self._song_update, 
-                            [song.id]+[getattr(song, columnname) for columnname in songcolumns_w_indices] + [comments, lyrics])
-
-            # delete old artists, album_artists and albums if necessary
-            # we have to do this after the songs table has been updated, otherwise we
-            # cannot detect whether we have to remove an album/artist or not
-            if oldsong.album != song.album:
-                changedalbums |= self._checkremoveindex("albums", "songs", ["album_id"], song.album_id)
-            if oldsong.artist != song.artist:
-                changedartists |= self._checkremoveindex("artists", "songs", ["album_artist_id", "artist_id"],
-                                                         oldsong.artist_id)
-            if oldsong.album_artist != song.album_artist:
-                changedartists |= self._checkremoveindex("artists", "songs", ["album_artist_id", "artist_id"],
-                                                         oldsong.album_artist_id)
-
-            # update tag information if necessary
-            if oldsong.tags != song.tags:
-                # check for new tags
-                for tag in song.tags:
-                    if tag not in oldsong.tags:
-                        tag_id, newtag = self._queryregisterindex("tags", ["name"], [tag])
-                        changedtags |= newtag
-                        self.cur.execute("INSERT INTO taggings (song_id, tag_id) VALUES (?, ?)", 
-                                         (song.id, tag_id))
-                # check for removed tags
-                for tag in oldsong.tags:
-                    if tag not in song.tags:
-                        tag_id = self._queryregisterindex("tags", ["name"], [tag])[0]
-                        self.cur.execute("DELETE FROM taggings WHERE (tag_id = ? AND song_id = ?)", [tag_id, song.id])
-                        changedtags |= self._checkremoveindex("tags", "taggings", ["tag_id"], tag_id)
+            self.cur.executemany(self._song_update, [[song.id] + self._songrow(song) for song, oldsong in songs])
+            # note that we must not access comments and lyrics via song, since this may query them from us
+            self._writesongtexts([(song.id, song.song_metadata) for song, oldsong in songs])
+
+            if self.fulltextsearch:
+                changedsongs = [(song, oldsong) for song, oldsong in songs
+                                if self._searchrow(song.id, song) != self._searchrow(song.id, oldsong)]
+                self.cur.executemany("DELETE FROM songs_search WHERE rowid = ?",
+                                     [(song.id,) for song, oldsong in changedsongs])
+                self.cur.executemany(self._search_insert,
+                                     [self._searchrow(song.id, song) for song, oldsong in changedsongs])
+
+            taggings = []
+            for song, oldsong in songs:
+                # delete old artists, album_artists and albums if necessary
+                # we have to do this after the songs table has been updated, otherwise we
+                # cannot detect whether we have to remove an album/artist or not
+                if oldsong.album != song.album or oldsong.album_artist != song.album_artist:
+                    changedalbums |= self._checkremoveindex("albums", "songs", ["album_id"], oldsong.album_id)
+                if oldsong.artist != song.artist:
+                    changedartists |= self._checkremoveindex("artists", "songs", ["album_artist_id", "artist_id"],
+                                                             oldsong.artist_id)
+                if oldsong.album_artist != song.album_artist:
+                    changedartists |= self._checkremoveindex("artists", "songs", ["album_artist_id", "artist_id"],
+                                                             oldsong.album_artist_id)
+
+                # update tag information if necessary
+                if oldsong.tags != song.tags:
+                    # check for new tags
+                    for tag in song.tags:
+                        if tag not in oldsong.tags:
+                            tag_id, newtag = self._queryregisterindex("tags", ["name"], [tag])
+                            changedtags |= newtag
+                            taggings.append((song.id, tag_id))
+                    # check for removed tags
+                    for tag in oldsong.tags:
+                        if tag not in song.tags:
+                            tag_id = self._queryregisterindex("tags", ["name"], [tag])[0]
+                            self.cur.execute("DELETE FROM taggings WHERE (tag_id = ? AND song_id = ?)", [tag_id, song.id])
+                            changedtags |= self._checkremoveindex("tags", "taggings", ["tag_id"], tag_id)
+            self.cur.executemany("INSERT INTO taggings (song_id, tag_id) VALUES (?, ?)", taggings)
         except:
+            self._indexids = None
             self._txn_abort()
             raise
         else:
+            self._indexids = None
             self._txn_commit()
-            if changedartists:
-                hub.notify(events.artistschanged(self.id))
-            if changedalbums:
-                hub.notify(events.albumschanged(self.id))
-            if changedtags:
-                hub.notify(events.tagschanged(self.id))
-        hub.notify(events.songchanged(self.id, song))
+            self._updatesampler([song.id for song, oldsong in songs])
+            self._updatebitsets([song.id for song, oldsong in songs])
+            self._notifyindexchanges(changedartists, changedalbums, changedtags)
+        for song, oldsong in songs:
+            hub.notify(events.songchanged(self.id, song))
 
     def _song_played(self, song, date_played):
         """register playing of song"""
@@ -571,17 +1109,39 @@ class songdb(service.service):
         self._txn_begin()
         try:
             self.cur.execute("INSERT INTO playstats (song_id, date_played) VALUES (?, ?)", [song.id, date_played])
+            day = int(date_played // 86400)
+            self.cur.execute("""INSERT OR IGNORE INTO playstats_daily (song_id, day, playcount, date_lastplayed)
+                                VALUES (?, ?, 0, ?)""", [song.id, day, date_played])
+            self.cur.execute("""UPDATE playstats_daily SET playcount = playcount+1,
+                                                           date_lastplayed = max(date_lastplayed, ?)
+                                WHERE song_id = ? AND day = ?""", [date_played, song.id, day])
             self.cur.execute("UPDATE songs SET playcount = playcount+1, date_lastplayed = ? WHERE id = ?", [date_played, song.id])
-            song.playcount += 1
-            song.date_lastplayed = date_played
-            song.dates_played.append(date_played)
+            if date_played - self.playstatspruned > 86400:
+                self._pruneplaystats(date_played)
+            # Note that we must not access the metadata attributes of song directly,
+            # since this may query the metadata from us.
+            if song.song_metadata:
+                song.song_metadata.playcount += 1
+                song.song_metadata.date_lastplayed = date_played
+                song.song_metadata.dates_played.append(date_played)
         except:
             self._txn_abort()
             raise
         else:
             self._txn_commit()
+            self._updatesampler([song.id])
         hub.notify(events.songchanged(self.id, song))
 
+    def _pruneplaystats(self, currenttime):
+        """ remove playing times which have expired according to the configured retention period
+
+        Their number per day is kept in playstats_daily.
+        """
+        self.playstatspruned = currenttime
+        if self.playstatsretention > 0:
+            self.cur.execute("DELETE FROM playstats WHERE date_played < ?",
+                             [currenttime - self.playstatsretention * 86400])
+
     def _song_skipped(self, song):
         """register skipping of song"""
         log.debug("skipping song: %r" % song)
@@ -591,12 +1151,14 @@ class songdb(service.service):
         self._txn_begin()
         try:
             self.cur.execute("UPDATE songs SET skipcount = skipcount+1 WHERE id = ?", [song.id])
-            song.skipcount += 1
+            if song.song_metadata:
+                song.song_metadata.skipcount += 1
         except:
             self._txn_abort()
             raise
         else:
             self._txn_commit()
+            self._updatesampler([song.id])
         hub.notify(events.songchanged(self.id, song))
 
     def _add_playlist(self, name, songs):
@@ -606,7 +1168,8 @@ class songdb(service.service):
 
         self._txn_begin()
         try:
-            self.cur.execute("INSERT OR REPLACE INTO playlists (name) VALUES (?)", [name])
+            self.cur.execute("INSERT OR REPLACE INTO playlists (name, sortname) VALUES (?, ?)",
+                             [name, metadata.sortkey(name)])
             self.cur.execute("SELECT id FROM playlists WHERE name = ?", [name])
             r = self.cur.fetchone()
             playlist_id = r["id"]
@@ -644,70 +1207,252 @@ class songdb(service.service):
     # !!! It is not save to call any of the following methods when a transaction is active !!!
     ##########################################################################################
 
-    _song_select = """SELECT %s, artists.name AS artist, albums.name AS album 
-                      FROM songs 
-                      LEFT JOIN albums ON albums.id == album_id
-                      LEFT JOIN artists ON artists.id == songs.artist_id
-                      WHERE songs.id = ?
-                      """ % ", ".join([c for c in songcolumns_all if c!="artist_id"])
-
-    _song_tags_select = """SELECT tags.name AS name FROM tags
-                           JOIN taggings ON taggings.tag_id = tags.id
-                           WHERE taggings.song_id = ?"""
-
-    _song_playstats_select = "SELECT date_played FROM playstats WHERE song_id = ?"
-
-    def _getsong_metadata(self, song_id):
-        """return song entry with given song_id"""
-        log.debug("Querying song metadata for id=%r" % song_id)
-        try:
-            r = self.con.execute(self._song_select, [song_id]).fetchone()
-            if r:
-                # fetch album artist
-                if r["album_artist_id"] is not None:
-                    select = """SELECT name FROM artists WHERE id = ?"""
-                    album_artist = self.con.execute(select, (r["album_artist_id"],)).fetchone()["name"]
-                else:
-                    album_artist = None
-
-                # fetch tags
-                tags = []
-                for tr in self.con.execute(self._song_tags_select, [song_id]):
-                    tags.append(tr["name"])
-
-                # fetch playstats
-                dates_played = []
-                for tr in self.con.execute(self._song_playstats_select, [song_id]):
-                    dates_played.append(tr["date_played"])
-
-                # generate and populate metadata
+    _songs_select = """SELECT songs.id AS song_id, %s,
+                              artists.name AS artist, albums.name AS album, album_artists.name AS album_artist
+                       FROM songs
+                       LEFT JOIN albums  ON albums.id == songs.album_id
+                       LEFT JOIN artists ON artists.id == songs.artist_id
+                       LEFT JOIN artists AS album_artists ON album_artists.id == songs.album_artist_id
+                       WHERE songs.id IN (%%s)
+                       """ % ", ".join(["songs.%s AS %s" % (c, c) for c in songcolumns_w_indices if c!="artist_id"])
+
+    _songs_tags_select = """SELECT taggings.song_id AS song_id, tags.name AS name FROM tags
+                            JOIN taggings ON taggings.tag_id = tags.id
+                            WHERE taggings.song_id IN (%s)"""
+
+    # number of the most recent playing times loaded with the song metadata
+    _ndatesplayed = 5
+
+    _songs_playstats_select = """SELECT song_id, date_played FROM playstats AS p
+                                 WHERE song_id IN (%%s) AND
+                                       date_played >= coalesce((SELECT date_played FROM playstats
+                                                                WHERE song_id = p.song_id
+                                                                ORDER BY date_played DESC
+                                                                LIMIT 1 OFFSET %d), 0)
+                                 ORDER BY song_id, date_played""" % (_ndatesplayed-1)
+
+    # maximal number of song ids passed in a single IN clause (SQLite limits the
+    # number of host parameters per statement)
+    _maxidsperquery = 500
+
+    def _getsongs_metadata(self, song_ids):
+        """return list of song entries with given song_ids (None for songs not found)
+
+        Independent of the number of songs, only a small number of set-based
+        queries is issued.
+        """
+        log.debug("Querying song metadata for %d ids" % len(song_ids))
+        mds = {}
+        for i in range(0, len(song_ids), self._maxidsperquery):
+            chunk = list(song_ids[i:i+self._maxidsperquery])
+            placeholders = ", ".join(["?"] * len(chunk))
+            for r in self.con.execute(self._songs_select % placeholders, chunk):
                 md = metadata.song_metadata()
                 for field in songcolumns_plain:
                     md[field] = r[field]
                 md.album = r["album"]
                 md.artist = r["artist"]
-                md.album_artist = album_artist
-                md.tags = tags
-                md.comments = loads(r["comments"])
-                md.lyrics = loads(r["lyrics"])
-                md.dates_played = dates_played
-                return md
-            else:
+                md.album_artist = r["album_artist"]
+                md.tags = []
+                # comments and lyrics are loaded on demand, see _getsong_texts
+                md.comments = md.lyrics = None
+                md.dates_played = []
+                mds[r["song_id"]] = md
+
+            # fetch tags
+            for r in self.con.execute(self._songs_tags_select % placeholders, chunk):
+                md = mds.get(r["song_id"])
+                if md is not None:
+                    md.tags.append(r["name"])
+
+            # fetch the most recent playing times
+            for r in self.con.execute(self._songs_playstats_select % placeholders, chunk):
+                md = mds.get(r["song_id"])
+                if md is not None:
+                    md.dates_played.append(r["date_played"])
+
+        return [mds.get(song_id) for song_id in song_ids]
+
+    def _getsong_texts(self, song_id):
+        """ return comments and lyrics of song as tuple of lists of (language, description, text) tuples """
+        result = []
+        for table in songcolumns_lists:
+            result.append([(r["language"], r["description"], r["text"])
+                           for r in self.con.execute("""SELECT language, description, text FROM %s
+                                                        WHERE song_id = ? ORDER BY position""" % table,
+                                                     [song_id])])
+        return tuple(result)
+
+    def _getsong_metadata(self, song_id):
+        """return song entry with given song_id"""
+        log.debug("Querying song metadata for id=%r" % song_id)
+        try:
+            md = self._getsongs_metadata([song_id])[0]
+            if md is None:
                 log.debug("Song '%d' not found in database" % song_id)
-                return None
+            return md
         except:
             log.debug_traceback()
             return None
 
+    def _getsongfilesinfo(self):
+        """return dict url -> (song, date_updated, size) for all songs in the database"""
+        result = {}
+        for row in self.con.execute("""SELECT id, album_id, artist_id, album_artist_id, url, date_updated, size
+                                       FROM songs"""):
+            song = item.song(self.id, row["id"], row["album_id"], row["artist_id"], row["album_artist_id"])
+            result[row["url"]] = song, row["date_updated"], row["size"]
+        return result
+
     def _gettag_id(self, tag_name):
         return self.con.execute("SELECT id FROM tags WHERE name = ?", [tag_name]).fetchone()[0]
 
-    def _getsongs(self, sort=None, filters=None):
-        """ returns songs filtered according to filters"""
+    # tag, rating and compilation filters evaluated by means of in-memory bitsets
+
+    def _getbitsets(self):
+        """ return bitsets of the songs with a given tag, rating or compilation flag, setting them up if necessary """
+        self.bitsetslock.acquire()
+        try:
+            if self.bitsets is None:
+                songs = self.con.execute("SELECT id, rating, compilation FROM songs")
+                taggings = self.con.execute("""SELECT taggings.song_id, tags.name FROM taggings
+                                               JOIN tags ON (tags.id = taggings.tag_id)""")
+                self.bitsets = bitsets.songbitsets(songs, taggings)
+            return self.bitsets
+        finally:
+            self.bitsetslock.release()
+
+    def _updatebitsets(self, song_ids):
+        """ update bitsets for songs with song_ids after they have been changed in the database """
+        # cf. _updatesampler
+        self.bitsetslock.acquire()
+        try:
+            if self.bitsets is None:
+                return
+            song_ids = list(song_ids)
+            for i in range(0, len(song_ids), self._maxidsperquery):
+                chunk = song_ids[i:i+self._maxidsperquery]
+                idstring = ", ".join(["?"] * len(chunk))
+                songs = self.con.execute("SELECT id, rating, compilation FROM songs WHERE id IN (%s)" % idstring,
+                                         chunk).fetchall()
+                taggings = self.con.execute("""SELECT taggings.song_id, tags.name FROM taggings
+                                               JOIN tags ON (tags.id = taggings.tag_id)
+                                               WHERE taggings.song_id IN (%s)""" % idstring, chunk).fetchall()
+                self.bitsets.update(chunk, songs, taggings)
+        finally:
+            self.bitsetslock.release()
+
+    def _splitfilters(self, filters):
+        """ evaluate tag, rating and compilation filters by means of the bitsets
+
+        Returns a tuple (selected, all, key, remainingfilters), where selected is the
+        bitset of the songs passing these filters, all the one of all songs, key
+        identifies selected as long as the bitsets are not updated and
+        remainingfilters the filters which have to be evaluated by the database. If
+        there are no filters to be evaluated by means of the bitsets, selected, all
+        and key are None.
+        """
+        conditions = []
+        remainingfilters = []
+        for filter in filters or ():
+            if isinstance(filter, item.tagfilter):
+                conditions.append(("tag", filter.tag_name, filter.inverted))
+            elif isinstance(filter, item.ratingfilter):
+                conditions.append(("rating", filter.rating or None, False))
+            elif isinstance(filter, item.compilationfilter):
+                conditions.append(("compilation", None, not filter.iscompilation))
+            else:
+                remainingfilters.append(filter)
+        if not conditions:
+            return None, None, None, filters
+        selected, all, generation = self._getbitsets().select(conditions)
+        return selected, all, (generation, tuple(conditions)), item.filters(remainingfilters)
+
+    def _compilefilters(self, filters):
+        """ return filters for the database with tag, rating and compilation filters replaced by a song id filter
+
+        Only the smaller one of the sets of matching and non-matching songs is handed to
+        the database and the song id filter is omitted if all songs pass.
+        """
+        selected, all, key, filters = self._splitfilters(filters)
+        if selected is None or selected == all:
+            return filters
+        excluded = all & ~selected
+        inverted = bitsets.count(selected) > bitsets.count(excluded)
+        bitset = inverted and excluded or selected
+        table = self._getsongidstable(key, bitset)
+        if table is not None:
+            return filters.added(_songidsfilter(inverted, table=table))
+        else:
+            return filters.added(_songidsfilter(inverted, song_ids=bitsets.toids(bitset)))
+
+    # number of temporary tables holding sets of song ids kept per connection
+    _nsongidstables = 8
+
+    def _getsongidstable(self, key, bitset):
+        """ return name of a temporary table holding the song ids contained in bitset
+
+        Each connection keeps the sets of song ids of the last used selections in
+        temporary tables, such that SQLite neither has to parse them as part of
+        every statement nor do we have to convert them each time. The table is
+        identified by key, see _splitfilters. None is returned if no table can be
+        set up because the writer is in the middle of a transaction.
+        """
+        readonly = getattr(self._local, "readonly", False)
+        # list of (key, table name) tuples, least recently used first
+        tables = getattr(self._local, "songidstables", None)
+        if tables is None:
+            tables = self._local.songidstables = []
+        for i, (tablekey, table) in enumerate(tables):
+            if tablekey == key:
+                tables.append(tables.pop(i))
+                return table
+        # Setting up the temporary table would commit a running transaction of the writer.
+        if not readonly and self.cur is not None:
+            return None
+        # Temporary tables are private to the connection, but SQLite does not
+        # allow to change them on a read-only connection, either.
+        if readonly:
+            self.con.execute("PRAGMA query_only = OFF")
+        try:
+            if len(tables) < self._nsongidstables:
+                table = "songids%d" % len(tables)
+            else:
+                table = tables.pop(0)[1]
+            self.con.execute("CREATE TEMP TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY)" % table)
+            self.con.execute("DELETE FROM temp.%s" % table)
+            self.con.executemany("INSERT INTO temp.%s VALUES (?)" % table, zip(bitsets.toids(bitset)))
+            self.con.commit()
+        finally:
+            if readonly:
+                self.con.execute("PRAGMA query_only = ON")
+        tables.append((key, table))
+        return table
+
+    def _getsongs(self, sort=None, filters=None, limit=None, offset=0, after=None):
+        """ returns songs filtered according to filters
+
+        If limit is set, only the page of at most limit songs following the
+        song with sort key after or, if after is None, starting at offset
+        is returned.
+        """
+        filters = self._compilefilters(filters)
         joinstring = filters and filters.SQL_JOIN_string() or ""
         wherestring = filters and filters.SQL_WHERE_string() or ""
         orderstring = sort and sort.SQL_string() or ""
+        limitstring = ""
+        if sort and hasattr(sort, "SQL_JOIN_string"):
+            # the order may depend on further tables
+            joinstring = "%s\n%s" % (sort.SQL_JOIN_string(), joinstring)
         args = filters and filters.SQL_args() or []
+        if limit is not None:
+            keys = sort and hasattr(sort, "SQL_keys") and sort.SQL_keys()
+            if keys:
+                wherestring, orderstring, limitstring, args = _SQL_page(wherestring, args, keys,
+                                                                        limit, offset, after)
+            else:
+                # without a unique sort key, we can only skip songs
+                limitstring = "LIMIT %d OFFSET %d" % (limit, offset)
         select = """SELECT songs.id              AS song_id,
                            songs.album_id        AS album_id,
                            songs.artist_id       AS artist_id,
@@ -718,32 +1463,53 @@ class songdb(service.service):
                     %s
                     %s
                     %s
-                    """ % (joinstring, wherestring, orderstring)
+                    %s
+                    """ % (joinstring, wherestring, orderstring, limitstring)
         # log.debug(select)
         return  [item.song(self.id, row["song_id"], row["album_id"], row["artist_id"], row["album_artist_id"])
                  for row in self.con.execute(select, args)]
 
-    def _getartists(self, filters=None):
-        """return artists filtered according to filters"""
-        joinstring = filters and filters.SQL_JOIN_string() or ""
-        wherestring = filters and filters.SQL_WHERE_string() or ""
-        args = filters and filters.SQL_args() or []
+    def _getartists(self, filters=None, limit=None, offset=0, after=None):
+        """return artists filtered according to filters
+
+        If limit is set, only the page of at most limit artists following the
+        artist with key (sort key of name, id) after or, if after is None, starting at offset
+        is returned.
+        """
+        sqlfilters = self._compilefilters(filters)
+        joinstring = sqlfilters and sqlfilters.SQL_JOIN_string() or ""
+        wherestring = sqlfilters and sqlfilters.SQL_WHERE_string() or ""
+        args = sqlfilters and sqlfilters.SQL_args() or []
+        wherestring, orderstring, limitstring, args = _SQL_page(wherestring, args,
+                                                                ["artists.sortname", "artists.id"],
+                                                                limit, offset, after)
         select = """SELECT DISTINCT artists.id AS artist_id, artists.name AS artist_name
                     FROM artists 
                     JOIN songs         ON (songs.artist_id = artists.id)
                     LEFT JOIN albums   ON (album_id = albums.id)
                     %s
                     %s
-                    ORDER BY artists.name COLLATE NOCASE""" % (joinstring, wherestring)
+                    %s
+                    %s""" % (joinstring, wherestring, orderstring, limitstring)
         # log.debug(select)
         return [item.artist(self.id, row["artist_id"], row["artist_name"], filters)
                 for row in self.con.execute(select, args)]
 
-    def _getalbums(self, filters=None):
-        """return albums filtered according to filters"""
-        joinstring = filters and filters.SQL_JOIN_string() or ""
-        wherestring = filters and filters.SQL_WHERE_string() or ""
-        args = filters and filters.SQL_args() or []
+    def _getalbums(self, filters=None, limit=None, offset=0, after=None):
+        """return albums filtered according to filters
+
+        If limit is set, only the page of at most limit albums following the
+        album with key (sort key of name, id, artist name) after or, if after is None,
+        starting at offset is returned.
+        """
+        sqlfilters = self._compilefilters(filters)
+        joinstring = sqlfilters and sqlfilters.SQL_JOIN_string() or ""
+        wherestring = sqlfilters and sqlfilters.SQL_WHERE_string() or ""
+        args = sqlfilters and sqlfilters.SQL_args() or []
+        wherestring, orderstring, limitstring, args = _SQL_page(wherestring, args,
+                                                                ["albums.sortname", "albums.id",
+                                                                 "artists.name"],
+                                                                limit, offset, after)
         # Hackish, but effective to allow collections show up in artists view
         if filters.contains(item.artistfilter):
             artist_id_column = "artist_id"
@@ -755,7 +1521,8 @@ class songdb(service.service):
                    JOIN songs    ON (songs.album_id = albums.id)
                    %s
                    %s
-                   ORDER BY albums.name COLLATE NOCASE""" % (artist_id_column, joinstring, wherestring)
+                   %s
+                   %s""" % (artist_id_column, joinstring, wherestring, orderstring, limitstring)
 
         # log.debug(select)
         return [item.album(self.id, row["album_id"], row["artist_name"], row["album_name"], filters)
@@ -763,16 +1530,17 @@ class songdb(service.service):
 
     def _gettags(self, filters=None):
         """return tags filtered according to filters"""
-        joinstring = filters and filters.SQL_JOIN_string() or ""
-        wherestring = filters and filters.SQL_WHERE_string() or ""
-        args = filters and filters.SQL_args() or []
+        sqlfilters = self._compilefilters(filters)
+        joinstring = sqlfilters and sqlfilters.SQL_JOIN_string() or ""
+        wherestring = sqlfilters and sqlfilters.SQL_WHERE_string() or ""
+        args = sqlfilters and sqlfilters.SQL_args() or []
         select ="""SELECT DISTINCT tags.id AS tag_id, tags.name AS tag_name
                    FROM tags
                    JOIN taggings ON (taggings.tag_id = tags.id)
                    JOIN songs ON (songs.id = taggings.song_id)
                    %s
                    %s
-                   ORDER BY tags.name COLLATE NOCASE""" % (joinstring, wherestring)
+                   ORDER BY tags.sortname""" % (joinstring, wherestring)
         # log.debug(select)
         return [item.tag(self.id, row["tag_id"], row["tag_name"], filters)
                 for row in self.con.execute(select, args)]
@@ -781,21 +1549,101 @@ class songdb(service.service):
         """return all stored ratings"""
         return []
 
+    # counts and aggregates, which are computed by the database without
+    # materializing the corresponding items
+
+    def _getnumberofsongs(self, filters=None):
+        """return number of songs matching filters"""
+        filters = self._compilefilters(filters)
+        if not filters:
+            return self.con.execute("SELECT count(*) FROM songs").fetchone()[0]
+        select = """SELECT count(*)
+                    FROM songs
+                    LEFT JOIN artists   ON (songs.artist_id = artists.id)
+                    LEFT JOIN albums    ON (songs.album_id = albums.id)
+                    %s
+                    %s""" % (filters.SQL_JOIN_string() or "", filters.SQL_WHERE_string() or "")
+        return self.con.execute(select, filters.SQL_args()).fetchone()[0]
+
+    def _getnumberofartists(self, filters=None):
+        """return number of artists matching filters"""
+        filters = self._compilefilters(filters)
+        if not filters:
+            return self.con.execute("SELECT count(*) FROM artists").fetchone()[0]
+        select = """SELECT count(DISTINCT artists.id)
+                    FROM artists
+                    JOIN songs         ON (songs.artist_id = artists.id)
+                    LEFT JOIN albums   ON (album_id = albums.id)
+                    %s
+                    %s""" % (filters.SQL_JOIN_string() or "", filters.SQL_WHERE_string() or "")
+        return self.con.execute(select, filters.SQL_args()).fetchone()[0]
+
+    def _getnumberofalbums(self, filters=None):
+        """return number of albums matching filters"""
+        filters = self._compilefilters(filters)
+        if not filters:
+            return self.con.execute("SELECT count(*) FROM albums").fetchone()[0]
+        # cf. _getalbums
+        if filters.contains(item.artistfilter):
+            artist_id_column = "artist_id"
+        else:
+            artist_id_column = "album_artist_id"
+        select = """SELECT count(DISTINCT albums.id)
+                    FROM albums
+                    JOIN artists  ON (songs.%s = artists.id)
+                    JOIN songs    ON (songs.album_id = albums.id)
+                    %s
+                    %s""" % (artist_id_column, filters.SQL_JOIN_string() or "",
+                                     filters.SQL_WHERE_string() or "")
+        return self.con.execute(select, filters.SQL_args()).fetchone()[0]
+
+    def _getnumberoftags(self, filters=None):
+        """return number of tags matching filters"""
+        filters = self._compilefilters(filters)
+        if not filters:
+            return self.con.execute("SELECT count(*) FROM tags").fetchone()[0]
+        select = """SELECT count(DISTINCT tags.id)
+                    FROM tags
+                    JOIN taggings ON (taggings.tag_id = tags.id)
+                    JOIN songs ON (songs.id = taggings.song_id)
+                    %s
+                    %s""" % (filters.SQL_JOIN_string() or "", filters.SQL_WHERE_string() or "")
+        return self.con.execute(select, filters.SQL_args()).fetchone()[0]
+
+    def _getsongsaggregates(self, filters=None):
+        """return songsaggregates instance for the songs matching filters"""
+        filters = self._compilefilters(filters)
+        joinstring = filters and filters.SQL_JOIN_string() or ""
+        wherestring = filters and filters.SQL_WHERE_string() or ""
+        args = filters and filters.SQL_args() or []
+        if filters:
+            joinstring = """LEFT JOIN artists   ON (songs.artist_id = artists.id)
+                            LEFT JOIN albums    ON (songs.album_id = albums.id)
+                            %s""" % joinstring
+        select = """SELECT count(*), total(songs.length), total(songs.size),
+                           total(songs.playcount), total(songs.playcount > 0)
+                    FROM songs
+                    %s
+                    %s""" % (joinstring, wherestring)
+        row = self.con.execute(select, args).fetchone()
+        return songsaggregates(row[0], int(row[1]), int(row[2]), int(row[3]), int(row[4]))
+
     def _getlastplayedsongs(self, sort=None, filters=None):
-        """return the last played songs"""
+        """return the last played songs (once per day on which they have been played)"""
+        filters = self._compilefilters(filters)
         joinstring = filters and filters.SQL_JOIN_string() or ""
         wherestring = filters and filters.SQL_WHERE_string() or ""
         orderstring = sort and sort.SQL_string() or ""
         args = filters and filters.SQL_args() or []
-        select = """SELECT DISTINCT songs.id              AS song_id,
-                                    songs.album_id        AS album_id,
-                                    songs.artist_id       AS artist_id,
-                                    songs.album_artist_id AS album_artist_id,
-                                    playstats.date_played AS date_played
-                    FROM songs
+        select = """SELECT songs.id                        AS song_id,
+                           songs.album_id                  AS album_id,
+                           songs.artist_id                 AS artist_id,
+                           songs.album_artist_id           AS album_artist_id,
+                           playstats_daily.date_lastplayed AS date_played
+                    FROM playstats_daily
+                    JOIN      songs     ON (songs.id = playstats_daily.song_id)
                     LEFT JOIN artists   ON (songs.artist_id = artists.id)
                     LEFT JOIN albums    ON (songs.album_id = albums.id) 
-                    JOIN      playstats ON (songs.id = playstats.song_id)
                     %s
                     %s
                     %s
@@ -805,17 +1653,150 @@ class songdb(service.service):
                            row["album_artist_id"], row["date_played"])
                  for row in self.con.execute(select, args)]
 
-    def _getplaylists(self, filters=None):
+    # weighted random selection of songs
+
+    _randomcandidates = """SELECT songs.id              AS song_id,
+                                  songs.album_id        AS album_id,
+                                  songs.artist_id       AS artist_id,
+                                  songs.album_artist_id AS album_artist_id,
+                                  songs.rating          AS rating,
+                                  songs.playcount       AS playcount,
+                                  songs.skipcount       AS skipcount,
+                                  songs.date_lastplayed AS date_lastplayed,
+                                  songs.length          AS length
+                           FROM songs
+                           LEFT JOIN artists   ON (songs.artist_id = artists.id)
+                           LEFT JOIN albums    ON (songs.album_id = albums.id)
+                           %s
+                           %s"""
+
+    def _getsampler(self):
+        """ return sampler containing the weights of all songs, setting it up if necessary """
+        self.samplerlock.acquire()
+        try:
+            if self.sampler is None:
+                weights = {}
+                for row in self.con.execute("SELECT id, rating, playcount, skipcount FROM songs"):
+                    weights[row["id"]] = sampler.songweight(row["rating"], row["playcount"], row["skipcount"])
+                self.sampler = sampler.weightedsampler(weights)
+            return self.sampler
+        finally:
+            self.samplerlock.release()
+
+    def _updatesampler(self, song_ids):
+        """ update weights of songs with song_ids after they have been changed in the database """
+        # Holding the lock ensures that a sampler set up concurrently
+        # from an older state of the database is updated as well.
+        self.samplerlock.acquire()
+        try:
+            if self.sampler is None:
+                return
+            song_ids = list(song_ids)
+            for i in range(0, len(song_ids), self._maxidsperquery):
+                chunk = song_ids[i:i+self._maxidsperquery]
+                weights = dict.fromkeys(chunk, 0)
+                for row in self.con.execute("SELECT id, rating, playcount, skipcount FROM songs WHERE id IN (%s)" %
+                                            ", ".join(["?"] * len(chunk)), chunk):
+                    weights[row["id"]] = sampler.songweight(row["rating"], row["playcount"], row["skipcount"])
+                for song_id, weight in weights.items():
+                    self.sampler.setweight(song_id, weight)
+        finally:
+            self.samplerlock.release()
+
+    def _getrandomsongs(self, filters=None, number=100, length=None):
+        """ return weighted random selection of at most number songs matching filters
+
+        The selection stops as soon as the total length of the songs exceeds length.
+        """
+        # tag, rating and compilation filters are checked directly for the drawn songs
+        selected, all, key, filters = self._splitfilters(filters)
         joinstring = filters and filters.SQL_JOIN_string() or ""
         wherestring = filters and filters.SQL_WHERE_string() or ""
         args = filters and filters.SQL_args() or []
+        currenttime = time.time()
+        result = []
+        totallength = 0
+        chosen = {}
+        rejected = {}
+        asampler = self._getsampler()
+        # We draw songs according to their weights and reject those which do not
+        # match the filters or, with the appropriate probability, have been played
+        # recently. For restrictive filters, this may take too many draws, in
+        # which case we examine all songs matching the filters instead.
+        ndrawn = 0
+        maxdrawn = 10*number + 100
+        while ndrawn < maxdrawn:
+            drawn = asampler.draw(min(max(2*(number-len(result)), 50), self._maxidsperquery))
+            if not drawn:
+                # the database is empty
+                return result
+            ndrawn += len(drawn)
+            song_ids = [song_id for song_id in drawn if song_id not in chosen and song_id not in rejected]
+            if selected is not None:
+                song_ids = [song_id for song_id in song_ids if (selected >> song_id) & 1]
+            if not song_ids:
+                continue
+            candidates = list(set(song_ids))
+            idstring = "songs.id IN (%s)" % ", ".join(["?"] * len(candidates))
+            if wherestring:
+                select = self._randomcandidates % (joinstring, "%s AND %s" % (wherestring, idstring))
+            else:
+                select = self._randomcandidates % (joinstring, "WHERE %s" % idstring)
+            rows = {}
+            for row in self.con.execute(select, args + candidates):
+                rows[row["song_id"]] = row
+            for song_id in song_ids:
+                row = rows.get(song_id)
+                if row is None:
+                    rejected[song_id] = True
+                    continue
+                if song_id in chosen:
+                    continue
+                weight = sampler.songweight(row["rating"], row["playcount"], row["skipcount"])
+                reducedweight = sampler.songweight(row["rating"], row["playcount"], row["skipcount"],
+                                                   row["date_lastplayed"], currenttime)
+                if random.random() * weight > reducedweight:
+                    continue
+                chosen[song_id] = True
+                result.append(item.song(self.id, song_id, row["album_id"], row["artist_id"],
+                                        row["album_artist_id"]))
+                totallength += row["length"] or 0
+                if len(result) >= number or (length is not None and totallength >= length):
+                    return result
+
+        # Examine all remaining songs matching the filters. Choosing the songs with the
+        # largest values of u**(1/weight) for uniform random u amounts to the same
+        # weighted selection without replacement.
+        keys = []
+        if selected is not None:
+            selected = set(bitsets.toids(selected))
+        for row in self.con.execute(self._randomcandidates % (joinstring, wherestring), args):
+            if row["song_id"] in chosen or (selected is not None and row["song_id"] not in selected):
+                continue
+            weight = sampler.songweight(row["rating"], row["playcount"], row["skipcount"],
+                                        row["date_lastplayed"], currenttime)
+            keys.append((random.random() ** (1/weight), row))
+        keys.sort(key=lambda x: x[0], reverse=True)
+        for key, row in keys:
+            result.append(item.song(self.id, row["song_id"], row["album_id"], row["artist_id"],
+                                    row["album_artist_id"]))
+            totallength += row["length"] or 0
+            if len(result) >= number or (length is not None and totallength >= length):
+                break
+        return result
+
+    def _getplaylists(self, filters=None):
+        sqlfilters = self._compilefilters(filters)
+        joinstring = sqlfilters and sqlfilters.SQL_JOIN_string() or ""
+        wherestring = sqlfilters and sqlfilters.SQL_WHERE_string() or ""
+        args = sqlfilters and sqlfilters.SQL_args() or []
         select ="""SELECT DISTINCT playlists.id AS playlist_id, playlists.name AS playlist_name
                    FROM playlists
                    JOIN playlistcontents ON (playlistcontents.playlist_id = playlists.id)
                    JOIN songs ON (songs.id = playlistcontents.song_id)
                    %s
                    %s
-                   ORDER BY playlists.name COLLATE NOCASE""" % (joinstring, wherestring)
+                   ORDER BY playlists.sortname""" % (joinstring, wherestring)
         # JOIN taggings ON (taggings.tag_id = tags.id)
         # log.debug(select)
         return [item.playlist(self.id, row["playlist_id"], row["playlist_name"], filters)
@@ -843,6 +1824,32 @@ class songdb(service.service):
                 log.debug_traceback()
                 pass
 
+    def add_songs(self, event):
+        if event.songdbid == self.id:
+            try:
+                self._add_songs(event.songs)
+            except:
+                # fall back to adding the songs one by one, such that a
+                # single invalid song does not prevent the others from being added
+                log.debug_traceback()
+                for song in event.songs:
+                    try:
+                        self._add_song(song)
+                    except:
+                        log.debug_traceback()
+
+    def update_songs(self, event):
+        if event.songdbid == self.id:
+            try:
+                self._update_songs(event.songs)
+            except:
+                log.debug_traceback()
+                for song in event.songs:
+                    try:
+                        self._update_song(song)
+                    except:
+                        log.debug_traceback()
+
     def delete_song(self, event):
         if event.songdbid == self.id:
             try:
@@ -895,21 +1902,31 @@ class songdb(service.service):
     def getdatabasestats(self, request):
         if self.id != request.songdbid:
             raise hub.DenyRequest
+        aggregates = self._getsongsaggregates()
         return songdbstats(self.id, "local", self.basedir, None, self.dbfile, self.cachesize, 
-                           self.getnumberofsongs(request), 
-                           self.getnumberofalbums(request),
-                           self.getnumberofartists(request),
-                           self.getnumberoftags(request))
+                           aggregates.numberofsongs,
+                           self._getnumberofalbums(),
+                           self._getnumberofartists(),
+                           self._getnumberoftags(),
+                           aggregates.totallength, aggregates.totalsize)
 
     def getnumberofsongs(self, request):
         if self.id != request.songdbid:
             raise hub.DenyRequest
-        return self.con.execute("SELECT count(*) FROM songs").fetchone()[0]
+        try:
+            return self._getnumberofsongs(request.filters)
+        except (KeyError, AttributeError, TypeError):
+            log.debug_traceback()
+            return 0
 
     def getnumberoftags(self, request):
         if self.id != request.songdbid:
             raise hub.DenyRequest
-        return self.con.execute("SELECT count(*) FROM tags").fetchone()[0]
+        try:
+            return self._getnumberoftags(request.filters)
+        except (KeyError, AttributeError, TypeError):
+            log.debug_traceback()
+            return 0
 
     def getnumberofratings(self, request):
         if self.id != request.songdbid:
@@ -919,12 +1936,29 @@ class songdb(service.service):
     def getnumberofalbums(self, request):
         if self.id != request.songdbid:
             raise hub.DenyRequest
-        return self.con.execute("SELECT count(*) FROM albums").fetchone()[0]
+        try:
+            return self._getnumberofalbums(request.filters)
+        except (KeyError, AttributeError, TypeError):
+            log.debug_traceback()
+            return 0
 
     def getnumberofartists(self, request):
         if self.id != request.songdbid:
             raise hub.DenyRequest
-        return self.con.execute("SELECT count(*) FROM artists").fetchone()[0]
+        try:
+            return self._getnumberofartists(request.filters)
+        except (KeyError, AttributeError, TypeError):
+            log.debug_traceback()
+            return 0
+
+    def getsongsaggregates(self, request):
+        if self.id != request.songdbid:
+            raise hub.DenyRequest
+        try:
+            return self._getsongsaggregates(request.filters)
+        except (KeyError, AttributeError, TypeError):
+            log.debug_traceback()
+            return songsaggregates(0, 0, 0, 0, 0)
 
     def getsong_metadata(self, request):
         if self.id != request.songdbid:
@@ -934,11 +1968,31 @@ class songdb(service.service):
         except KeyError:
             return None
 
+    def getsong_texts(self, request):
+        if self.id != request.songdbid:
+            raise hub.DenyRequest
+        return self._getsong_texts(request.song_id)
+
+    def getsongs_metadata(self, request):
+        if self.id != request.songdbid:
+            raise hub.DenyRequest
+        try:
+            return self._getsongs_metadata(request.song_ids)
+        except:
+            log.debug_traceback()
+            return [None] * len(request.song_ids)
+
+    def getsongfilesinfo(self, request):
+        if self.id != request.songdbid:
+            raise hub.DenyRequest
+        return self._getsongfilesinfo()
+
     def getsongs(self, request):
         if self.id != request.songdbid:
             raise hub.DenyRequest
         try:
-            return self._getsongs(request.sort, request.filters)
+            return self._getsongs(request.sort, request.filters,
+                                  request.limit, request.offset, request.after)
         except (KeyError, AttributeError, TypeError):
             log.debug_traceback()
             return []
@@ -947,7 +2001,7 @@ class songdb(service.service):
         if self.id != request.songdbid:
             raise hub.DenyRequest
         try:
-            return self._getartists(request.filters)
+            return self._getartists(request.filters, request.limit, request.offset, request.after)
         except KeyError:
             log.debug_traceback()
             return []
@@ -956,7 +2010,7 @@ class songdb(service.service):
         if self.id != request.songdbid:
             raise hub.DenyRequest
         try:
-            return self._getalbums(request.filters)
+            return self._getalbums(request.filters, request.limit, request.offset, request.after)
         except KeyError:
             log.debug_traceback()
             return []
@@ -990,21 +2044,133 @@ class songdb(service.service):
             raise hub.DenyRequest
         return self._getlastplayedsongs(request.sort, request.filters)
 
+    def getrandomsongs(self, request):
+        if self.id != request.songdbid:
+            raise hub.DenyRequest
+        try:
+            return self._getrandomsongs(request.filters, request.number, request.length)
+        except (KeyError, AttributeError, TypeError):
+            log.debug_traceback()
+            return []
+
 
 #
 # thread for automatic registering and rescanning of songs in database
 #
 
+class songdbreaders(service.service):
+
+    """ pool of threads serving read requests for a songdb via read-only connections
+
+    Requests are processed only after the songdb has applied all database events,
+    which have been received before the request. Thus, a request always sees the
+    changes sent before it, but does not wait for changes sent afterwards.
+    """
+
+    def __init__(self, songdb, nreaders, songdbhub):
+        service.service.__init__(self, "%r songdb readers" % songdb.id, daemonize=True, hub=songdbhub)
+        self.songdb = songdb
+        # mapping request class -> handler
+        self.handlers = {}
+        # number of database events received so far
+        self.eventsreceived = 0
+        self.jobs = Queue.Queue()
+        self.readers = []
+        for i in range(nreaders):
+            reader = threading.Thread(target=self._reader, name="%r songdb reader %d" % (songdb.id, i))
+            reader.setDaemon(True)
+            self.readers.append(reader)
+
+        self.channel.subscribe(events.dbevent, self.dbevent)
+
+    def supply(self, requestclass, handler):
+        self.handlers[requestclass] = handler
+        # register the request with the channel, such that the hub routes it to us
+        self.channel.supply(requestclass, handler)
+
+    def run(self):
+        for reader in self.readers:
+            reader.start()
+        service.service.run(self)
+
+    def work(self):
+        # We do not use self.channel.process since the requests are answered
+        # asynchronously by the reader threads.
+        item = self.channel.queue.get()
+        if isinstance(item, events.event):
+            self.channel.processitem(item)
+        elif item.request.songdbid == self.songdb.id:
+            handler = self.handlers.get(item.request.__class__)
+            if handler is not None:
+                self.jobs.put((self.eventsreceived, handler, item))
+
+    def _reader(self):
+        if not self.songdb.openreadconnection():
+            return
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            eventsreceived, handler, rr = job
+            if rr.cancelled:
+                continue
+            self.songdb.waitforevents(eventsreceived)
+            try:
+                result = handler(rr.request)
+            except:
+                log.debug_traceback()
+                result = None
+            rr.setresult(result)
+        self.songdb.con.close()
+
+    # event handlers
+
+    def dbevent(self, event):
+        if event.songdbid == self.songdb.id:
+            self.eventsreceived += 1
+
+    def quit(self, event):
+        service.service.quit(self, event)
+        for reader in self.readers:
+            self.jobs.put(None)
+
+
+class _scanstate:
+
+    """ bookkeeping of a running scan of the music directory """
+
+    def __init__(self):
+        self.starttime = self.lastreport = time.time()
+        # urls of all readable songs found
+        self.seen = set()
+        # pending new songs (song metadata) and changed songs ((song, song metadata) tuples)
+        self.added = []
+        self.updated = []
+        # number of files scanned, added and updated
+        self.nscanned = 0
+        self.nadded = 0
+        self.nupdated = 0
+
+    def throughput(self):
+        return self.nscanned / max(time.time() - self.starttime, 1e-3)
+
+
 class songautoregisterer(service.service):
 
+    # number of new or changed songs written to the database in one go
+    scanbatchsize = 100
+    # interval in seconds between two progress reports during a scan
+    scanreportinterval = 10
+
     def __init__(self, basedir, songdbid, dbbusymethod,
-                 tracknrandtitlere, postprocessors):
+                 tracknrandtitlere, postprocessors, scanthreads=1):
         service.service.__init__(self, "songautoregisterer", daemonize=True)
         self.basedir = basedir
         self.songdbid = songdbid
         self.dbbusymethod = dbbusymethod
         self.tracknrandtitlere = tracknrandtitlere
         self.postprocessors = postprocessors
+        self.scanthreads = max(1, scanthreads)
         self.done = False
         # support file extensions
         self.supportedextensions = metadata.getextensions()
@@ -1069,44 +2235,169 @@ class songautoregisterer(service.service):
             song = self._request(requests.getsongs(self.songdbid, filters=urlfilter))[0]
         return song
 
-    def registerdirtree(self, dir, oldsongs, force):
-        """ scan for songs in dir and its subdirectories, removing those scanned from the set oldsongs. 
+    def _walk(self, dir):
+        """ generate paths of all files with supported extensions in dir and its subdirectories
 
-        If force is set, the m_time of a song is ignored and the song is always scanned.
+        If scandir is available, the file type is taken from the directory
+        entries, which avoids a stat call per entry on most file systems.
         """
-        log.debug("registerer: entering %r"% dir)
-        self.channel.process()
-        if self.done: return
-        songpaths = []
-
-        # scan for paths of songs and recursively call registering of subdirectories
-        for name in os.listdir(dir):
-            path = os.path.join(dir, name)
-            extension = os.path.splitext(path)[1].lower()
-            if os.access(path, os.R_OK):
-                if os.path.isdir(path):
-                    try:
-                        self.registerdirtree(path, oldsongs, force)
-                    except (IOError, OSError), e:
-                        log.warning("songautoregisterer: could not enter dir %r: %r" % (path, e))
-                elif extension in self.supportedextensions:
-                    songpaths.append(path)
-
-        # now register songs...
-        songs = []
-        for path in songpaths:
+        dirs = [dir]
+        while dirs:
+            dir = dirs.pop()
+            log.debug("registerer: entering %r"% dir)
+            subdirs = []
             try:
-                song = self._registerorupdatesong(path, force)
-                # remove song from list of songs to be checked (if present)
-                oldsongs.discard(song)
-            except (IOError, OSError):
-                # if the registering or update failed we do nothing and the song
-                # will be deleted from the database later on
-                pass
+                if scandir is not None:
+                    entries = [(entry.path, entry.is_dir()) for entry in scandir(dir)]
+                else:
+                    entries = [(os.path.join(dir, name), None) for name in os.listdir(dir)]
+            except (IOError, OSError), e:
+                log.warning("songautoregisterer: could not enter dir %r: %r" % (dir, e))
+                continue
+            for path, isdir in entries:
+                if isdir is None:
+                    isdir = os.path.isdir(path)
+                if isdir:
+                    subdirs.append(path)
+                elif os.path.splitext(path)[1].lower() in self.supportedextensions:
+                    yield path
+            # visit subdirectories in alphabetical order
+            subdirs.sort()
+            subdirs.reverse()
+            dirs.extend(subdirs)
+
+    def _scanworker(self, jobs, results, songfilesinfo, force):
+        """ read metadata of the song files in the queue jobs and put them in the queue results
+
+        The results are tuples (url, status, song, song metadata), where status is
+        one of "unchanged", "changed", "new" or "failed". The worker terminates
+        when receiving None.
+        """
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            path, relpath, url = job
+            song = None
+            try:
+                info = songfilesinfo.get(url)
+                if info is not None:
+                    song, date_updated, size = info
+                    if not force:
+                        stat = os.stat(path)
+                        if date_updated >= stat.st_mtime and size == stat.st_size:
+                            results.put((url, "unchanged", song, None))
+                            continue
+                newsong_metadata = metadata.metadata_from_file(relpath, self.basedir,
+                                                               self.tracknrandtitlere, self.postprocessors)
+                results.put((url, song and "changed" or "new", song, newsong_metadata))
+            except (IOError, OSError, RuntimeError):
+                # the song can no longer be read and will thus be deleted
+                # from the database later on
+                results.put((url, "failed", song, None))
             except:
                 # but in case of non-IO exceptions report them in debugging mode
                 log.debug_traceback()
-        log.debug("registerer: leaving %r"% dir)
+                results.put((url, "failed", song, None))
+
+    def _processscanresults(self, results, state, block=False):
+        """ process all results of the scan workers currently available """
+        while True:
+            try:
+                url, status, song, newsong_metadata = results.get(block, 0.1)
+            except Queue.Empty:
+                break
+            block = False
+            state.nscanned += 1
+            if status != "failed":
+                state.seen.add(url)
+            if status == "new":
+                state.added.append(newsong_metadata)
+            elif status == "changed":
+                state.updated.append((song, newsong_metadata))
+            else:
+                log.debug("registerer: song '%r' %s" % (url, status))
+        if len(state.added) + len(state.updated) >= self.scanbatchsize:
+            self._flushscanresults(state)
+        if time.time() - state.lastreport > self.scanreportinterval:
+            state.lastreport = time.time()
+            log.info(_("database %r: %d files scanned (%.1f files/s), %d new and %d changed songs") %
+                     (self.songdbid, state.nscanned, state.throughput(), state.nadded, state.nupdated))
+
+    def _flushscanresults(self, state):
+        """ write pending new and changed songs of the scan to the database """
+        if state.updated:
+            # fetch the stored metadata of all changed songs at once, such
+            # that the information not contained in the song file is kept
+            songs_metadata = self._request(requests.getsongs_metadata(self.songdbid,
+                                                                      [song.id for song, md in state.updated]))
+            songs = []
+            for (song, newsong_metadata), song_metadata in zip(state.updated, songs_metadata):
+                if song_metadata is not None:
+                    song_metadata.update(newsong_metadata)
+                    song.song_metadata = song_metadata
+                    songs.append(song)
+            if songs:
+                self._notify(events.update_songs(self.songdbid, songs))
+            state.nupdated += len(state.updated)
+            state.updated = []
+        if state.added:
+            self._notify(events.add_songs(self.songdbid, state.added))
+            state.nadded += len(state.added)
+            state.added = []
+
+    def registerdirtree(self, dir, songfilesinfo, force):
+        """ scan for songs in dir and its subdirectories and return _scanstate of the scan
+
+        songfilesinfo is a dictionary url -> (song, date_updated, size) of the songs
+        currently registered in the database. Only new songs and those, which
+        changed since their last update, are read. If force is set, all songs are
+        read. The metadata is read in parallel by a pool of worker threads and
+        written to the database in batches.
+        """
+        if self.basedir.endswith("/"):
+            prefixlen = len(self.basedir)
+        else:
+            prefixlen = len(self.basedir) + 1
+        state = _scanstate()
+        jobs = Queue.Queue(100 * self.scanthreads)
+        results = Queue.Queue()
+        workers = []
+        for i in range(self.scanthreads):
+            worker = threading.Thread(target=self._scanworker, args=(jobs, results, songfilesinfo, force))
+            worker.setDaemon(True)
+            worker.start()
+            workers.append(worker)
+        try:
+            for path in self._walk(dir):
+                relpath = path[prefixlen:]
+                url = u"file://" + encoding.decode_path(relpath)
+                while True:
+                    try:
+                        jobs.put((path, relpath, url), timeout=0.1)
+                        break
+                    except Queue.Full:
+                        self._processscanresults(results, state)
+                self._processscanresults(results, state)
+                self.channel.process()
+                if self.done:
+                    break
+        finally:
+            if self.done:
+                # drop pending jobs
+                try:
+                    while True:
+                        jobs.get_nowait()
+                except Queue.Empty:
+                    pass
+            for worker in workers:
+                jobs.put(None)
+            for worker in workers:
+                while worker.isAlive():
+                    self._processscanresults(results, state, block=True)
+            self._processscanresults(results, state)
+            self._flushscanresults(state)
+        return state
 
     def rescansong(self, song, force):
         if song.songdbid != self.songdbid:
@@ -1181,16 +2472,24 @@ class songautoregisterer(service.service):
 
     def autoregistersongs(self, event):
         if self.songdbid == event.songdbid:
-            oldsongs = set(hub.request(requests.getsongs(self.songdbid)))
-            log.info(_("database %r: scanning for songs in %r (currently %d songs registered)") % (self.songdbid, self.basedir, len(oldsongs)))
+            songfilesinfo = self._request(requests.getsongfilesinfo(self.songdbid))
+            log.info(_("database %r: scanning for songs in %r (currently %d songs registered)") % (self.songdbid, self.basedir, len(songfilesinfo)))
 
             # scan for all songs in the filesystem
             log.debug("database %r: searching for new songs" % self.songdbid)
-            self.registerdirtree(self.basedir, oldsongs, event.force)
+            state = self.registerdirtree(self.basedir, songfilesinfo, event.force)
+            log.info(_("database %r: %d files scanned in %.0f s (%.1f files/s), %d new and %d changed songs") %
+                     (self.songdbid, state.nscanned, time.time() - state.starttime, state.throughput(),
+                      state.nadded, state.nupdated))
+            if self.done:
+                # the scan has been interrupted, so we cannot know which songs are gone
+                return
 
-            # remove songs which have not yet been scanned and thus are not accesible anymore
-            log.info(_("database %r: removing %d stale songs") % (self.songdbid, len(oldsongs)))
-            for song in oldsongs:
+            # remove songs which have not been found and thus are not accesible anymore
+            stalesongs = [song for url, (song, date_updated, size) in songfilesinfo.iteritems()
+                          if url not in state.seen]
+            log.info(_("database %r: removing %d stale songs") % (self.songdbid, len(stalesongs)))
+            for song in stalesongs:
                 self._notify(events.delete_song(self.songdbid, song))
 
             nrsongs = hub.request(requests.getnumberofsongs(self.songdbid))
@@ -84,21 +84,32 @@ class slist:
                 return
 
     def set(self, items, keepselection=False):
-        """set all items in slist trying to keep the current selection if keepselection is set """
+        """set all items in slist trying to keep the current selection if keepselection is set
+
+        items may be a pagedlist, which is used as is instead of being copied.
+        """
         if keepselection:
             oldselecteditem = self.getselected()
             oldselected = self.selected
-        try:
-            self.items = list(items)
-        except:
-            self.items = []
+        if isinstance(items, pagedlist):
+            self.items = items
+        else:
+            try:
+                self.items = list(items)
+            except:
+                self.items = []
         if keepselection and oldselected is not None and self.items:
             # we try to keep the current selection and search for the previously
             # selected item in the new list. We most probably find it around
             # the original position.
             oldselecteditemid = oldselecteditem.getid()
             startsearch = min(max(0, oldselected-1), len(self))
-            for i in range(startsearch, len(self)) + range(startsearch):
+            if isinstance(self.items, pagedlist):
+                # do not read all pages but only search in the vicinity
+                searchrange = range(startsearch, min(startsearch+self.items.pagesize, len(self)))
+            else:
+                searchrange = range(startsearch, len(self)) + range(startsearch)
+            for i in searchrange:
                 if self[i].getid() == oldselecteditemid:
                     self.selected = i
                     break
@@ -135,6 +146,43 @@ class slist:
         if self.win.hasfocus():
             hub.notify(events.selectionchanged(self.getselected()))
 
+    def _select(self, index):
+        "helper routine, which selects the item at index"
+        self.selected = index
+        self._notifyselectionchanged()
+        self._updatetop()
+
+    def _selectmatching(self, indices, matches, onselected=None):
+        """ helper routine, which selects the first item at one of indices satisfying matches
+
+        Returns True if such an item has been found, otherwise False. Items
+        read page-wise are searched in a separate thread instead and None is
+        returned. The selection is then changed once the search has completed.
+        If given, onselected is called with whether an item has been found
+        after the selection has been changed.
+        """
+        if isinstance(self.items, pagedlist):
+            items = self.items
+            def searched(index):
+                # ignore results for lists which have been replaced in the meantime
+                if items is self.items:
+                    if index is not None:
+                        self._select(index)
+                        self.win.update()
+                    if onselected is not None:
+                        onselected(index is not None)
+            items.search(indices, matches, searched, self.win.channel)
+            return None
+        for i in indices:
+            if matches(self[i]):
+                self._select(i)
+                if onselected is not None:
+                    onselected(True)
+                return True
+        if onselected is not None:
+            onselected(False)
+        return False
+
     def _updatetop(self):
         "helper routine, which updates self.top"
 
@@ -209,16 +257,14 @@ class slist:
                 return True
         return False
 
-    def selectbyid(self, id):
+    def selectbyid(self, id, onselected=None):
         """select entry by id
-        Returns True if selection was valid, otherwise False."""
+        Returns True if selection was valid, otherwise False (or None
+        if the search is still going on, see _selectmatching)."""
         if len(self) > 0:
-            for i in range(len(self)):
-                if self[i].id == id:
-                    self.selected = i
-                    self._notifyselectionchanged()
-                    self._updatetop()
-                    return True
+            return self._selectmatching(range(len(self)), lambda item: item.id == id, onselected)
+        if onselected is not None:
+            onselected(False)
         return False
 
     def selectbysearchstring(self, searchstring):
@@ -230,12 +276,8 @@ class slist:
                 first = 0
             else:
                 first = self.selected
-            for i in range(first+1, len(self)) + range(first):
-                if self[i].getname().lower().find(searchstring)!=-1:
-                    self.selected = i
-                    self._notifyselectionchanged()
-                    self._updatetop()
-                    return True
+            return self._selectmatching(range(first+1, len(self)) + range(first),
+                                        lambda item: item.getname().lower().find(searchstring)!=-1)
         return False
 
     def selectbyregexp(self, regexp, includeselected=True):
@@ -250,12 +292,8 @@ class slist:
                 first = 0
             else:
                 first = self.selected
-            for i in range(first + (not includeselected and 1 or 0), len(self)) + range(first):
-                if cregexp.search(self[i].getname()):
-                    self.selected = i
-                    self._notifyselectionchanged()
-                    self._updatetop()
-                    return True
+            return self._selectmatching(range(first + (not includeselected and 1 or 0), len(self)) + range(first),
+                                        lambda item: cregexp.search(item.getname()))
         return False
 
     def selectbyletter(self, letter):
@@ -267,12 +305,8 @@ class slist:
             else:
                 first = self.selected
                 letter = letter.lower()
-                for i in range(first+1, len(self)) + range(first):
-                    if self[i].getname().lower().startswith(letter):
-                        self.selected = i
-                        self._notifyselectionchanged()
-                        self._updatetop()
-                        return True
+                return self._selectmatching(range(first+1, len(self)) + range(first),
+                                            lambda item: item.getname().lower().startswith(letter))
         return False
 
     def selectrelative(self, dist):
@@ -335,3 +369,167 @@ class slist:
             self.items[self.selected+1], self.items[self.selected]
             self.selected += 1
             self._updatetop()
+
+
+class pagedlist:
+    """ read-only list of items, most of which are read page-wise on demand
+
+    The list consists of the items of the list head, followed by length
+    items, which are read in pages of pagesize items by calling
+    getpage(after, offset, limit), and the items of the list tail. If
+    the key (as returned by getkey) of the last item of the preceding page is
+    known, it is passed as after and the database can directly seek to the
+    page. Otherwise, we have to resort to the offset of the page. At most
+    maxpages pages are kept in memory. Whenever a page is accessed, the
+    following one is read in advance in a separate thread.
+
+    Pages are never read by the thread accessing the list. Instead,
+    placeholder is returned for items of pages not available yet, and
+    onpageread is called with the list as argument in the thread
+    processing channel once such a page has been read. Items missing
+    because the contents have changed in the meantime are replaced by
+    placeholder as well.
+    """
+
+    def __init__(self, head, length, tail, getpage, getkey, placeholder, onpageread, channel,
+                 pagesize=500, maxpages=16):
+        self.head = head
+        self.length = length
+        self.tail = tail
+        self.getpage = getpage
+        self.getkey = getkey
+        self.placeholder = placeholder
+        self.onpageread = onpageread
+        self.channel = channel
+        self.pagesize = pagesize
+        self.maxpages = maxpages
+        self.pages = {}          # page number -> list of items
+        self.lastused = []       # page numbers, the least recently used one first
+        self.lastkeys = {}       # page number -> key of last item of page
+        self.reading = {}        # page number -> future of page currently being read
+        self.searchtoken = None  # token identifying the search currently going on
+
+    def __len__(self):
+        return len(self.head) + self.length + len(self.tail)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("pagedlist index out of range")
+        if index < len(self.head):
+            return self.head[index]
+        index -= len(self.head)
+        if index >= self.length:
+            return self.tail[index-self.length]
+        pagenumber, index = divmod(index, self.pagesize)
+        page = self._getpage(pagenumber)
+        if page is None or index >= len(page):
+            return self.placeholder
+        return page[index]
+
+    def readpage(self, index):
+        """ read the page containing the item at index in the calling thread
+
+        This must not be called any more once the list is accessed by the
+        thread processing channel.
+        """
+        index -= len(self.head)
+        if 0 <= index < self.length:
+            pagenumber = divmod(index, self.pagesize)[0]
+            if pagenumber not in self.pages:
+                self._storepage(pagenumber, self.getpage(*self._pageargs(pagenumber)))
+
+    def _pageargs(self, pagenumber):
+        after = self.lastkeys.get(pagenumber-1)
+        if after is not None:
+            return after, 0, self.pagesize
+        return None, pagenumber*self.pagesize, self.pagesize
+
+    def _getpage(self, pagenumber):
+        """ return page or None if it is still being read """
+        page = self.pages.get(pagenumber)
+        if page is None:
+            self._readpage(pagenumber)
+        else:
+            self.lastused.remove(pagenumber)
+            self.lastused.append(pagenumber)
+        # read the following page in advance
+        nextpagenumber = pagenumber + 1
+        if nextpagenumber*self.pagesize < self.length and nextpagenumber not in self.pages:
+            self._readpage(nextpagenumber)
+        return page
+
+    def _readpage(self, pagenumber):
+        """ start reading page in a separate thread unless this is already being done """
+        future = self.reading.get(pagenumber)
+        if future is None:
+            future = hub.callnoblocking(self.getpage, self._pageargs(pagenumber))
+            self.reading[pagenumber] = future
+            future.addcallback(lambda future: self._pageread(pagenumber, future), self.channel)
+        return future
+
+    def _pageread(self, pagenumber, future):
+        if self.reading.get(pagenumber) is future:
+            del self.reading[pagenumber]
+            self._storepage(pagenumber, future.result)
+            self.onpageread(self)
+
+    def _storepage(self, pagenumber, page):
+        page = page or []
+        self.pages[pagenumber] = page
+        if len(page) == self.pagesize:
+            self.lastkeys[pagenumber] = self.getkey(page[-1])
+        self.lastused.append(pagenumber)
+        if len(self.pages) > self.maxpages:
+            del self.pages[self.lastused.pop(0)]
+
+    def search(self, indices, matches, callback, channel):
+        """ search for the first of indices whose item satisfies matches in a separate thread
+
+        callback is called in the thread processing channel with the index
+        found or None. The items of head and tail are checked right away,
+        since they may issue requests themselves. The pages read during
+        the search are not kept. Starting a new search abandons the
+        previous one.
+        """
+        matching = {}
+        for i in range(len(self.head)):
+            if matches(self.head[i]):
+                matching[i] = True
+        for i in range(len(self.tail)):
+            if matches(self.tail[i]):
+                matching[len(self.head)+self.length+i] = True
+        self.searchtoken = token = object()
+
+        def search():
+            pagenumber = page = lastkey = None
+            for i in indices:
+                if self.searchtoken is not token:
+                    return None
+                index = i - len(self.head)
+                if not 0 <= index < self.length:
+                    if i in matching:
+                        return i
+                    continue
+                newpagenumber, index = divmod(index, self.pagesize)
+                if newpagenumber != pagenumber:
+                    page = self.pages.get(newpagenumber)
+                    if page is None:
+                        if lastkey is not None and newpagenumber == pagenumber+1:
+                            page = self.getpage(lastkey, 0, self.pagesize) or []
+                        else:
+                            page = self.getpage(*self._pageargs(newpagenumber)) or []
+                    lastkey = None
+                    if len(page) == self.pagesize:
+                        lastkey = self.getkey(page[-1])
+                    pagenumber = newpagenumber
+                if index < len(page) and matches(page[index]):
+                    return i
+            return None
+
+        def searched(future):
+            if self.searchtoken is token:
+                self.searchtoken = None
+                callback(future.result)
+        hub.callnoblocking(search, callback=searched, channel=channel)
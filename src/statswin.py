@@ -24,17 +24,18 @@ import hub, requests
 
 class statswin(messagewin.messagewin):
 
-    def __init__(self, screen, maxh, maxw, channel, numberofsongdbs):
+    def __init__(self, screen, maxh, maxw, channel, numberofsongdbs, playerids):
         # column number of message string
         messagewin.messagewin.__init__(self, screen, maxh, maxw, channel,
                                        config.colors.statswindow,
                                        _("PyTone Statistics"), [],
                                        config.statswindow.autoclosetime)
         self.numberofsongdbs = numberofsongdbs
+        self.playerids = [playerid for playerid in playerids if playerid is not None]
 
     def _outputlen(self, iw):
         """number of lines in window with inner widht iw"""
-        result = self.numberofsongdbs*4 + 3
+        result = self.numberofsongdbs*6 + 4 + len(self.playerids)*5
         return result
 
     def showitems(self):
@@ -49,6 +50,10 @@ class statswin(messagewin.messagewin):
 									    songdbstats.numberoftags)
 
             lines.append((dbidstring, dbstatstring))
+            hours, seconds = divmod(songdbstats.totallength, 3600)
+            lines.append((indent + _("total") + ":",
+                          _("%d:%02d:%02d playing time, %dMB") % (hours, seconds // 60, seconds % 60,
+                                                                  songdbstats.totalsize // (1024*1024))))
             if songdbstats.type == "local":
                 dbtypestring = _("local database (db file: %s)") % (songdbstats.dbfile)
             else:
@@ -57,6 +62,9 @@ class statswin(messagewin.messagewin):
             lines.append((indent + _("base directory") + ":", songdbstats.basedir)) 
             dbcachesizestring =  "%dkB" % songdbstats.cachesize
             lines.append((indent + _("cache size") + ":", dbcachesizestring))
+            nrequests, size = stats.requestcachesegments.get(songdbstats.id, (0, 0))
+            lines.append((indent + _("request cache") + ":",
+                          _("%d requests, %dkB") % (nrequests, size//1024)))
 
         lines.append(("", ""))
         cachestatsstring = _("%d requests, %d / %d objects") % (stats.requestcacherequests, stats.requestcachesize,
@@ -64,13 +72,49 @@ class statswin(messagewin.messagewin):
         if stats.requestcachemaxsize != 0:
             cachestatsstring = cachestatsstring + " (%d%%)" % (100*stats.requestcachesize//stats.requestcachemaxsize)
         lines.append((_("Request cache size") + ":", cachestatsstring))
+        cachememorystring = "%dkB / %dkB" % (stats.requestcachebytes//1024, stats.requestcachemaxbytes//1024)
+        if stats.requestcachemaxbytes != 0:
+            cachememorystring = cachememorystring + " (%d%%)" % (100*stats.requestcachebytes//stats.requestcachemaxbytes)
+        lines.append((_("Request cache memory") + ":", cachememorystring))
         totalrequests = stats.requestcachehits + stats.requestcachemisses
         if totalrequests != 0:
             percentstring = " (%d%%)" % (100*stats.requestcachehits//totalrequests)
         else:
             percentstring = ""
         lines.append((_("Request cache stats") + ":",
-                      (_("%d hits / %d requests") % (stats.requestcachehits, totalrequests)) + percentstring))
+                      (_("%d hits / %d requests") % (stats.requestcachehits, totalrequests)) + percentstring +
+                      (_(", %d evictions") % stats.requestcacheevictions)))
+
+        for playerid in self.playerids:
+            lines.append(("", ""))
+            playerstats = hub.request(requests.getplayerstats(playerid))
+            playeridstring = _("Player %s") % playerid + ":"
+            if playerstats is None:
+                lines.append((playeridstring, _("no statistics available")))
+                continue
+            lines.append((playeridstring,
+                          _("%.2fs buffer (%.2fs - %.2fs), %d underruns") % (playerstats.bufferlength,
+                                                                            playerstats.minbufferlength,
+                                                                            playerstats.maxbufferlength,
+                                                                            playerstats.underruns)))
+            if playerstats.lowwatermark is not None and playerstats.highwatermark is not None:
+                fillstring = "%.2fs - %.2fs" % (playerstats.lowwatermark, playerstats.highwatermark)
+            else:
+                fillstring = _("buffer not yet filled")
+            lines.append((indent + _("fill level") + ":", fillstring))
+            lines.append((indent + _("device writes") + ":",
+                          _("%d writes, max. latency %dms") % (playerstats.writes, playerstats.maxlatency)))
+            latencystrings = []
+            previousbound = 0
+            for bound, count in playerstats.latencies:
+                if count:
+                    if bound is None:
+                        boundstring = ">%gms" % previousbound
+                    else:
+                        boundstring = "<=%gms" % bound
+                    latencystrings.append("%s %d%%" % (boundstring, 100*count//playerstats.writes))
+                previousbound = bound
+            lines.append((indent + _("latencies") + ":", ", ".join(latencystrings)))
 
         wc1 = max([len(lc) for lc, rc in lines]) + 1
         if wc1 > 0.6*self.iw:
@@ -0,0 +1,149 @@
+# -*- coding: ISO-8859-1 -*-
+
+# Copyright (C) 2003, 2004 Jrg Lehmann <joerg@luga.de>
+#
+# This file is part of PyTone (http://www.luga.de/pytone/)
+#
+# PyTone is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2
+# as published by the Free Software Foundation.
+#
+# PyTone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyTone; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+""" check that the NumPy implementation of the pcm module agrees with the C extension module
+
+Both modules have to be importable, i.e. the extension module has to be built
+(see setup.py) and NumPy has to be installed. Otherwise, the tests are skipped.
+"""
+
+import array, os.path, sys, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+try:
+    import numpy
+    import pcm, pcmnumpy
+except ImportError:
+    pcmnumpy = None
+
+# number of stereo samples of a frame as returned by libmad
+FRAMESAMPLES = 1152
+
+
+def _frames(nframes, seed):
+    """ return list of nframes frames of pseudo-random 16 bit stereo PCM data """
+    result = []
+    x = seed
+    for i in range(nframes):
+        samples = array.array("h")
+        for j in range(2*FRAMESAMPLES):
+            x = (1103515245*x + 12345) % 2147483648
+            samples.append(x % 50000 - 25000)
+        result.append(samples.tostring())
+    return result
+
+
+def _stream(module, frames, in_rate, out_rates, size, factor, mixingrate):
+    """ render frames like decoder.decodedsong.readinto into out buffers of size bytes
+
+    The output rate is taken cyclically from out_rates for each out buffer.
+    Returns the concatenated output and the list of positions returned by render.
+    """
+    output = []
+    positions = []
+    state = None
+    framenr = framepos = 0
+    mixingratio = 0.5
+    chunknr = 0
+    while framenr < len(frames):
+        out_rate = out_rates[chunknr % len(out_rates)]
+        # when mixing, there has to be data in the buffer already
+        out = array.array("c", frames[chunknr % len(frames)][:size].ljust(size, "\0"))
+        start = 0
+        while start < size and framenr < len(frames):
+            frame = frames[framenr]
+            framepos, start, state, mixingratio = module.render(out, start, size, frame, framepos,
+                                                                in_rate, out_rate, state,
+                                                                factor, mixingratio, mixingrate)
+            positions.append((framepos, start))
+            if framepos >= len(frame):
+                framenr += 1
+                framepos = 0
+        output.append(out[:start].tostring())
+        chunknr += 1
+    return "".join(output), positions
+
+
+class rendertest(unittest.TestCase):
+
+    def setUp(self):
+        if pcmnumpy is None:
+            self.skipTest("NumPy or the pcm extension module not available")
+        self.frames = _frames(8, 4711)
+
+    def tearDown(self):
+        if pcmnumpy is not None:
+            for module in pcm, pcmnumpy:
+                module.setresamplingquality("medium")
+
+    def assertequivalent(self, in_rate, out_rates, size=4096, factor=0.8, mixingrate=None):
+        for quality in "low", "medium", "high":
+            for module in pcm, pcmnumpy:
+                module.setresamplingquality(quality)
+            cresult, cpositions = _stream(pcm, self.frames, in_rate, out_rates, size, factor, mixingrate)
+            nresult, npositions = _stream(pcmnumpy, self.frames, in_rate, out_rates, size, factor, mixingrate)
+            self.assertEqual(cpositions, npositions)
+            csamples = numpy.frombuffer(cresult, numpy.int16).astype(numpy.int32)
+            nsamples = numpy.frombuffer(nresult, numpy.int16).astype(numpy.int32)
+            # the implementations may round differently
+            self.assert_(abs(csamples - nsamples).max() <= 1)
+
+    def testcopy(self):
+        self.assertequivalent(44100, [44100])
+
+    def testdownsample(self):
+        self.assertequivalent(48000, [44100])
+
+    def testupsample(self):
+        self.assertequivalent(22050, [44100], size=512)
+
+    def testmixing(self):
+        self.assertequivalent(48000, [44100], mixingrate=1e-4)
+
+    def testspeedchanges(self):
+        # changing the playback speed changes the output rate in steps of 441 Hz
+        self.assertequivalent(44100, [44100, 43659, 43218, 44541], size=1024)
+
+
+class resamplertest(unittest.TestCase):
+
+    def setUp(self):
+        if pcmnumpy is None:
+            self.skipTest("NumPy or the pcm extension module not available")
+
+    def testconvert(self):
+        # converting a stream in pieces gives the same result as converting it at once
+        samples = numpy.frombuffer("".join(_frames(2, 42)), numpy.int16).reshape(-1, 2)
+        whole = pcmnumpy.resampler(48000, 44100, first=samples[0])
+        values, consumed = whole.convert(samples[1:], len(samples))
+        pieces = pcmnumpy.resampler(48000, 44100, first=samples[0])
+        pos = 1
+        results = []
+        while pos < len(samples):
+            piece, consumedpiece = pieces.convert(samples[pos:pos+500], 300)
+            results.append(piece)
+            pos += consumedpiece
+        pieced = numpy.concatenate(results)
+        n = min(len(values), len(pieced))
+        self.assert_(n > len(values) - 20)
+        self.assert_(abs(values[:n] - pieced[:n]).max() < 1e-2)
+
+
+if __name__ == "__main__":
+    unittest.main()